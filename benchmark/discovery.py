@@ -0,0 +1,131 @@
+"""
+benchmark of service discovery latency at 1, 10 and 100 instances per
+service. Registers dummy instances under benchmark-discovery-* names and
+deregisters them when done.
+"""
+
+import argparse
+import json
+import random
+import time
+
+from core.redis_service_registry import RedisServiceRegistry, \
+    RedisServiceRegistryKeys
+
+
+SERVICE_NAME_PREFIX = 'benchmark-discovery'
+HOST = 'benchmark.local'
+NUM_SERVICES = 10
+INSTANCES_PER_SERVICE = [1, 10, 100]
+
+
+def discover_service_multi_round_trip(registry, service_name, num):
+    """
+    discovery as it was done before the Lua script: sismember, smembers,
+    then one transaction around smembers and one around the hgetalls
+    """
+    redis = registry._redis
+    if not redis.sismember(RedisServiceRegistryKeys.services_key(),
+                           service_name):
+        return []
+    service_guids_key = RedisServiceRegistryKeys.service_guids_key(
+        service_name)
+    redis.smembers(service_guids_key)
+    guids = list(redis.transaction(
+        lambda pipe: pipe.smembers(service_guids_key), service_guids_key,
+        value_from_callable=True))
+    guids = random.sample(guids, min(num, len(guids)))
+    instance_keys = [RedisServiceRegistryKeys.service_instance_key(
+        service_name, x) for x in guids]
+    configs = redis.transaction(
+        lambda pipe: [pipe.hgetall(x) for x in instance_keys],
+        *instance_keys, value_from_callable=True)
+    return [registry.parse_service_config(x) for x in configs]
+
+
+def register_instances(registry, service_name, num):
+    guids = []
+    for i in xrange(num):
+        guid = '%s-%d' % (service_name, i)
+        registry.register_service({
+            'name': service_name,
+            'host': HOST,
+            'port': 20000 + i,
+            'guid': guid,
+            'pid': i,
+            'functions': json.dumps(['heartbeat', 'healthcheck']),
+            'socket_type': 'REP',
+            'connect_method': 'bind',
+            'alive': json.dumps(True)
+        })
+        guids.append(guid)
+    return guids
+
+
+def measure(function, iterations):
+    """
+    :return: (mean, p50, p99) latency of function in microseconds
+    """
+    latencies = []
+    for _ in xrange(iterations):
+        start = time.time()
+        function()
+        latencies.append((time.time() - start) * 1000000)
+    latencies.sort()
+    return (sum(latencies) / len(latencies),
+            latencies[len(latencies) / 2],
+            latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))])
+
+
+def main(host, port, db, iterations, num):
+    registry = RedisServiceRegistry(host=host, port=port, db=db)
+    print '%-32s %10s %10s %10s %10s' % ('discovery', 'instances',
+                                         'mean(us)', 'p50(us)', 'p99(us)')
+    for instances in INSTANCES_PER_SERVICE:
+        service_names = ['%s-%d-%d' % (SERVICE_NAME_PREFIX, instances, i)
+                         for i in xrange(NUM_SERVICES)]
+        registered = dict((x, register_instances(registry, x, instances))
+                          for x in service_names)
+        try:
+            cases = [
+                ('multi round trip (before)',
+                 lambda: discover_service_multi_round_trip(
+                     registry, service_names[0], num)),
+                ('discover_service',
+                 lambda: registry.discover_service(service_names[0], num)),
+                ('discover_services x%d' % NUM_SERVICES,
+                 lambda: registry.discover_services(service_names, num)),
+                ('%d x discover_service' % NUM_SERVICES,
+                 lambda: [registry.discover_service(x, num)
+                          for x in service_names])
+            ]
+            for name, function in cases:
+                print '%-32s %10d %10.1f %10.1f %10.1f' % (
+                    (name, instances) + measure(function, iterations))
+
+            watching_registry = RedisServiceRegistry(host=host, port=port,
+                                                     db=db)
+            watching_registry.watch(service_names)
+            print '%-32s %10d %10.1f %10.1f %10.1f' % (
+                ('discover_service (watched)', instances) + measure(
+                    lambda: watching_registry.discover_service(
+                        service_names[0], num), iterations))
+            watching_registry.unwatch()
+        finally:
+            for service_name, guids in registered.items():
+                for guid in guids:
+                    registry.deregister_service(service_name, guid, HOST)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Service discovery benchmark")
+    parser.add_argument("--host", default='127.0.0.1', help="redis host")
+    parser.add_argument("--port", type=int, default=6379, help="redis port")
+    parser.add_argument("--db", type=int, default=9, help="redis db")
+    parser.add_argument("-n", "--iterations", type=int, default=1000,
+                        help="discoveries per measurement")
+    parser.add_argument("--num", type=int, default=5,
+                        help="instances sampled per discovery")
+    args = parser.parse_args()
+    main(args.host, args.port, args.db, args.iterations, args.num)
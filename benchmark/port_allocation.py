@@ -0,0 +1,145 @@
+"""
+benchmark of port allocation when many services start on one host at
+once: REGISTRATIONS threads allocate a port and register at the same
+moment, time-to-ready is measured from that moment to the registration.
+Registers dummy instances of a benchmark-ports service on a dummy host and
+cleans them up when done.
+"""
+
+import argparse
+import json
+import threading
+import time
+
+from core.redis_service_registry import RedisServiceRegistry, \
+    RedisServiceRegistryKeys
+
+
+SERVICE_NAME = 'benchmark-ports'
+HOST = 'benchmark-ports.local'
+REGISTRATIONS = 200
+PORT_BATCH_SIZE = 100
+
+
+def next_available_port_watch(registry, host, attempts):
+    """
+    port allocation as it was done before the Lua script: a WATCH/MULTI
+    transaction on the ZSET of pre-allocated ports, retried when another
+    allocation changed it meanwhile
+    """
+    host_ports_key = RedisServiceRegistryKeys.host_ports_key(host)
+    allocated = []
+
+    def _next_available_port(pipe):
+        attempts.append(1)
+        count = pipe.zcard(host_ports_key)
+        if count <= 1:
+            first = registry.STARTING_PORT if count == 0 else \
+                int(pipe.zrange(host_ports_key, 0, 0)[0]) + 1
+            ports = []
+            for p in xrange(first, first + PORT_BATCH_SIZE):
+                ports.extend([p, p])
+            pipe.zadd(host_ports_key, *ports)
+        port = pipe.zrange(host_ports_key, 0, 0)[0]
+        pipe.multi()
+        pipe.zrem(host_ports_key, port)
+        allocated[:] = [int(port)]
+
+    registry._redis.transaction(_next_available_port, host_ports_key)
+    return allocated[0]
+
+
+def run(registry, allocate, num):
+    start_event = threading.Event()
+    times_to_ready = []
+    ports = []
+    errors = []
+
+    def _register(i):
+        guid = '%s-%d' % (SERVICE_NAME, i)
+        start_event.wait()
+        start = time.time()
+        try:
+            port = allocate(guid)
+            registry.register_service({
+                'name': SERVICE_NAME,
+                'host': HOST,
+                'port': port,
+                'guid': guid,
+                'pid': i,
+                'functions': json.dumps(['heartbeat']),
+                'socket_type': 'REP',
+                'connect_method': 'bind'
+            })
+        except Exception as exception:
+            errors.append(exception)
+            return
+        times_to_ready.append((time.time() - start) * 1000)
+        ports.append(port)
+
+    threads = [threading.Thread(target=_register, args=(i,))
+               for i in xrange(num)]
+    for thread in threads:
+        thread.start()
+    start = time.time()
+    start_event.set()
+    for thread in threads:
+        thread.join()
+    elapsed = (time.time() - start) * 1000
+
+    for i in xrange(num):
+        registry.deregister_service(SERVICE_NAME, '%s-%d' % (SERVICE_NAME, i),
+                                    HOST)
+    times_to_ready.sort()
+    return {
+        'elapsed': elapsed,
+        'p50': times_to_ready[len(times_to_ready) / 2]
+        if times_to_ready else None,
+        'p99': times_to_ready[min(len(times_to_ready) - 1,
+                                  len(times_to_ready) * 99 / 100)]
+        if times_to_ready else None,
+        'duplicate_ports': len(ports) - len(set(ports)),
+        'errors': len(errors)
+    }
+
+
+def clean(registry):
+    registry._redis.delete(RedisServiceRegistryKeys.host_ports_key(HOST),
+                           RedisServiceRegistryKeys.host_next_port_key(HOST))
+
+
+def main(host, port, db, num):
+    registry = RedisServiceRegistry(host=host, port=port, db=db)
+    print '%-28s %12s %10s %10s %10s %10s %8s' % (
+        'allocation', 'elapsed(ms)', 'p50(ms)', 'p99(ms)', 'attempts',
+        'dup ports', 'errors')
+
+    clean(registry)
+    attempts = []
+    result = run(registry, lambda guid: next_available_port_watch(
+        registry, HOST, attempts), num)
+    print '%-28s %12.1f %10.1f %10.1f %10d %10d %8d' % (
+        'WATCH/MULTI (before)', result['elapsed'], result['p50'],
+        result['p99'], len(attempts), result['duplicate_ports'],
+        result['errors'])
+
+    clean(registry)
+    result = run(registry, lambda guid: registry.next_available_port(
+        SERVICE_NAME, guid, HOST), num)
+    print '%-28s %12.1f %10.1f %10.1f %10d %10d %8d' % (
+        'next_available_port', result['elapsed'], result['p50'],
+        result['p99'], num, result['duplicate_ports'], result['errors'])
+    clean(registry)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Port allocation benchmark")
+    parser.add_argument("--host", default='127.0.0.1', help="redis host")
+    parser.add_argument("--port", type=int, default=6379, help="redis port")
+    parser.add_argument("--db", type=int, default=9, help="redis db")
+    parser.add_argument("-n", "--registrations", type=int,
+                        default=REGISTRATIONS,
+                        help="registrations started at once")
+    args = parser.parse_args()
+    main(args.host, args.port, args.db, args.registrations)
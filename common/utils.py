@@ -3,9 +3,13 @@ Module provides generic utility methods
 """
 
 import ConfigParser
+import ctypes
+import ctypes.util
 import hashlib
 import os
 import subprocess
+import sys
+import threading
 import time
 import zmq
 
@@ -33,6 +37,29 @@ def redis_config_from_config_file(config, section, defaults=None):
     if config.has_option(section, "db"):
         ret["db"] = config.getint(section, "db")
 
+    # replicas = host:port, host:port
+    if config.has_option(section, "replicas"):
+        ret["replicas"] = [x.strip() for x in
+                           config.get(section, "replicas").split(",")
+                           if x.strip()]
+
+    # shards = host:port[:db] [replica host:port ...], host:port[:db] ...
+    if config.has_option(section, "shards"):
+        ret["shards"] = [x.split() for x in
+                         config.get(section, "shards").split(",")
+                         if x.strip()]
+
+    if config.has_option(section, "snapshot_file"):
+        ret["snapshot_file"] = config.get(section, "snapshot_file")
+
+    if config.has_option(section, "snapshot_max_age"):
+        ret["snapshot_max_age"] = config.getint(section, "snapshot_max_age")
+
+    # in milliseconds
+    for x in ['socket_timeout', 'socket_connect_timeout']:
+        if config.has_option(section, x):
+            ret[x] = config.getint(section, x)
+
     return ret
 
 
@@ -49,6 +76,23 @@ def zmq_socket_from_socket_type(context, socket_type):
         return context.socket(zmq.PUSH)
     elif socket_type == "PULL":
         return context.socket(zmq.PULL)
+    elif socket_type == "ROUTER":
+        return context.socket(zmq.ROUTER)
+    elif socket_type == "DEALER":
+        return context.socket(zmq.DEALER)
+
+
+def split_envelope(frames):
+    """
+    Splits a multipart message received on a ROUTER socket into its routing
+    envelope (including the empty delimiter frame) and its body
+    :param frames: list of frames
+    :return: tuple of (envelope, body)
+    """
+    for i, frame in enumerate(frames):
+        if not frame:
+            return frames[:i + 1], frames[i + 1:]
+    return [], frames
 
 
 def enum(**enums):
@@ -75,6 +119,70 @@ def current_timestamp(seconds=False, milliseconds=False, microseconds=True):
     return int(now_ts * precision)
 
 
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+# clock ids of Linux, other platforms number their clocks differently
+CLOCK_MONOTONIC = 1
+CLOCK_THREAD_CPUTIME_ID = 3
+
+
+def _load_clock_gettime():
+    if not sys.platform.startswith('linux'):
+        return None
+    for name in ('c', 'rt'):
+        path = ctypes.util.find_library(name)
+        if not path:
+            continue
+        try:
+            return ctypes.CDLL(path).clock_gettime
+        except (OSError, AttributeError):
+            continue
+    return None
+
+
+_clock_gettime = _load_clock_gettime()
+# a timespec per thread, made once, keeps a call under a microsecond
+_timespecs = threading.local()
+
+
+def _clock_microseconds(clock_id):
+    try:
+        timespec, pointer = _timespecs.value
+    except AttributeError:
+        timespec = _Timespec()
+        pointer = ctypes.pointer(timespec)
+        _timespecs.value = (timespec, pointer)
+    if _clock_gettime(clock_id, pointer) != 0:
+        return None
+    return timespec.tv_sec * 1000000 + timespec.tv_nsec // 1000
+
+
+def monotonic_time():
+    """
+    Returns microseconds of a clock which never goes back, unlike
+    current_timestamp, for measuring durations. Its origin is arbitrary, it
+    is shared by the processes of a host. Falls back to the wall clock off
+    Linux, or where clock_gettime is not available.
+    """
+    if _clock_gettime is not None:
+        now = _clock_microseconds(CLOCK_MONOTONIC)
+        if now is not None:
+            return now
+    return int(time.time() * 1000000)
+
+
+def thread_cpu_time():
+    """
+    Returns microseconds of CPU time the calling thread used, None off Linux
+    or where clock_gettime is not available
+    """
+    if _clock_gettime is None:
+        return None
+    return _clock_microseconds(CLOCK_THREAD_CPUTIME_ID)
+
+
 def set_time_zone(timezone='America/Los_Angeles'):
     os.environ['TZ'] = timezone
     time.tzset()
@@ -0,0 +1,59 @@
+"""
+Module provides a token bucket budget, which caps extra load (hedged
+requests, retries) to a fraction of the regular requests
+"""
+
+import threading
+import time
+
+
+class TokenBudget(object):
+    """
+    Every regular request deposits 'ratio' tokens, every extra request
+    withdraws one. With ratio=0.05 at most about 5% extra load is sent.
+    'max_tokens' bounds bursts after a long quiet period, the bucket starts
+    with 'initial_tokens' so the first extra requests are not refused.
+    'tokens_per_second' tops the bucket up over time, which keeps a minimum
+    rate of extra requests at low traffic.
+    """
+
+    def __init__(self, ratio, max_tokens=10, initial_tokens=1,
+                 tokens_per_second=0):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens_per_second = tokens_per_second
+        self._tokens = min(initial_tokens, max_tokens)
+        self._last_refill_time = time.time()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'TokenBudget(ratio=%s, tokens=%s)' % (self.ratio, self._tokens)
+
+    @property
+    def tokens(self):
+        return self._tokens
+
+    def _refill(self):
+        if not self.tokens_per_second:
+            return
+        now = time.time()
+        self._tokens = min(self.max_tokens, self._tokens +
+                           (now - self._last_refill_time) *
+                           self.tokens_per_second)
+        self._last_refill_time = now
+
+    def deposit(self):
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self):
+        """
+        :return: True if a token was available and has been taken
+        """
+        with self._lock:
+            self._refill()
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
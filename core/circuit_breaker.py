@@ -0,0 +1,194 @@
+"""
+Module provides a circuit breaker, which takes a failing or slow instance
+of a service out of load balancing for a cooling-off period
+"""
+
+import threading
+
+from common.utils import Enum, current_timestamp
+
+
+BREAKER_STATES = Enum(['closed', 'open', 'half_open'])
+
+
+class CircuitBreaker(object):
+    """
+    Breaker of one instance (guid) of a service.
+
+    closed: requests flow, consecutive failures and timeouts are counted.
+    Too many of them, or an ejection as latency outlier, open the breaker.
+    open: no requests for 'cooling_off_period' milliseconds, after which
+    the breaker turns half_open.
+    half_open: at most 'max_probes' requests at a time are let through,
+    'probe_successes' successful probes close the breaker, a failed probe
+    opens it again. Every probe gives its slot back exactly once, with
+    record_success, record_failure or release.
+    """
+
+    DEFAULT_FAILURE_THRESHOLD = 5
+    DEFAULT_TIMEOUT_THRESHOLD = 2
+    DEFAULT_COOLING_OFF_PERIOD = 30 * 1000  # in milliseconds
+    DEFAULT_MAX_PROBES = 1
+    DEFAULT_PROBE_SUCCESSES = 3
+
+    def __init__(self, service_name, guid,
+                 failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 timeout_threshold=DEFAULT_TIMEOUT_THRESHOLD,
+                 cooling_off_period=DEFAULT_COOLING_OFF_PERIOD,
+                 max_probes=DEFAULT_MAX_PROBES,
+                 probe_successes=DEFAULT_PROBE_SUCCESSES,
+                 logger=None):
+        self.logger = logger
+        self.service = service_name
+        self.guid = guid
+        self.failure_threshold = failure_threshold
+        self.timeout_threshold = timeout_threshold
+        self.cooling_off_period = cooling_off_period
+        self.max_probes = max_probes
+        self.probe_successes = probe_successes
+        self.state = BREAKER_STATES.CLOSED
+        self.consecutive_failures = 0
+        self.consecutive_timeouts = 0
+        self.num_opened = 0
+        self.last_transition_time = current_timestamp()
+        self.last_transition_reason = None
+        self._opened_at = None
+        self._probes_in_flight = 0
+        self._probes_succeeded = 0
+        # probes taken before the latest transition hold no slot
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'CircuitBreaker(service=%s, guid=%s, state=%s)' % (
+            self.service, self.guid, BREAKER_STATES.name_from_value(
+                self.state))
+
+    def log(self, level, message):
+        try:
+            if not hasattr(self, 'logger'):
+                return
+            logger = self.logger
+            if logger is None:
+                return
+            if not hasattr(logger, level):
+                return
+            logger_method = getattr(logger, level)
+            if not logger_method:
+                return
+            logger_method(message)
+        except:
+            pass
+
+    def _transition(self, state, reason):
+        self.log('error' if state == BREAKER_STATES.OPEN else 'info',
+                 'breaker of instance: %s of %s service: %s -> %s (%s)' %
+                 (self.guid, self.service,
+                  BREAKER_STATES.name_from_value(self.state),
+                  BREAKER_STATES.name_from_value(state), reason))
+        self.state = state
+        self.last_transition_time = current_timestamp()
+        self.last_transition_reason = reason
+        if state == BREAKER_STATES.OPEN:
+            self.num_opened += 1
+            self._opened_at = current_timestamp(milliseconds=True)
+        self._probes_in_flight = 0
+        self._probes_succeeded = 0
+        self._generation += 1
+        self.consecutive_failures = 0
+        self.consecutive_timeouts = 0
+
+    def _cooled_off(self):
+        return current_timestamp(milliseconds=True) - self._opened_at >= \
+            self.cooling_off_period
+
+    def available(self):
+        """
+        :return: whether a request may be sent now, without taking a probe
+        slot
+        """
+        if self.state == BREAKER_STATES.CLOSED:
+            return True
+        if self.state == BREAKER_STATES.OPEN:
+            return self._cooled_off()
+        return self._probes_in_flight < self.max_probes
+
+    def acquire(self):
+        """
+        Called when a request is about to be sent, takes a probe slot when
+        half_open
+
+        :return: tuple of (whether the request may be sent, probe). probe is
+        None unless a probe slot was taken, and is passed on to
+        record_success, record_failure or release.
+        """
+        with self._lock:
+            if self.state == BREAKER_STATES.OPEN:
+                if not self._cooled_off():
+                    return False, None
+                self._transition(BREAKER_STATES.HALF_OPEN, 'cooled off')
+            if self.state == BREAKER_STATES.HALF_OPEN:
+                if self._probes_in_flight >= self.max_probes:
+                    return False, None
+                self._probes_in_flight += 1
+                return True, self._generation
+            return True, None
+
+    def _holds_slot(self, probe):
+        return probe is not None and probe == self._generation and \
+            self.state == BREAKER_STATES.HALF_OPEN
+
+    def release(self, probe):
+        """
+        Gives the slot of a probe back without a verdict on the instance,
+        e.g. when the request was not sent
+        """
+        with self._lock:
+            if self._holds_slot(probe):
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+
+    def record_success(self, probe=None):
+        with self._lock:
+            self.consecutive_failures = 0
+            self.consecutive_timeouts = 0
+            if not self._holds_slot(probe):
+                return
+            self._probes_in_flight = max(0, self._probes_in_flight - 1)
+            self._probes_succeeded += 1
+            if self._probes_succeeded >= self.probe_successes:
+                self._transition(BREAKER_STATES.CLOSED, '%d probes succeeded'
+                                 % self._probes_succeeded)
+
+    def record_failure(self, timeout=False, probe=None):
+        with self._lock:
+            if self.state == BREAKER_STATES.HALF_OPEN:
+                if self._holds_slot(probe):
+                    self._transition(BREAKER_STATES.OPEN, 'probe failed')
+                return
+            if self.state != BREAKER_STATES.CLOSED:
+                return
+            self.consecutive_failures += 1
+            if timeout:
+                self.consecutive_timeouts += 1
+            if self.consecutive_timeouts >= self.timeout_threshold:
+                self._transition(BREAKER_STATES.OPEN, '%d consecutive '
+                                 'timeouts' % self.consecutive_timeouts)
+            elif self.consecutive_failures >= self.failure_threshold:
+                self._transition(BREAKER_STATES.OPEN, '%d consecutive '
+                                 'failures' % self.consecutive_failures)
+
+    def eject(self, reason):
+        with self._lock:
+            if self.state == BREAKER_STATES.CLOSED:
+                self._transition(BREAKER_STATES.OPEN, reason)
+
+    def to_dict(self):
+        return {
+            'guid': self.guid,
+            'state': BREAKER_STATES.name_from_value(self.state).lower(),
+            'consecutive_failures': self.consecutive_failures,
+            'consecutive_timeouts': self.consecutive_timeouts,
+            'num_opened': self.num_opened,
+            'last_transition_time': self.last_transition_time,
+            'last_transition_reason': self.last_transition_reason
+        }
@@ -2,17 +2,21 @@
 Module provides base class for a service client
 """
 
+import heapq
+import json
+import os
 import time
 import threading
 import uuid
+import weakref
 import zmq
 
-from common.utils import zmq_socket_from_socket_type, \
-    current_timestamp
+from common.utils import current_timestamp
 
 from core.redis_service_registry import \
     RedisServiceRegistry
 from core.error import ServiceFunctionNotAvailableError
+from core.transport import TransportManager
 
 
 DEFAULT_MAX_TRIES = 3
@@ -21,14 +25,22 @@ DEFAULT_SLEEP_BEFORE_RETRY = 3 * 1000  # 3 seconds in milliseconds
 DEFAULT_HEARTBEAT_FREQUENCY = 30 * 1000  # in milliseconds
 
 
+def connect_string_from_service_config(service_config):
+    return "tcp://%s:%d" % \
+           ("*"
+            if service_config["connect_method"] == "bind"
+            else service_config["host"],
+            service_config["port"])
+
+
 def socket_from_service_config(context, service_config,
                                timeout=DEFAULT_TIME_OUT):
-    socket = zmq_socket_from_socket_type(context, service_config["socket_type"])
-    connect_string = "tcp://%s:%d" % \
-                     ("*"
-                     if service_config["connect_method"] == "bind"
-                     else service_config["host"],
-                      service_config["port"])
+    """
+    :param context: zmq context, the one of the TransportManager if None
+    """
+    connect_string = connect_string_from_service_config(service_config)
+    socket = TransportManager.instance().socket(
+        service_config["socket_type"], connect_string, context)
     getattr(socket, service_config["connect_method"])(connect_string)
     socket.setsockopt(zmq.RCVTIMEO, timeout)
     socket.setsockopt(zmq.LINGER, 0)
@@ -56,7 +68,8 @@ class ServiceClient(object):
                  max_tries=DEFAULT_MAX_TRIES,
                  heartbeat_frequency=DEFAULT_HEARTBEAT_FREQUENCY,
                  start_heartbeat_thread=True,
-                 logger=None):
+                 logger=None,
+                 context=None):
 
         self.logger = logger
         self._timeout = timeout
@@ -76,26 +89,22 @@ class ServiceClient(object):
         self.start_time = current_timestamp()
         self.shutdown_time = None
         self.guid = str(uuid.uuid4())
-        self._context = zmq.Context()
+        # a zmq.green.Context makes requests cooperative under gevent, the
+        # context shared by the process is used if None
+        self._context = context
         self._socket = socket_from_service_config(self._context,
                                                   self._service_config,
                                                   self._timeout)
         self.alive = True
         self.killed_by_error = None
+        # the instance is pinged by the HeartbeatMonitor of the process,
+        # which marks all of its clients dead when it stops answering
+        self._heartbeat_monitor = None
         if start_heartbeat_thread:
-            self._heartbeat_stop_event = threading.Event()
-            heartbeat = ClientHeartbeat(self, self._service_config,
-                                        self._timeout, self._heartbeat_frequency,
-                                        self._max_tries)
-            self._heartbeat_thread = threading.Thread(
-                target=heartbeat,
-                name='%s-client-heartbeat-%s' % (self._service_name,
-                                                 current_timestamp()),
-                args=(self._heartbeat_stop_event, )
-            )
-            self._heartbeat_thread.start()
-        else:
-            self._heartbeat_thread = None
+            monitor = HeartbeatMonitor.instance()
+            if monitor.register(self, self._service_config,
+                                self._heartbeat_frequency):
+                self._heartbeat_monitor = monitor
 
     def __repr__(self):
         return 'ServiceClient(guid=%s, service_name=%s, service_guid=%s)' % \
@@ -118,18 +127,29 @@ class ServiceClient(object):
             pass
 
     def shutdown(self):
-        if self._heartbeat_thread is None:
+        if self._heartbeat_monitor is None:
             return
+        self._heartbeat_monitor.unregister(self, self._service_config)
         if self.shutdown_time is not None:
             return
         self.alive = False
-        self._heartbeat_stop_event.set()
-        self._heartbeat_thread.join()
-        self.log('error', 'stopped heartbeat thread')
-        self._socket.close()
-        self._socket = None
+        self.log('debug', 'stopped heartbeat of %r' % self)
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
         self.shutdown_time = current_timestamp()
 
+    def close(self):
+        """
+        shuts the client down and closes its socket, also when it runs
+        without heartbeat thread
+        """
+        self.shutdown()
+        self.alive = False
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
     def _setup_socket(self, reuse=True, timeout=DEFAULT_TIME_OUT):
         if reuse and self._socket is not None:
             return
@@ -145,6 +165,24 @@ class ServiceClient(object):
     def description(self):
         return self.request('description', 'description')
 
+    def slowlog(self, reset=False):
+        return self.request('slowlog', 'reset' if reset else 'slowlog')
+
+    def profile(self, action='result', **kwargs):
+        """
+        :param action: start, stop or result
+        :param kwargs: of start, mode, duration, interval and every
+        """
+        return self.request('profile', json.dumps(dict(kwargs, action=action)))
+
+    def heapprofile(self, action='snapshot', **kwargs):
+        """
+        :param action: start, stop or snapshot
+        :param kwargs: frames of start, limit of snapshot
+        """
+        return self.request('heapprofile',
+                            json.dumps(dict(kwargs, action=action)))
+
     def stop(self):
         return self.request('stop', 'stop')
 
@@ -157,6 +195,8 @@ class ServiceClient(object):
         error = None
 
         self._setup_socket(timeout=timeout)
+        # a reused socket may have been set up with another timeout
+        self._socket.setsockopt(zmq.RCVTIMEO, timeout)
 
         while self.alive and try_num < max_tries:
 
@@ -231,73 +271,378 @@ class ServiceClient(object):
         raise ServiceClientError('%r Should never get here' % self)
 
 
-class ClientHeartbeat(object):
+class HeartbeatMonitor(object):
+    """
+    Pings the instances the clients of a process talk to, one ping per
+    instance (guid) per interval however many clients it has, from a single
+    thread polling one DEALER socket per instance. An instance that does
+    not answer 'max_failures' pings in a row within 'timeout' milliseconds
+    takes all of its clients down with it. Instances which registered a
+    control_port are pinged there.
+
+    With 'zmq_heartbeat_interval' set, and libzmq 4.2 or later, the sockets
+    also use the native ZMTP heartbeats (ZMQ_HEARTBEAT_IVL), which notice a
+    dead connection without waiting for the service to answer.
+
+    A forked child gets a monitor of its own the first time a client
+    registers with it.
+    """
 
-    def __init__(self, client, service_config,
-                 timeout=DEFAULT_TIME_OUT,
-                 heartbeat_frequency=DEFAULT_HEARTBEAT_FREQUENCY,
-                 max_tries=DEFAULT_MAX_TRIES,
-                 logger=None):
+    DEFAULT_TIMEOUT = 2 * 1000  # in milliseconds
+    DEFAULT_MAX_FAILURES = 1
+    POLL_TIMEOUT = 100  # in milliseconds
+    HEARTBEAT_SOCKET_TYPES = ('REQ', 'DEALER')
+
+    _instance = None
+    _instance_lock = threading.Lock()
+    zmq_heartbeat_interval = None
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT,
+                 max_failures=DEFAULT_MAX_FAILURES,
+                 zmq_heartbeat_interval=None, logger=None):
         self.logger = logger
-        self._client = client
-        # self._timeout = timeout
-        self._timeout = 2 * 1000
-        # self._max_tries = max_tries
-        self._max_tries = 1
-        self._heartbeat_frequency = heartbeat_frequency
-        self._service_config = service_config
-        self._context = zmq.Context()
-        self._socket = socket_from_service_config(self._context,
-                                                  self._service_config,
-                                                  self._timeout)
+        self.pid = os.getpid()
+        self._timeout = timeout
+        self._max_failures = max_failures
+        self._zmq_heartbeat_interval = zmq_heartbeat_interval
+        self._instances = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self.stats = {
+            'num_pings': 0,
+            'num_failures': 0,
+            'num_instances_dead': 0
+        }
 
     def __repr__(self):
-        pass
+        return 'HeartbeatMonitor(pid=%d, instances=%d)' % (
+            self.pid, len(self._instances))
 
-    def __call__(self, *args, **kwargs):
+    def log(self, level, message):
+        try:
+            if not hasattr(self, 'logger'):
+                return
+            logger = self.logger
+            if logger is None:
+                return
+            if not hasattr(logger, level):
+                return
+            logger_method = getattr(logger, level)
+            if not logger_method:
+                return
+            logger_method(message)
+        except:
+            pass
 
-        stop_event = args[0]
-        error = None
-        try_num = 0
-        sleep_duration = None
-        while not stop_event.is_set() and try_num < self._max_tries:
-            error = None
-            if sleep_duration:
-                time.sleep(sleep_duration/1000.0)
+    @classmethod
+    def configure(cls, zmq_heartbeat_interval=None):
+        """
+        :param zmq_heartbeat_interval: milliseconds between native ZMTP
+        heartbeats of the monitor sockets, None disables them. Applies to
+        monitors made afterwards.
+        """
+        cls.zmq_heartbeat_interval = zmq_heartbeat_interval
+
+    @classmethod
+    def instance(cls):
+        """
+        :return: the HeartbeatMonitor of the current process
+        """
+        instance = cls._instance
+        if instance is not None and instance.pid == os.getpid():
+            return instance
+        with cls._instance_lock:
+            instance = cls._instance
+            if instance is None or instance.pid != os.getpid():
+                instance = cls(
+                    zmq_heartbeat_interval=cls.zmq_heartbeat_interval)
+                cls._instance = instance
+            return instance
+
+    def register(self, client, service_config,
+                 heartbeat_frequency=DEFAULT_HEARTBEAT_FREQUENCY):
+        """
+        :param client: ServiceClient whose alive state follows the instance
+        :param service_config: config of the instance
+        :param heartbeat_frequency: milliseconds between pings, the
+        instance is pinged as often as its most demanding client asks for
+        :return: whether the client is monitored, instances of socket types
+        other than request-reply ones are not
+        """
+        if service_config['socket_type'] not in self.HEARTBEAT_SOCKET_TYPES:
+            return False
+        guid = service_config['guid']
+        with self._lock:
+            instance = self._instances.get(guid)
+            if instance is None:
+                instance = {
+                    'config': service_config,
+                    'clients': weakref.WeakSet(),
+                    'interval': heartbeat_frequency,
+                    'next_ping': current_timestamp(milliseconds=True) +
+                    heartbeat_frequency,
+                    'sent_at': None,
+                    'failures': 0,
+                    'last_pong': None
+                }
+                self._instances[guid] = instance
+            instance['clients'].add(client)
+            instance['interval'] = min(instance['interval'],
+                                       heartbeat_frequency)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='heartbeat-monitor')
+                self._thread.daemon = True
+                self._thread.start()
+        return True
+
+    def unregister(self, client, service_config):
+        guid = service_config['guid']
+        with self._lock:
+            instance = self._instances.get(guid)
+            if instance is None:
+                return
+            instance['clients'].discard(client)
+            if not len(instance['clients']):
+                del self._instances[guid]
+
+    def instances(self):
+        """
+        :return: dict of guid to number of clients, failed pings in a row
+        and time of the last answer of the monitored instances
+        """
+        with self._lock:
+            return dict((guid, {
+                'clients': len(x['clients']),
+                'failures': x['failures'],
+                'last_pong': x['last_pong']
+            }) for guid, x in self._instances.items())
+
+    def _socket(self, service_config):
+        service_config = dict(service_config, socket_type='DEALER')
+        if service_config.get('control_port'):
+            # the control socket of the instance answers heartbeats even
+            # while its data socket is busy, it is always bound
+            service_config['port'] = service_config['control_port']
+            service_config['connect_method'] = 'connect'
+        socket = socket_from_service_config(None, service_config)
+        if self._zmq_heartbeat_interval and \
+                zmq.zmq_version_info() >= (4, 2):
+            socket.setsockopt(zmq.HEARTBEAT_IVL,
+                              self._zmq_heartbeat_interval)
+            socket.setsockopt(zmq.HEARTBEAT_TIMEOUT, self._timeout)
+        return socket
+
+    def _run(self):
+        # sockets are owned by this thread, guid to socket
+        sockets = {}
+        poller = zmq.Poller()
+        try:
+            while True:
+                with self._lock:
+                    instances = dict(self._instances)
+                for guid in [x for x in sockets if x not in instances]:
+                    poller.unregister(sockets[guid])
+                    sockets.pop(guid).close()
+
+                now = current_timestamp(milliseconds=True)
+                for guid, instance in instances.items():
+                    sent_at = instance['sent_at']
+                    if sent_at is not None and now - sent_at >= self._timeout:
+                        self._ping_failed(guid, instance)
+                        # a late answer must not count for the next ping
+                        poller.unregister(sockets[guid])
+                        sockets.pop(guid).close()
+                    elif sent_at is None and now >= instance['next_ping']:
+                        if guid not in sockets:
+                            sockets[guid] = self._socket(instance['config'])
+                            poller.register(sockets[guid], zmq.POLLIN)
+                        sockets[guid].send_multipart(
+                            ['', 'heartbeat', 'heartbeat'])
+                        instance['sent_at'] = now
+                        self.stats['num_pings'] += 1
+
+                socks = dict(poller.poll(self.POLL_TIMEOUT))
+                now = current_timestamp(milliseconds=True)
+                for guid, socket in sockets.items():
+                    if socket not in socks:
+                        continue
+                    while True:
+                        try:
+                            socket.recv_multipart(zmq.NOBLOCK)
+                        except zmq.error.Again:
+                            break
+                    instance = instances[guid]
+                    instance['sent_at'] = None
+                    instance['failures'] = 0
+                    instance['last_pong'] = now
+                    instance['next_ping'] = now + instance['interval']
+
+        except zmq.error.ContextTerminated:
+            pass
+        except Exception as exception:
+            self.log('error', '%r crashed. Error: %r' % (self, exception))
+        finally:
+            for socket in sockets.values():
+                socket.close()
+            with self._lock:
+                self._thread = None
+
+    def _ping_failed(self, guid, instance):
+        self.stats['num_failures'] += 1
+        instance['sent_at'] = None
+        instance['failures'] += 1
+        instance['next_ping'] = current_timestamp(milliseconds=True) + \
+            pow(2, instance['failures'] - 1) * instance['interval']
+        if instance['failures'] < self._max_failures:
+            return
+        with self._lock:
+            if self._instances.get(guid) is instance:
+                del self._instances[guid]
+        self.stats['num_instances_dead'] += 1
+        error = ServiceClientTimeoutError(instance['config']['name'],
+                                          'heartbeat', self._timeout)
+        clients = list(instance['clients'])
+        self.log('error', 'instance: %s of %s service missed %d heartbeats, '
+                          'marking its %d clients dead' %
+                 (guid, instance['config']['name'], instance['failures'],
+                  len(clients)))
+        for client in clients:
+            client.alive = False
+            client.shutdown_time = current_timestamp()
+            client.killed_by_error = error
+
+
+class ServiceFuture(object):
+    """
+    Result of a request made through an AsyncServiceClient
+    """
+
+    def __init__(self, function_name, request_guid):
+        self.function_name = function_name
+        self.request_guid = request_guid
+        self._done_event = threading.Event()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'ServiceFuture(function=%s, request_guid=%s, done=%s)' % \
+               (self.function_name, self.request_guid, self.done())
+
+    def done(self):
+        return self._done_event.is_set()
+
+    def result(self, timeout=None):
+        """
+        Blocks until the response arrives.
+
+        :param timeout: seconds to wait, blocks indefinitely if None
+        :return: the response
+        :raises: error of the request, ServiceClientTimeoutError if nothing
+        arrived within timeout
+        """
+        if not self._done_event.wait(timeout):
+            raise ServiceClientTimeoutError(self.function_name, timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._done_event.wait(timeout):
+            raise ServiceClientTimeoutError(self.function_name, timeout)
+        return self._exception
+
+    def add_done_callback(self, fn):
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def set_result(self, result):
+        self._complete(result, None)
+
+    def set_exception(self, exception):
+        self._complete(None, exception)
+
+    def _complete(self, result, exception):
+        with self._lock:
+            if self.done():
+                return
+            self._result = result
+            self._exception = exception
+            self._done_event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
             try:
-                # print '%r sending heartbeat' % self._client
-                self._socket.send_multipart(['heartbeat', 'heartbeat'])
-                self._socket.recv()
-                sleep_duration = self._heartbeat_frequency
-            except zmq.error.Again:
-                error = ServiceClientTimeoutError()
-                self._socket.close()
-                self._socket = socket_from_service_config(self._context,
-                                                          self._service_config,
-                                                          self._timeout)
-                sleep_duration = pow(2, try_num) * self._heartbeat_frequency
-                try_num += 1
-            except zmq.error.ZMQError as exception:
-                error = ServiceClientError(exception)
-                break
-            except Exception as exception:
-                error = ServiceClientError(exception)
-                break
+                fn(self)
+            except Exception:
+                pass
 
-        self._client.alive = False
-        self._client.shutdown_time = current_timestamp()
-        if error:
-            self._client.killed_by_error = error
-            self.log('error', 'heartbeat thread of client %r dying due '
-                              'to error: %r' % (self._client, error))
-            print '[%s] heartbeat of %r thread dying due to error: %r' % (
-                time.strftime('%Y-%m-%d %H-%M-%S', time.localtime()),
-                self._client, error)
+
+class AsyncServiceClient(object):
+    """
+    Pipelined client for a service instance. Unlike ServiceClient, which
+    uses a lock-step REQ socket, requests go out on a DEALER socket and many
+    of them can be in flight at once. Each request carries its request guid
+    as routing envelope, which the service echoes back, so responses are
+    correlated to requests whatever order they arrive in.
+
+    The socket is owned by a background I/O thread, request() is safe to
+    call from any thread and returns a ServiceFuture.
+    """
+
+    IO_LOOP_POLL_TIMEOUT = 1000  # in milliseconds
+
+    def __init__(self, service_name,
+                 registry_redis_config=None,
+                 service_config=None,
+                 timeout=DEFAULT_TIME_OUT,
+                 logger=None,
+                 context=None):
+
+        self.logger = logger
+        self._timeout = timeout
+        self._service_name = service_name
+
+        if service_config:
+            self._service_config = service_config
         else:
-            self.log('debug', 'Stopping heartbeat thread of %r' % self._client)
+            self._registry = RedisServiceRegistry(**(registry_redis_config or
+                                                     {}))
+            self._service_config = self._registry.discover_service(
+                self._service_name)[0]
 
-        print '[%s] Stopping heartbeat thread of %r' % (
-            time.strftime('%Y-%m-%d %H-%M-%S', time.localtime()), self._client)
+        self.start_time = current_timestamp()
+        self.shutdown_time = None
+        self.guid = str(uuid.uuid4())
+        self._transport = TransportManager.instance()
+        self._context = context or self._transport.context
+        self._pending = {}
+        self._deadlines = []
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+        self._queue_endpoint = 'inproc://async-client-%s' % self.guid
+        self._queue_socket = self._transport.socket(
+            zmq.PUSH, self._queue_endpoint, self._context)
+        self._queue_socket.setsockopt(zmq.LINGER, 0)
+        self._queue_socket.bind(self._queue_endpoint)
+        self._io_thread = threading.Thread(
+            target=self._run_io_loop,
+            name='%s-async-client-%s' % (self._service_name, self.guid)
+        )
+        self._io_thread.daemon = True
+        self._io_thread.start()
+        self.alive = True
+
+    def __repr__(self):
+        return 'AsyncServiceClient(guid=%s, service_name=%s, ' \
+               'service_guid=%s, in_flight=%d)' % \
+               (self.guid, self._service_name, self._service_config['guid'],
+                len(self._pending))
 
     def log(self, level, message):
         try:
@@ -314,3 +659,185 @@ class ClientHeartbeat(object):
             logger_method(message)
         except:
             pass
+
+    @property
+    def in_flight(self):
+        return len(self._pending)
+
+    def ping(self):
+        return self.request('heartbeat', 'ping')
+
+    def healthcheck(self):
+        return self.request('healthcheck', 'health')
+
+    def description(self):
+        return self.request('description', 'description')
+
+    def slowlog(self, reset=False):
+        return self.request('slowlog', 'reset' if reset else 'slowlog')
+
+    def profile(self, action='result', **kwargs):
+        """
+        :param action: start, stop or result
+        :param kwargs: of start, mode, duration, interval and every
+        """
+        return self.request('profile', json.dumps(dict(kwargs, action=action)))
+
+    def heapprofile(self, action='snapshot', **kwargs):
+        """
+        :param action: start, stop or snapshot
+        :param kwargs: frames of start, limit of snapshot
+        """
+        return self.request('heapprofile',
+                            json.dumps(dict(kwargs, action=action)))
+
+    def request(self, function_name, request, response_class=None,
+                timeout=None):
+        """
+        Sends a request without waiting for its response
+
+        :param function_name:
+        :param request: protobuf message or string
+        :param response_class: protobuf class to parse the response with
+        :param timeout: milliseconds, defaults to the client's timeout
+        :return: ServiceFuture
+        """
+
+        if function_name not in self._service_config['functions']:
+            raise ServiceFunctionNotAvailableError(
+                '%r: function: %s not available for service: %s' % (
+                    self, function_name, self._service_name
+                ))
+        if not self.alive:
+            raise ServiceClientError('%r is no longer alive' % self)
+
+        if hasattr(request, 'SerializeToString'):
+            if not request.header.request_guid:
+                request.header.request_guid = str(uuid.uuid4())
+            request_guid = str(request.header.request_guid)
+            request_message = request.SerializeToString()
+        else:
+            request_guid = str(uuid.uuid4())
+            request_message = str(request)
+
+        timeout = self._timeout if timeout is None else timeout
+        future = ServiceFuture(function_name, request_guid)
+        deadline = current_timestamp(milliseconds=True) + timeout
+        # a request message may be sent more than once with the same
+        # request_guid, every call is routed by an id of its own
+        call_id = str(uuid.uuid4())
+        with self._lock:
+            self._pending[call_id] = (future, response_class, timeout)
+            self._queue_socket.send_multipart(
+                [call_id, str(deadline), str(function_name),
+                 request_message])
+        return future
+
+    def _run_io_loop(self):
+        queue = self._transport.socket(zmq.PULL, self._queue_endpoint,
+                                       self._context)
+        queue.connect(self._queue_endpoint)
+        connect_string = connect_string_from_service_config(
+            self._service_config)
+        socket = self._transport.socket(zmq.DEALER, connect_string,
+                                        self._context)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(connect_string)
+        poller = zmq.Poller()
+        poller.register(queue, zmq.POLLIN)
+        poller.register(socket, zmq.POLLIN)
+
+        try:
+            while not self._stop_event.is_set():
+                socks = dict(poller.poll(self._next_poll_timeout()))
+
+                if queue in socks:
+                    while True:
+                        try:
+                            call_id, deadline, function_name, message = \
+                                queue.recv_multipart(zmq.NOBLOCK)
+                        except zmq.error.Again:
+                            break
+                        heapq.heappush(self._deadlines,
+                                       (int(deadline), call_id))
+                        socket.send_multipart(
+                            [call_id, '', function_name, message])
+
+                if socket in socks:
+                    while True:
+                        try:
+                            frames = socket.recv_multipart(zmq.NOBLOCK)
+                        except zmq.error.Again:
+                            break
+                        self._complete_request(frames[0], frames[-1])
+
+                self._expire_requests()
+
+        except zmq.error.ContextTerminated:
+            # the process is shutting down, the sockets are closed below
+            self._fail_pending(ServiceClientError('%r shut down' % self))
+        except Exception as exception:
+            self.log('error', 'I/O thread of %r crashed. Error: %r' %
+                     (self, exception))
+            self._fail_pending(ServiceClientError(exception))
+        finally:
+            self.alive = False
+            queue.close()
+            socket.close()
+
+    def _next_poll_timeout(self):
+        if not self._deadlines:
+            return self.IO_LOOP_POLL_TIMEOUT
+        return max(0, min(self.IO_LOOP_POLL_TIMEOUT,
+                          self._deadlines[0][0] -
+                          current_timestamp(milliseconds=True)))
+
+    def _complete_request(self, call_id, response_string):
+        with self._lock:
+            pending = self._pending.pop(call_id, None)
+        if pending is None:
+            # timed out already, late responses are dropped
+            return
+        future, response_class, timeout = pending
+        if response_class is None:
+            future.set_result(response_string)
+            return
+        try:
+            response = response_class()
+            response.ParseFromString(response_string)
+            future.set_result(response)
+        except Exception as exception:
+            future.set_exception(ServiceClientError(exception))
+
+    def _expire_requests(self):
+        now = current_timestamp(milliseconds=True)
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, call_id = heapq.heappop(self._deadlines)
+            with self._lock:
+                pending = self._pending.pop(call_id, None)
+            if pending is None:
+                continue
+            future, response_class, timeout = pending
+            self.log('debug', '%r can not complete function: %s of '
+                              'service: %s in %s milliseconds' %
+                     (self, future.function_name, self._service_name,
+                      timeout))
+            future.set_exception(ServiceClientTimeoutError(
+                self._service_name, future.function_name, timeout))
+
+    def _fail_pending(self, error):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for future, response_class, timeout in pending.values():
+            future.set_exception(error)
+
+    def shutdown(self):
+        if self.shutdown_time is not None:
+            return
+        self.alive = False
+        self._stop_event.set()
+        self._io_thread.join()
+        self._fail_pending(ServiceClientError('%r shut down' % self))
+        with self._lock:
+            self._queue_socket.close()
+        self.shutdown_time = current_timestamp()
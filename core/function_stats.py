@@ -0,0 +1,387 @@
+"""
+Module provides per-function request statistics of a service: latency
+histograms, phase timings, CPU time, request and error counts and message
+sizes over a recent window of time
+"""
+
+import heapq
+import threading
+
+from common.utils import current_timestamp, monotonic_time, \
+    thread_cpu_time
+
+
+class PhaseTimer(object):
+    """
+    Times the phases of one request (recv, queue, parse, validate, handle,
+    serialize, send) with the monotonic clock, and the CPU time the handler
+    used with the CPU clock of its thread. Under the gevent IO loop the
+    thread is shared, so CPU time of other greenlets may count too.
+
+    Handlers find the timer of the request they run for with current(),
+    between start() and stop() of the service.
+    """
+
+    _local = threading.local()
+
+    def __init__(self, start_time=None):
+        """
+        :param start_time: monotonic time in microseconds the request
+        arrived at, now if None
+        """
+        self._last = monotonic_time() if start_time is None else start_time
+        self.start_time = self._last
+        self.phases = []
+        self.cpu_time = None
+        self._cpu_start = None
+        # set by handlers of protobuf messages
+        self.request_guid = None
+        self.client = None
+        # whether the timings go into the header of the response
+        self.sampled = False
+
+    def __repr__(self):
+        return 'PhaseTimer(%s)' % ', '.join('%s=%d' % x for x in self.phases)
+
+    def mark(self, phase):
+        """
+        Ends a phase, which started when the previous one ended
+        """
+        now = monotonic_time()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    def duration(self, *phases):
+        """
+        :return: microseconds spent in the phases
+        """
+        return sum(x for name, x in self.phases if name in phases)
+
+    def start(self):
+        """
+        Makes the timer the one of the calling thread, and starts measuring
+        its CPU time
+        """
+        PhaseTimer._local.timer = self
+        self._cpu_start = thread_cpu_time()
+
+    def cpu_time_so_far(self):
+        """
+        :return: CPU microseconds since start(), None if not measured
+        """
+        if self._cpu_start is None:
+            return None
+        return thread_cpu_time() - self._cpu_start
+
+    def stop(self):
+        self.cpu_time = self.cpu_time_so_far()
+        PhaseTimer._local.timer = None
+
+    @classmethod
+    def current(cls):
+        """
+        :return: timer of the request the calling thread handles, None if
+        there is none
+        """
+        return getattr(cls._local, 'timer', None)
+
+
+class LatencyHistogram(object):
+    """
+    Log-bucketed histogram of fixed memory, in the way of HdrHistogram.
+    Every power of two range of values is split in SUB_BUCKETS linear
+    buckets, so percentiles are accurate to within 1 / SUB_BUCKETS of the
+    value, whatever its magnitude. Values up to MAX_VALUE are recorded,
+    larger ones count as MAX_VALUE.
+    """
+
+    SUB_BUCKET_BITS = 3
+    SUB_BUCKETS = 1 << SUB_BUCKET_BITS  # per power of two
+    MAX_VALUE = (1 << 40) - 1  # in microseconds, about 12 days
+    PERCENTILES = ((50, 'p50'), (90, 'p90'), (99, 'p99'), (99.9, 'p999'))
+
+    def __init__(self):
+        self._counts = [0] * (self._index(self.MAX_VALUE) + 1)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def __repr__(self):
+        return 'LatencyHistogram(count=%d, p50=%s, p99=%s)' % (
+            self.count, self.percentile(50), self.percentile(99))
+
+    @classmethod
+    def _index(cls, value):
+        if value < 2 * cls.SUB_BUCKETS:
+            return value
+        shift = value.bit_length() - cls.SUB_BUCKET_BITS - 1
+        return cls.SUB_BUCKETS * shift + (value >> shift)
+
+    @classmethod
+    def _value(cls, index):
+        """
+        :return: middle of the range of values of a bucket
+        """
+        if index < 2 * cls.SUB_BUCKETS:
+            return index
+        shift = index // cls.SUB_BUCKETS - 1
+        lowest = (index - cls.SUB_BUCKETS * shift) << shift
+        return lowest + ((1 << shift) >> 1)
+
+    def record(self, value):
+        value = min(max(0, int(value)), self.MAX_VALUE)
+        self._counts[self._index(value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for index, count in enumerate(other._counts):
+            if count:
+                self._counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None:
+            self.min = other.min if self.min is None \
+                else min(self.min, other.min)
+        if other.max is not None:
+            self.max = other.max if self.max is None \
+                else max(self.max, other.max)
+
+    def percentile(self, percentile):
+        """
+        :param percentile: between 0 and 100
+        :return: value at the percentile, None if nothing was recorded
+        """
+        if not self.count:
+            return None
+        rank = max(1, int(round(self.count * percentile / 100.0)))
+        seen = 0
+        for index, count in enumerate(self._counts):
+            seen += count
+            if seen >= rank:
+                return min(max(self._value(index), self.min), self.max)
+        return self.max
+
+    def to_dict(self):
+        d = {
+            'count': self.count,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.total / self.count if self.count else None
+        }
+        for percentile, name in self.PERCENTILES:
+            d[name] = self.percentile(percentile)
+        return d
+
+
+class FunctionStats(object):
+    """
+    Statistics of the requests of every function of a service. They cover
+    the current window of 'window' milliseconds and the one before it, so
+    they describe recent traffic rather than the lifetime of the process.
+    """
+
+    DEFAULT_WINDOW = 60 * 1000  # in milliseconds
+
+    def __init__(self, window=DEFAULT_WINDOW):
+        self.window = window
+        self._current = {}
+        self._previous = {}
+        self._window_start = current_timestamp(milliseconds=True)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def _new_entry(cls):
+        return {
+            'latency': LatencyHistogram(),
+            'num_requests': 0,
+            'num_errors': 0,
+            'request_bytes': 0,
+            'response_bytes': 0,
+            'phases': {},
+            'cpu_time': 0,
+            'num_cpu_times': 0
+        }
+
+    def _rotate(self):
+        now = current_timestamp(milliseconds=True)
+        elapsed = now - self._window_start
+        if elapsed < self.window:
+            return
+        # a window without traffic in between leaves nothing to keep
+        self._previous = self._current if elapsed < 2 * self.window else {}
+        self._current = {}
+        self._window_start = now
+
+    def record(self, function, response_time, success, request_size=0,
+               response_size=0, phases=None, cpu_time=None):
+        """
+        :param response_time: in microseconds
+        :param request_size, response_size: in bytes
+        :param phases: list of (phase, microseconds) of the request
+        :param cpu_time: CPU microseconds of the request
+        """
+        with self._lock:
+            self._rotate()
+            entry = self._current.get(function)
+            if entry is None:
+                entry = self._current[function] = self._new_entry()
+            entry['latency'].record(response_time)
+            entry['num_requests'] += 1
+            if not success:
+                entry['num_errors'] += 1
+            entry['request_bytes'] += request_size
+            entry['response_bytes'] += response_size
+            for phase, duration in phases or ():
+                entry['phases'][phase] = \
+                    entry['phases'].get(phase, 0) + duration
+            if cpu_time is not None:
+                entry['cpu_time'] += cpu_time
+                entry['num_cpu_times'] += 1
+
+    def reset(self):
+        with self._lock:
+            self._current = {}
+            self._previous = {}
+            self._window_start = current_timestamp(milliseconds=True)
+
+    def to_dict(self):
+        """
+        :return: dict of function to its latency percentiles, average
+        microseconds per phase and of CPU time, request and error counts and
+        average request and response sizes in bytes
+        """
+        with self._lock:
+            self._rotate()
+            entries = {}
+            for stats in (self._previous, self._current):
+                for function, entry in stats.items():
+                    merged = entries.get(function)
+                    if merged is None:
+                        merged = entries[function] = self._new_entry()
+                    merged['latency'].merge(entry['latency'])
+                    for k in ('num_requests', 'num_errors', 'request_bytes',
+                              'response_bytes', 'cpu_time', 'num_cpu_times'):
+                        merged[k] += entry[k]
+                    for phase, duration in entry['phases'].items():
+                        merged['phases'][phase] = \
+                            merged['phases'].get(phase, 0) + duration
+            since = self._window_start - (self.window if self._previous
+                                          else 0)
+
+        result = {}
+        for function, entry in entries.items():
+            num_requests = entry['num_requests']
+            result[function] = {
+                'latency': entry['latency'].to_dict(),
+                'num_requests': num_requests,
+                'num_errors': entry['num_errors'],
+                'avg_request_bytes':
+                    entry['request_bytes'] // num_requests,
+                'avg_response_bytes':
+                    entry['response_bytes'] // num_requests,
+                'avg_phases': dict(
+                    (phase, duration // num_requests)
+                    for phase, duration in entry['phases'].items()),
+                'avg_cpu_time':
+                    entry['cpu_time'] // entry['num_cpu_times']
+                    if entry['num_cpu_times'] else None,
+                'since': since
+            }
+        return result
+
+
+class SlowLog(object):
+    """
+    The 'size' slowest requests of the current window of 'window'
+    milliseconds, kept in a min-heap, so a request faster than all of them
+    costs a single comparison.
+    """
+
+    DEFAULT_SIZE = 32
+
+    def __init__(self, size=DEFAULT_SIZE, window=FunctionStats.DEFAULT_WINDOW):
+        self.size = size
+        self.window = window
+        self._heap = []
+        self._sequence = 0
+        self._window_start = current_timestamp(milliseconds=True)
+        self._lock = threading.Lock()
+
+    def _rotate(self):
+        now = current_timestamp(milliseconds=True)
+        if now - self._window_start >= self.window:
+            self._heap = []
+            self._window_start = now
+
+    def record(self, function, response_time, request_guid=None, client=None,
+               request_size=0, response_size=0, phases=None, cpu_time=None):
+        """
+        :param response_time: in microseconds
+        :param phases: list of (phase, microseconds) of the request
+        """
+        heap = self._heap
+        if len(heap) >= self.size and response_time <= heap[0][0]:
+            if current_timestamp(milliseconds=True) - self._window_start < \
+                    self.window:
+                return
+        with self._lock:
+            self._rotate()
+            if len(self._heap) >= self.size and \
+                    response_time <= self._heap[0][0]:
+                return
+            self._sequence += 1
+            # a phase may be marked more than once, e.g. log
+            totals = {}
+            for phase, duration in phases or ():
+                totals[phase] = totals.get(phase, 0) + duration
+            entry = {
+                'function': function,
+                'response_time': response_time,
+                'request_guid': request_guid,
+                'client': client,
+                'request_bytes': request_size,
+                'response_bytes': response_size,
+                'phases': totals,
+                'cpu_time': cpu_time,
+                'time': current_timestamp(milliseconds=True)
+            }
+            item = (response_time, self._sequence, entry)
+            if len(self._heap) >= self.size:
+                heapq.heapreplace(self._heap, item)
+            else:
+                heapq.heappush(self._heap, item)
+
+    def entries(self):
+        """
+        :return: list of the slowest requests, the slowest first
+        """
+        return self.to_dict()['entries']
+
+    def reset(self):
+        """
+        :return: list of the slowest requests before the reset
+        """
+        return self.to_dict(reset=True)['entries']
+
+    def to_dict(self, reset=False):
+        """
+        :param reset: clear the slow log after reading it
+        """
+        with self._lock:
+            self._rotate()
+            d = {
+                'size': self.size,
+                'window': self.window,
+                'since': self._window_start,
+                'entries': [x[2] for x in sorted(self._heap, reverse=True)]
+            }
+            if reset:
+                self._heap = []
+                self._window_start = current_timestamp(milliseconds=True)
+            return d
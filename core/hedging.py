@@ -0,0 +1,171 @@
+"""
+Module provides hedged requests: if a request has not completed after a
+delay, a duplicate is sent to another instance and the first response wins
+"""
+
+import collections
+import Queue
+import threading
+
+from core.budget import TokenBudget
+
+
+DEFAULT_HEDGE_DELAY = 50 * 1000  # in microseconds
+DEFAULT_HEDGE_PERCENTILE = 95
+DEFAULT_HEDGE_BUDGET_RATIO = 0.05
+
+
+class LatencyTracker(object):
+    """
+    Keeps the latest latencies of a function and a percentile over them,
+    which is recomputed every 'refresh_every' samples
+    """
+
+    WINDOW_SIZE = 1000
+    MIN_SAMPLES = 20
+
+    def __init__(self, percentile=DEFAULT_HEDGE_PERCENTILE,
+                 refresh_every=50):
+        self.percentile = percentile
+        self._refresh_every = refresh_every
+        self._latencies = collections.deque(maxlen=self.WINDOW_SIZE)
+        self._since_refresh = 0
+        self._value = None
+        self._lock = threading.Lock()
+
+    def add(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+            self._since_refresh += 1
+            if self._since_refresh < self._refresh_every and \
+                    self._value is not None:
+                return
+            if len(self._latencies) < self.MIN_SAMPLES:
+                return
+            latencies = sorted(self._latencies)
+            self._value = latencies[min(len(latencies) - 1,
+                                        len(latencies) * self.percentile //
+                                        100)]
+            self._since_refresh = 0
+
+    def value(self):
+        """
+        :return: the percentile, None until enough samples were seen
+        """
+        return self._value
+
+
+class Hedger(object):
+    """
+    Runs hedged calls within a budget and counts hedges fired and won
+    """
+
+    def __init__(self, budget_ratio=DEFAULT_HEDGE_BUDGET_RATIO,
+                 percentile=DEFAULT_HEDGE_PERCENTILE,
+                 default_delay=DEFAULT_HEDGE_DELAY):
+        self.budget = TokenBudget(budget_ratio)
+        self.percentile = percentile
+        self.default_delay = default_delay
+        self._trackers = {}
+        self._lock = threading.Lock()
+        self.stats = {
+            'num_requests': 0,
+            'hedges_fired': 0,
+            'hedges_won': 0,
+            'hedges_over_budget': 0
+        }
+
+    def _tracker(self, key):
+        with self._lock:
+            if key not in self._trackers:
+                self._trackers[key] = LatencyTracker(self.percentile)
+            return self._trackers[key]
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def record_latency(self, key, latency):
+        self._tracker(key).add(latency)
+
+    def delay(self, key):
+        """
+        :return: microseconds to wait before hedging calls of key, the
+        observed percentile if known
+        """
+        value = self._tracker(key).value()
+        return self.default_delay if value is None else value
+
+    def __call__(self, key, primary, hedge, delay=None):
+        """
+        Starts primary() in a thread. If it has not completed after delay
+        (microseconds, defaults to the percentile latency of key) and the
+        budget allows, hedge() is started as well. The first successful
+        result is returned, the other one is discarded. A response whose
+        header says it did not succeed is not a success. If both fail, the
+        outcome of the primary is returned or raised.
+
+        :param key: identifies the function for latency tracking
+        :param primary: callable making the request
+        :param hedge: callable making the duplicate request, may raise
+        """
+        self.budget.deposit()
+        self._count('num_requests')
+        if delay is None:
+            delay = self.delay(key)
+
+        results = Queue.Queue()
+
+        def _run(name, fn):
+            try:
+                results.put((name, True, fn()))
+            except Exception as exception:
+                results.put((name, False, exception))
+
+        self._start(_run, 'primary', primary)
+        try:
+            first = results.get(timeout=delay / 1000000.0)
+            running = 0
+        except Queue.Empty:
+            first = None
+            running = 1
+
+        if first is None:
+            if self.budget.withdraw():
+                self._count('hedges_fired')
+                self._start(_run, 'hedge', hedge)
+                running += 1
+            else:
+                self._count('hedges_over_budget')
+            first = results.get()
+            running -= 1
+
+        failures = {}
+        while True:
+            name, returned, value = first
+            if returned and self._succeeded(value):
+                if name == 'hedge':
+                    self._count('hedges_won')
+                return value
+            failures[name] = (returned, value)
+            if not running:
+                returned, value = failures.get('primary', (returned, value))
+                if returned:
+                    return value
+                raise value
+            first = results.get()
+            running -= 1
+
+    @classmethod
+    def _start(cls, target, name, fn):
+        # a call left running does not keep the process from exiting
+        thread = threading.Thread(target=target, args=(name, fn),
+                                  name='hedged-%s' % name)
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def _succeeded(cls, response):
+        if hasattr(response, 'header'):
+            return response.header.success
+        return True
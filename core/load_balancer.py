@@ -0,0 +1,212 @@
+"""
+Module provides load balancing policies, which pick the instance of a
+service a request is sent to, and the per instance stats they decide on
+"""
+
+import random
+import threading
+
+from common.utils import current_timestamp
+
+
+MIN_SPARE_CAPACITY = 0.05
+
+
+class UnknownBalancingPolicyError(RuntimeError):
+    pass
+
+
+def spare_capacity(load):
+    """
+    :param load: load an instance published, as returned by Service.load,
+    or None if it published none
+    :return: share of the capacity of the instance that is unused, between
+    MIN_SPARE_CAPACITY and 1. Queued requests and CPU both use it up.
+    Instances without published load count as idle.
+    """
+    if not load:
+        return 1.0
+    concurrency = max(1, load.get('concurrency') or 1)
+    utilization = max(
+        float(load.get('in_flight', 0) + load.get('queue_depth', 0)) /
+        concurrency,
+        load.get('cpu', 0) / 100.0)
+    return max(MIN_SPARE_CAPACITY, 1.0 - utilization)
+
+
+def weighted_sample(items, weights, num):
+    """
+    Samples num distinct items, each with a chance in proportion to its
+    weight (Efraimidis-Spirakis)
+
+    :param items: list of items
+    :param weights: list of positive weights of the items
+    :param num:
+    :return: list of at most num items
+    """
+    keyed = [(random.random() ** (1.0 / w), i)
+             for i, w in enumerate(weights)]
+    keyed.sort(reverse=True)
+    return [items[i] for _, i in keyed[:num]]
+
+
+class InstanceStats(object):
+    """
+    Counters and latency of requests sent to one instance (guid) of a
+    service. Latencies are in microseconds, averaged as an EWMA.
+    """
+
+    EWMA_WEIGHT = 0.3
+
+    def __init__(self, guid):
+        self.guid = guid
+        self.outstanding = 0
+        self.num_requests = 0
+        self.num_success = 0
+        self.num_error = 0
+        self.ewma_latency = None
+        self.ewma_server_latency = None
+        self.last_latency = None
+        self.last_request_time = None
+        # load the instance published to the registry
+        self.load = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'InstanceStats(guid=%s, outstanding=%d, num_requests=%d, ' \
+               'ewma_latency=%s)' % (self.guid, self.outstanding,
+                                     self.num_requests, self.ewma_latency)
+
+    def _ewma(self, average, value):
+        if average is None:
+            return float(value)
+        return self.EWMA_WEIGHT * value + (1 - self.EWMA_WEIGHT) * average
+
+    def start(self):
+        with self._lock:
+            self.outstanding += 1
+            self.num_requests += 1
+            self.last_request_time = current_timestamp()
+
+    def finish(self, latency, success, server_latency=None):
+        """
+        :param latency: client side wall time of the request
+        :param success: whether the request succeeded
+        :param server_latency: response_time reported by the service
+        """
+        with self._lock:
+            self.outstanding -= 1
+            if success:
+                self.num_success += 1
+            else:
+                self.num_error += 1
+            self.last_latency = latency
+            self.ewma_latency = self._ewma(self.ewma_latency, latency)
+            if server_latency is not None:
+                self.ewma_server_latency = self._ewma(
+                    self.ewma_server_latency, server_latency)
+
+    def to_dict(self):
+        return {
+            'guid': self.guid,
+            'outstanding': self.outstanding,
+            'num_requests': self.num_requests,
+            'num_success': self.num_success,
+            'num_error': self.num_error,
+            'ewma_latency': self.ewma_latency,
+            'ewma_server_latency': self.ewma_server_latency,
+            'last_latency': self.last_latency,
+            'last_request_time': self.last_request_time,
+            'load': self.load
+        }
+
+
+class LoadBalancingPolicy(object):
+    """
+    abstract base class of load balancing policies
+    """
+
+    NAME = None
+
+    def select(self, candidates):
+        """
+        :param candidates: non empty list of InstanceStats
+        :return: the InstanceStats of the chosen instance
+        """
+        raise NotImplementedError()
+
+
+class RoundRobinPolicy(LoadBalancingPolicy):
+
+    NAME = 'round_robin'
+
+    def __init__(self):
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def select(self, candidates):
+        with self._lock:
+            self._next += 1
+            return candidates[self._next % len(candidates)]
+
+
+class LeastOutstandingPolicy(LoadBalancingPolicy):
+
+    NAME = 'least_outstanding'
+
+    def select(self, candidates):
+        fewest = min(x.outstanding for x in candidates)
+        return random.choice([x for x in candidates
+                              if x.outstanding == fewest])
+
+
+class PowerOfTwoChoicesPolicy(LoadBalancingPolicy):
+    """
+    Picks two instances at random and takes the one with the lower expected
+    latency, i.e. EWMA latency scaled by the requests queued on it.
+    Instances without observed latency are preferred, so they get probed.
+    """
+
+    NAME = 'p2c'
+
+    def _cost(self, stats):
+        if stats.ewma_latency is None:
+            return 0
+        return stats.ewma_latency * (stats.outstanding + 1)
+
+    def select(self, candidates):
+        if len(candidates) == 1:
+            return candidates[0]
+        first, second = random.sample(candidates, 2)
+        return first if self._cost(first) <= self._cost(second) else second
+
+
+class LoadAwarePolicy(PowerOfTwoChoicesPolicy):
+    """
+    Power of two choices on the load the instances publish to the registry:
+    the requests this client queued on an instance, scaled by how little
+    spare capacity the instance reported. Pools of this policy are also
+    filled by weighted discovery, so new clients favor idle instances.
+    """
+
+    NAME = 'load_aware'
+
+    def _cost(self, stats):
+        return (stats.outstanding + 1) / spare_capacity(stats.load)
+
+
+BALANCING_POLICIES = {
+    RoundRobinPolicy.NAME: RoundRobinPolicy,
+    LeastOutstandingPolicy.NAME: LeastOutstandingPolicy,
+    PowerOfTwoChoicesPolicy.NAME: PowerOfTwoChoicesPolicy,
+    LoadAwarePolicy.NAME: LoadAwarePolicy
+}
+
+
+def balancing_policy_from_name(name):
+    try:
+        return BALANCING_POLICIES[name]()
+    except KeyError:
+        raise UnknownBalancingPolicyError(
+            'balancing policy: %s not in set [%s] of valid policies' %
+            (name, ', '.join(BALANCING_POLICIES.keys())))
@@ -0,0 +1,416 @@
+"""
+Module provides the on-demand profilers of a service: a statistical stack
+sampler, whose result is collapsed stacks for flame graphs, or cProfile of
+1 in N requests, whose result is pstats, and a heap profiler of the top
+allocation sites and live objects
+"""
+
+import base64
+import collections
+import cProfile
+import gc
+import marshal
+import os
+import pstats
+import StringIO
+import sys
+import threading
+import zmq
+
+from google.protobuf.message import Message
+
+from common.utils import current_timestamp
+from core.client import AsyncServiceClient, ServiceClient
+from core.resourcepool import ResourcePool
+from core.transport import TransportManager
+
+try:
+    # part of python 3, pytracemalloc on a patched python 2
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+class ProfilerError(RuntimeError):
+    pass
+
+
+class StackSampler(object):
+    """
+    Samples the stacks of all threads of the process every 'interval'
+    milliseconds from a thread of its own, and counts identical stacks.
+    Only threads are seen, greenlets not running at the time of a sample
+    are not.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.num_samples = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name='profiler-stack-sampler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    @classmethod
+    def _frame_name(cls, code):
+        return '%s:%s:%d' % (os.path.basename(code.co_filename), code.co_name,
+                             code.co_firstlineno)
+
+    def _run(self):
+        own_ident = threading.current_thread().ident
+        while not self._stop_event.wait(self.interval / 1000.0):
+            names = dict((x.ident, x.name) for x in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self._frame_name(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.num_samples += 1
+
+    def collapsed(self):
+        """
+        :return: one line of 'frame;frame;... count' per distinct stack, the
+        input of flamegraph.pl and speedscope
+        """
+        return '\n'.join('%s %d' % x for x in sorted(self.stacks.items()))
+
+
+class RequestProfiler(object):
+    """
+    Runs 1 in 'every' requests under cProfile and adds their stats up
+    """
+
+    _local = threading.local()
+
+    def __init__(self, every):
+        self.every = every
+        self.num_requests = 0
+        self.num_profiled = 0
+        self.stats = None
+        self._lock = threading.Lock()
+
+    def call(self, function, *args):
+        with self._lock:
+            self.num_requests += 1
+            num_requests = self.num_requests
+        # a thread runs one profiler at a time, e.g. not for two
+        # greenlets at once
+        if num_requests % self.every or \
+                getattr(RequestProfiler._local, 'active', False):
+            return function(*args)
+        profile = cProfile.Profile()
+        RequestProfiler._local.active = True
+        try:
+            return profile.runcall(function, *args)
+        finally:
+            RequestProfiler._local.active = False
+            with self._lock:
+                self.num_profiled += 1
+                if self.stats is None:
+                    self.stats = pstats.Stats(profile)
+                else:
+                    self.stats.add(profile)
+
+    def pstats(self, sort='cumulative', limit=50):
+        """
+        :return: tuple of (pstats report as text, base64 of the marshalled
+        stats, which pstats.Stats loads once written to a file)
+        """
+        with self._lock:
+            if self.stats is None:
+                return '', ''
+            output = StringIO.StringIO()
+            self.stats.stream = output
+            self.stats.sort_stats(sort).print_stats(limit)
+            return output.getvalue(), \
+                base64.b64encode(marshal.dumps(self.stats.stats))
+
+
+class Profiler(object):
+    """
+    One profiling session at a time, for 'duration' seconds or until
+    stopped. While no session runs, the request path only checks that
+    request_profiler is None.
+    """
+
+    MODES = ('sample', 'cprofile')
+    DEFAULT_MODE = 'sample'
+    DEFAULT_DURATION = 30  # in seconds
+    MAX_DURATION = 600  # in seconds
+    DEFAULT_INTERVAL = 10  # in milliseconds, between stack samples
+    MIN_INTERVAL = 1  # in milliseconds
+    DEFAULT_EVERY = 10  # requests per request profiled
+
+    def __init__(self, logger=None):
+        self.logger = logger
+        # set while a cprofile session runs
+        self.request_profiler = None
+        self._sampler = None
+        self._session = None
+        self._result = None
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def log(self, level, message):
+        try:
+            if not hasattr(self, 'logger'):
+                return
+            logger = self.logger
+            if logger is None:
+                return
+            if not hasattr(logger, level):
+                return
+            logger_method = getattr(logger, level)
+            if not logger_method:
+                return
+            logger_method(message)
+        except:
+            pass
+
+    def running(self):
+        return self._session is not None
+
+    def start(self, mode=DEFAULT_MODE, duration=DEFAULT_DURATION,
+              interval=DEFAULT_INTERVAL, every=DEFAULT_EVERY):
+        """
+        :param mode: sample or cprofile
+        :param duration: seconds, at most MAX_DURATION
+        :param interval: milliseconds between stack samples
+        :param every: with cprofile, one of every 'every' requests is
+        profiled
+        :return: dict describing the session
+        """
+        if mode not in self.MODES:
+            raise ProfilerError('profiling mode %s not in set [%s]' %
+                                (mode, ', '.join(self.MODES)))
+        duration = min(max(0, float(duration)), self.MAX_DURATION)
+        with self._lock:
+            if self._session is not None:
+                raise ProfilerError('a %s profiling session is running' %
+                                    self._session['mode'])
+            self._session = {
+                'mode': mode,
+                'duration': duration,
+                'start_time': current_timestamp(milliseconds=True)
+            }
+            if mode == 'sample':
+                self._session['interval'] = max(self.MIN_INTERVAL,
+                                                int(interval))
+                self._sampler = StackSampler(self._session['interval'])
+                self._sampler.start()
+            else:
+                self._session['every'] = max(1, int(every))
+                self.request_profiler = RequestProfiler(
+                    self._session['every'])
+            self._timer = threading.Timer(duration, self.stop)
+            self._timer.daemon = True
+            self._timer.start()
+        self.log('info', 'started %s profiling for %s seconds' %
+                 (mode, duration))
+        return dict(self._session)
+
+    def stop(self):
+        """
+        Ends the running session, its result is kept until the next one
+        ends
+
+        :return: whether a session was running
+        """
+        with self._lock:
+            session = self._session
+            if session is None:
+                return False
+            self._session = None
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            result = dict(session)
+            result['end_time'] = current_timestamp(milliseconds=True)
+            if self._sampler is not None:
+                self._sampler.stop()
+                result['num_samples'] = self._sampler.num_samples
+                result['collapsed'] = self._sampler.collapsed()
+                self._sampler = None
+            else:
+                profiler, self.request_profiler = self.request_profiler, None
+                result['num_requests'] = profiler.num_requests
+                result['num_profiled'] = profiler.num_profiled
+                result['pstats'], result['pstats_dump'] = profiler.pstats()
+            self._result = result
+        self.log('info', 'stopped %s profiling' % session['mode'])
+        return True
+
+    def result(self):
+        """
+        :return: dict of the result of the last session, or of the state of
+        the running one
+        """
+        session = self._session
+        if session is not None:
+            elapsed = (current_timestamp(milliseconds=True) -
+                       session['start_time']) / 1000.0
+            return dict(session, running=True,
+                        remaining=max(0, session['duration'] - elapsed))
+        if self._result is None:
+            return {'running': False}
+        return dict(self._result, running=False)
+
+
+class HeapProfiler(object):
+    """
+    Snapshots of the heap, each returned with its top entries and its diff
+    to the previous one. With tracemalloc the entries are allocation sites
+    by file and line, which are traced from start() to stop(). Without it
+    they are counts of the objects the garbage collector tracks, by type.
+
+    Counts of live protobuf messages, clients, resource pools and sockets
+    come with every snapshot.
+    """
+
+    DEFAULT_LIMIT = 20
+    DEFAULT_FRAMES = 1  # of the traceback of an allocation
+    # classes whose live instances are counted
+    LIVE_OBJECTS = (
+        ('protobuf_messages', Message),
+        ('service_clients', ServiceClient),
+        ('async_service_clients', AsyncServiceClient),
+        ('resource_pools', ResourcePool),
+        ('zmq_sockets', zmq.Socket)
+    )
+
+    def __init__(self, logger=None):
+        self.logger = logger
+        self._snapshot = None
+        self._snapshot_time = None
+        self._lock = threading.Lock()
+
+    def log(self, level, message):
+        try:
+            if not hasattr(self, 'logger'):
+                return
+            logger = self.logger
+            if logger is None:
+                return
+            if not hasattr(logger, level):
+                return
+            logger_method = getattr(logger, level)
+            if not logger_method:
+                return
+            logger_method(message)
+        except:
+            pass
+
+    @classmethod
+    def available(cls):
+        """
+        :return: whether allocations can be traced
+        """
+        return tracemalloc is not None
+
+    @classmethod
+    def tracing(cls):
+        return tracemalloc is not None and tracemalloc.is_tracing()
+
+    def start(self, frames=DEFAULT_FRAMES):
+        if tracemalloc is None:
+            raise ProfilerError('tracemalloc not available, snapshots count '
+                                'objects by type')
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(max(1, int(frames)))
+                self._snapshot = None
+        self.log('info', 'started tracing allocations')
+
+    def stop(self):
+        with self._lock:
+            if self.tracing():
+                tracemalloc.stop()
+                self._snapshot = None
+                self.log('info', 'stopped tracing allocations')
+
+    @classmethod
+    def _type_name(cls, t):
+        return '%s.%s' % (getattr(t, '__module__', '?'), t.__name__)
+
+    def _objects(self):
+        """
+        :return: tuple of (Counter of type name to number of objects,
+        dict of LIVE_OBJECTS name to number of objects)
+        """
+        types = collections.Counter()
+        live = dict((name, 0) for name, _ in self.LIVE_OBJECTS)
+        for obj in gc.get_objects():
+            types[type(obj)] += 1
+        for t, count in types.items():
+            for name, cls in self.LIVE_OBJECTS:
+                if issubclass(t, cls):
+                    live[name] += count
+        return collections.Counter(
+            dict((self._type_name(t), count) for t, count in types.items())
+        ), live
+
+    @classmethod
+    def _site(cls, stat):
+        return ['%s:%d' % (x.filename, x.lineno) for x in stat.traceback]
+
+    def snapshot(self, limit=DEFAULT_LIMIT):
+        """
+        :param limit: number of top entries and diff entries
+        :return: dict of the snapshot
+        """
+        limit = max(1, int(limit))
+        with self._lock:
+            types, live = self._objects()
+            d = {
+                'tracemalloc': self.tracing(),
+                'time': current_timestamp(milliseconds=True),
+                'objects': live,
+                'open_sockets': TransportManager.instance().open_sockets()
+            }
+            if d['tracemalloc']:
+                snapshot = tracemalloc.take_snapshot().filter_traces((
+                    tracemalloc.Filter(False, tracemalloc.__file__),))
+                d['traced_memory'], d['peak_traced_memory'] = \
+                    tracemalloc.get_traced_memory()
+                d['top'] = [{'site': self._site(x), 'size': x.size,
+                             'count': x.count}
+                            for x in snapshot.statistics('lineno')[:limit]]
+                if isinstance(self._snapshot, tracemalloc.Snapshot):
+                    d['diff'] = [
+                        {'site': self._site(x), 'size': x.size,
+                         'size_diff': x.size_diff, 'count': x.count,
+                         'count_diff': x.count_diff}
+                        for x in snapshot.compare_to(self._snapshot,
+                                                     'lineno')[:limit]]
+            else:
+                snapshot = types
+                d['top'] = [{'type': t, 'count': count}
+                            for t, count in types.most_common(limit)]
+                if isinstance(self._snapshot, collections.Counter):
+                    diff = types.copy()
+                    diff.subtract(self._snapshot)
+                    d['diff'] = [
+                        {'type': t, 'count': types[t], 'count_diff': x}
+                        for t, x in sorted(diff.items(),
+                                           key=lambda y: -abs(y[1]))[:limit]
+                        if x]
+            if self._snapshot is not None:
+                d['previous_time'] = self._snapshot_time
+            self._snapshot = snapshot
+            self._snapshot_time = d['time']
+            return d
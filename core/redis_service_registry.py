@@ -5,15 +5,106 @@ Module provides Redis backed service registry
 import json
 import random
 import redis
+import threading
+import time
+import zlib
+
+from common.utils import current_timestamp
 
 from error import ServiceNotAvailableError, \
     UnknownSocketTypeError, ServiceRegistrationError
+from load_balancer import spare_capacity, weighted_sample
+from registry_snapshot import RegistrySnapshot
+from registry_watcher import RegistryWatcher
+
+
+_CONNECTION_POOLS = {}
+_CONNECTION_POOLS_LOCK = threading.Lock()
+
+
+def redis_client(host, port, db, socket_timeout=None,
+                 socket_connect_timeout=None):
+    """
+    :param socket_timeout: milliseconds a command may take, after which
+    redis.TimeoutError is raised, no limit if None
+    :param socket_connect_timeout: milliseconds connecting may take, no
+    limit if None
+    :return: StrictRedis on the connection pool of the process for host,
+    port, db and timeouts, which all registries and clients share
+    """
+    key = (host, int(port), int(db), socket_timeout, socket_connect_timeout)
+    with _CONNECTION_POOLS_LOCK:
+        pool = _CONNECTION_POOLS.get(key)
+        if pool is None:
+            pool = redis.ConnectionPool(
+                host=host, port=int(port), db=int(db),
+                socket_timeout=None if socket_timeout is None
+                else socket_timeout / 1000.0,
+                socket_connect_timeout=None if socket_connect_timeout is None
+                else socket_connect_timeout / 1000.0)
+            _CONNECTION_POOLS[key] = pool
+    return redis.StrictRedis(connection_pool=pool)
+
+
+class RedisNode(object):
+    """
+    A Redis primary, which takes the writes, and its read replicas
+    """
+
+    # a replica which can not be reached is skipped for this long
+    REPLICA_RETRY_INTERVAL = 10  # in seconds
+
+    def __init__(self, primary, replicas=(), socket_timeout=None,
+                 socket_connect_timeout=None):
+        """
+        :param primary: dict of host, port and db
+        :param replicas: list of dicts of host, port and db
+        :param socket_timeout, socket_connect_timeout: in milliseconds, of
+        the connections to all of them
+        """
+        self.config = primary
+        self.primary = redis_client(
+            socket_timeout=socket_timeout,
+            socket_connect_timeout=socket_connect_timeout, **primary)
+        self.replicas = [redis_client(
+            socket_timeout=socket_timeout,
+            socket_connect_timeout=socket_connect_timeout, **x)
+            for x in replicas]
+        self._replicas_down_until = [0] * len(self.replicas)
+
+    def __repr__(self):
+        return 'RedisNode(host=%s, port=%s, db=%s, replicas=%d)' % (
+            self.config['host'], self.config['port'], self.config['db'],
+            len(self.replicas))
+
+    def read(self, function):
+        """
+        :param function: callable(StrictRedis) which only reads
+        :return: its result on a random replica, or on the primary if there
+        is no replica or it can not be reached in time
+        """
+        now = time.time()
+        replicas = [i for i, down_until in
+                    enumerate(self._replicas_down_until) if down_until <= now]
+        if not replicas:
+            return function(self.primary)
+        i = random.choice(replicas)
+        try:
+            return function(self.replicas[i])
+        except (redis.ConnectionError, redis.TimeoutError):
+            self._replicas_down_until[i] = now + self.REPLICA_RETRY_INTERVAL
+            return function(self.primary)
 
 
 class RedisServiceRegistry(object):
     """
     Redis backed service registry
     Provides methods for service registry, discovery and deregistry
+
+    Discovery reads go to read replicas when there are any, writes to the
+    primary. The keys of a service may be sharded across several nodes by
+    the crc32 of its name. The first node keeps the set of services, the
+    ports of hosts and the event channels.
     """
 
     DEFAULT_REDIS_CONFIG = {
@@ -21,12 +112,116 @@ class RedisServiceRegistry(object):
         "port": 6379,
         "db": 9
     }
+    # a node which stalls fails over to another or to the snapshot
+    DEFAULT_SOCKET_TIMEOUT = 1000  # in milliseconds
+    DEFAULT_SOCKET_CONNECT_TIMEOUT = 1000  # in milliseconds
     STARTING_PORT = 9000
-    PORT_BATCH_SIZE = 100
+    MAX_PORT = 65535
     MANDATORY_FIELDS = ['name', 'host', 'port', 'guid', 'functions',
                         'socket_type', 'connect_method']
+    JSON_FIELDS = ['port', 'ports', 'control_port', 'pid', 'start_time',
+                   'alive', 'workers', 'load']
+    # weighted discovery picks among this many times the instances asked for
+    WEIGHTED_DISCOVERY_OVERSAMPLING = 4
+    # KEYS[2i - 1]: SET of guids of the i-th service, KEYS[2i]: ZSET of
+    # leases of the i-th service, ARGV[1]: number of instances per service,
+    # ARGV[i + 1]: prefix of the HMAP key of an instance of the i-th service.
+    # Sampling num + (number of expired leases) distinct guids yields num
+    # live ones whenever there are that many.
+    DISCOVER_SCRIPT = """
+local time = redis.call('TIME')
+local now = time[1] * 1000 + math.floor(time[2] / 1000)
+local num = tonumber(ARGV[1])
+local services = {}
+for i = 1, #KEYS / 2 do
+    local leases_key = KEYS[2 * i]
+    local expired = redis.call('ZCOUNT', leases_key, '-inf', now)
+    local guids = redis.call('SRANDMEMBER', KEYS[2 * i - 1], num + expired)
+    local instances = {}
+    for _, guid in ipairs(guids) do
+        if #instances >= num then
+            break
+        end
+        local lease = redis.call('ZSCORE', leases_key, guid)
+        if not lease or tonumber(lease) > now then
+            local instance = redis.call('HGETALL', ARGV[i + 1] .. guid)
+            if #instance > 0 then
+                instances[#instances + 1] = instance
+            end
+        end
+    end
+    services[i] = instances
+end
+return services
+"""
+    # KEYS[1]: ZSET of leases of a service, KEYS[2]: HMAP of the instance,
+    # ARGV[1]: guid, ARGV[2]: ttl in milliseconds
+    RENEW_LEASE_SCRIPT = """
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    return 0
+end
+if redis.replicate_commands then
+    redis.replicate_commands()
+end
+local time = redis.call('TIME')
+local expiry = time[1] * 1000 + math.floor(time[2] / 1000) + tonumber(ARGV[2])
+redis.call('ZADD', KEYS[1], expiry, ARGV[1])
+return expiry
+"""
+    # KEYS[1]: ZSET of returned ports of a host, KEYS[2]: STRING of the
+    # lowest port of a host never allocated, ARGV[1]: number of ports,
+    # ARGV[2]: 1 for consecutive ports, ARGV[3]: first port, ARGV[4]: last
+    # port. Hosts which used the ZSET of pre-allocated batches of ports
+    # keep them as returned ports.
+    ALLOCATE_PORTS_SCRIPT = """
+local count = tonumber(ARGV[1])
+local next_port = tonumber(redis.call('GET', KEYS[2]))
+if not next_port then
+    next_port = tonumber(ARGV[3])
+    local highest = redis.call('ZREVRANGE', KEYS[1], 0, 0)
+    if #highest > 0 then
+        next_port = math.max(next_port, tonumber(highest[1]) + 1)
+    end
+end
+local ports = {}
+if ARGV[2] ~= '1' then
+    ports = redis.call('ZRANGE', KEYS[1], 0, count - 1)
+end
+local needed = count - #ports
+if next_port + needed - 1 > tonumber(ARGV[4]) then
+    return {}
+end
+if #ports > 0 then
+    redis.call('ZREM', KEYS[1], unpack(ports))
+end
+for port = next_port, next_port + needed - 1 do
+    ports[#ports + 1] = port
+end
+redis.call('SET', KEYS[2], next_port + needed)
+return ports
+"""
+    REGISTER_EVENT = 'register'
+    DEREGISTER_EVENT = 'deregister'
+    UPDATE_EVENT = 'update'
 
     def __init__(self, **kwargs):
+        """
+        :param host, port, db: primary node
+        :param replicas: read replicas of the primary, list of "host:port"
+        strings or dicts of host, port and db
+        :param shards: nodes to shard the keys of services across, in place
+        of host, port and db. Each one a "host:port[:db]" string, a list of
+        those with the primary first and its replicas after it, or a dict
+        of host, port, db and replicas.
+        :param snapshot_file: host local snapshot of the registry written
+        by the registry_snapshot daemon. Discovery is answered from it
+        while it is fresh, and from whatever it last held when Redis can
+        not be reached.
+        :param snapshot_max_age: milliseconds a snapshot stays fresh
+        :param socket_timeout: milliseconds a Redis command may take
+        :param socket_connect_timeout: milliseconds connecting to Redis may
+        take
+        """
 
         cfg = {}
         for f in ["host", "port", "db"]:
@@ -34,10 +229,106 @@ class RedisServiceRegistry(object):
                 cfg[f] = self.DEFAULT_REDIS_CONFIG[f]
             else:
                 cfg[f] = kwargs[f]
-        self._redis = redis.StrictRedis(**cfg)
-        self._next_avaialble_port = None
+        shards = kwargs.get('shards') or \
+            [dict(cfg, replicas=kwargs.get('replicas') or [])]
+        timeouts = {
+            'socket_timeout': kwargs.get('socket_timeout',
+                                         self.DEFAULT_SOCKET_TIMEOUT),
+            'socket_connect_timeout': kwargs.get(
+                'socket_connect_timeout',
+                self.DEFAULT_SOCKET_CONNECT_TIMEOUT)
+        }
+        self._nodes = [self._redis_node(x, cfg['db'], timeouts)
+                       for x in shards]
+        self._home = self._nodes[0]
+        self._redis = self._home.primary
+        self._watcher = None
+        self._snapshot = None
+        if kwargs.get('snapshot_file'):
+            self._snapshot = RegistrySnapshot(
+                kwargs['snapshot_file'], kwargs.get(
+                    'snapshot_max_age', RegistrySnapshot.DEFAULT_MAX_AGE))
+        self._discover_script = self._redis.register_script(
+            self.DISCOVER_SCRIPT)
+        self._renew_lease_script = self._redis.register_script(
+            self.RENEW_LEASE_SCRIPT)
+        self._allocate_ports_script = self._redis.register_script(
+            self.ALLOCATE_PORTS_SCRIPT)
+
+    @classmethod
+    def _redis_config(cls, address, db):
+        if isinstance(address, dict):
+            return {
+                'host': address.get('host',
+                                    cls.DEFAULT_REDIS_CONFIG['host']),
+                'port': int(address.get('port',
+                                        cls.DEFAULT_REDIS_CONFIG['port'])),
+                'db': int(address.get('db', db))
+            }
+        parts = address.strip().split(':')
+        return {
+            'host': parts[0],
+            'port': int(parts[1]) if len(parts) > 1
+            else cls.DEFAULT_REDIS_CONFIG['port'],
+            'db': int(parts[2]) if len(parts) > 2 else int(db)
+        }
+
+    @classmethod
+    def _redis_node(cls, shard, db, timeouts):
+        if isinstance(shard, dict):
+            primary = cls._redis_config(shard, db)
+            replicas = shard.get('replicas') or []
+        elif isinstance(shard, basestring):
+            primary = cls._redis_config(shard, db)
+            replicas = []
+        else:
+            primary = cls._redis_config(shard[0], db)
+            replicas = shard[1:]
+        return RedisNode(primary, [cls._redis_config(x, primary['db'])
+                                   for x in replicas], **timeouts)
+
+    def _service_node(self, service_name):
+        """
+        :return: RedisNode the keys of a service live on
+        """
+        if len(self._nodes) == 1:
+            return self._home
+        return self._nodes[(zlib.crc32(service_name) & 0xffffffff) %
+                           len(self._nodes)]
+
+    @classmethod
+    def _time_to_milliseconds(cls, time):
+        return time[0] * 1000 + time[1] / 1000
 
-    def register_service(self, service_map):
+    def server_time(self, service_name=None):
+        """
+
+        :param service_name: the time of the node of this service
+        :return: time of the Redis server in milliseconds, leases are
+        measured against it so clocks of hosts do not matter
+        """
+        node = self._home if service_name is None \
+            else self._service_node(service_name)
+        return self._time_to_milliseconds(node.primary.time())
+
+    @classmethod
+    def _event(cls, event, service_name, service_guid):
+        return json.dumps({
+            'event': event,
+            'name': service_name,
+            'guid': service_guid,
+            'time': current_timestamp()
+        })
+
+    def register_service(self, service_map, lease_ttl=None):
+        """
+
+        :param service_map: fields of the instance, MANDATORY_FIELDS
+        included
+        :param lease_ttl: milliseconds the instance stays discoverable
+        unless renew_lease is called, forever if None
+        :return: None
+        """
 
         for field in self.MANDATORY_FIELDS:
             if field not in service_map:
@@ -51,14 +342,141 @@ class RedisServiceRegistry(object):
             service_map['name'], service_map['guid']
         )
 
-        def _register_service(pipe):
+        service_leases_key = RedisServiceRegistryKeys.service_leases_key(
+            service_map['name'])
+
+        node = self._service_node(service_map['name'])
+        if lease_ttl:
+            expiry = self.server_time(service_map['name']) + lease_ttl
+
+        # nothing is read, so MULTI/EXEC without WATCH: registrations of
+        # many instances at once never abort each other
+        pipe = node.primary.pipeline(transaction=True)
+        pipe.sadd(service_guids_key, service_map['guid'])
+        pipe.hmset(service_instance_key, service_map)
+        if lease_ttl:
+            pipe.zadd(service_leases_key, expiry, service_map['guid'])
+        # the instance is announced once it can be discovered
+        home_pipe = pipe if node is self._home \
+            else self._redis.pipeline(transaction=True)
+        home_pipe.sadd(services_key, service_map['name'])
+        # the ports of an instance registering again after it was reaped
+        # were given back to its host, which must not hand them out again
+        ports = service_map.get('ports') or []
+        if isinstance(ports, basestring):
+            ports = json.loads(ports)
+        ports = list(ports) + [service_map['port']]
+        home_pipe.zrem(RedisServiceRegistryKeys.host_ports_key(
+            service_map['host']), *set(int(x) for x in ports))
+        home_pipe.publish(
+            RedisServiceRegistryKeys.service_events_channel(
+                service_map['name']),
+            self._event(self.REGISTER_EVENT, service_map['name'],
+                        service_map['guid']))
+        pipe.execute()
+        if home_pipe is not pipe:
+            home_pipe.execute()
+
+    def update_service(self, service_name, service_guid, fields,
+                       notify=True):
+        """
+        Updates fields of a registered instance of a service, and notifies
+        the watchers. Nothing is done if the instance is not registered.
+
+        :param service_name:
+        :param service_guid:
+        :param fields: dict of fields to set
+        :param notify: publish an update event, which makes every watcher
+        reload the instance
+        :return: whether the instance was updated
+        """
+
+        service_instance_key = RedisServiceRegistryKeys.service_instance_key(
+            service_name, service_guid)
+        channel = RedisServiceRegistryKeys.service_events_channel(
+            service_name)
+        event = self._event(self.UPDATE_EVENT, service_name, service_guid)
+        node = self._service_node(service_name)
+        # local to the call, the load reporter updates from a thread of its
+        # own
+        state = {'updated': False}
+
+        def _update_service(pipe):
+            state['updated'] = bool(pipe.exists(service_instance_key))
             pipe.multi()
-            pipe.sadd(services_key, service_map['name'])
-            pipe.sadd(service_guids_key, service_map['guid'])
-            pipe.hmset(service_instance_key, service_map)
+            if not state['updated']:
+                return
+            pipe.hmset(service_instance_key, fields)
+            if notify and node is self._home:
+                pipe.publish(channel, event)
+
+        node.primary.transaction(_update_service, service_instance_key)
+        if notify and state['updated'] and node is not self._home:
+            self._redis.publish(channel, event)
+        return state['updated']
+
+    def renew_lease(self, service_name, service_guid, lease_ttl):
+        """
+        Extends the lease of an instance to lease_ttl milliseconds from now
+
+        :param service_name:
+        :param service_guid:
+        :param lease_ttl: in milliseconds
+        :return: whether the instance is still registered. If not, e.g.
+        it was reaped after its lease ran out, it has to register again.
+        """
+
+        return bool(self._renew_lease_script(
+            keys=[RedisServiceRegistryKeys.service_leases_key(service_name),
+                  RedisServiceRegistryKeys.service_instance_key(
+                      service_name, service_guid)],
+            args=[service_guid, int(lease_ttl)],
+            client=self._service_node(service_name).primary))
+
+    def expired_instances(self, service_name):
+        """
+
+        :param service_name:
+        :return: list of guids of instances whose lease ran out
+        """
+
+        now = self.server_time(service_name)
+        return self._service_node(service_name).read(
+            lambda r: r.zrangebyscore(
+                RedisServiceRegistryKeys.service_leases_key(service_name),
+                '-inf', now))
+
+    def reap_expired_instances(self, service_names=None):
+        """
+        Deregisters the instances whose lease ran out, e.g. because their
+        process was killed before it could deregister, and returns their
+        ports to their host. An instance which renewed its lease meanwhile
+        is left alone.
+
+        :param service_names: services to reap, all services if None
+        :return: list of (service name, guid) of the reaped instances
+        """
 
-        self._redis.transaction(_register_service, services_key,
-                                service_guids_key, service_instance_key)
+        if service_names is None:
+            service_names = self.services()
+        reaped = []
+        for service_name in service_names:
+            primary = self._service_node(service_name).primary
+            service_leases_key = RedisServiceRegistryKeys.service_leases_key(
+                service_name)
+            now = self.server_time(service_name)
+            for guid in primary.zrangebyscore(service_leases_key, '-inf',
+                                              now):
+                host = primary.hget(
+                    RedisServiceRegistryKeys.service_instance_key(
+                        service_name, guid), 'host')
+                if host is None:
+                    primary.zrem(service_leases_key, guid)
+                    continue
+                if self._deregister_service(service_name, guid, host,
+                                            expired_at=now):
+                    reaped.append((service_name, guid))
+        return reaped
 
     def next_available_port(self, service_name, service_guid, host):
         """
@@ -69,31 +487,33 @@ class RedisServiceRegistry(object):
         :return: next port available for a service in host
         """
 
-        host_ports_key = RedisServiceRegistryKeys.host_ports_key(host)
+        return self.next_available_ports(service_name, service_guid, host,
+                                         1)[0]
 
-        def _next_available_port(pipe):
-            count = pipe.zcard(host_ports_key)
-            if count == 0:
-                ports = []
-                for p in xrange(self.STARTING_PORT, self.STARTING_PORT +
-                                self.PORT_BATCH_SIZE):
-                    ports.extend([p, p])
-                pipe.zadd(host_ports_key, *ports)
-            elif count == 1:
-                ports = []
-                starting_port = int(pipe.zrange(host_ports_key, 0, 0)[0])
-                for p in xrange(starting_port + 1, starting_port + 1 +
-                                self.PORT_BATCH_SIZE):
-                    ports.extend([p, p])
-                pipe.zadd(host_ports_key, *ports)
-
-            starting_port = pipe.zrange(host_ports_key, 0, 0)[0]
-            self._next_avaialble_port = int(starting_port)
-            pipe.multi()
-            pipe.zrem(host_ports_key, starting_port)
+    def next_available_ports(self, service_name, service_guid, host, count,
+                             contiguous=False):
+        """
+        Allocates ports atomically, in one round trip, without retries
+        however many services start on a host at once
 
-        self._redis.transaction(_next_available_port, host_ports_key)
-        return self._next_avaialble_port
+        :param service_name
+        :param service_guid
+        :param host:
+        :param count: number of ports
+        :param contiguous: allocate a block of consecutive ports. Otherwise
+        returned ports are reused first.
+        :return: list of ports available for a service in host
+        """
+
+        ports = self._allocate_ports_script(
+            keys=[RedisServiceRegistryKeys.host_ports_key(host),
+                  RedisServiceRegistryKeys.host_next_port_key(host)],
+            args=[count, 1 if contiguous else 0, self.STARTING_PORT,
+                  self.MAX_PORT])
+        if not ports:
+            raise ServiceRegistrationError('no %d ports left on host: %s' %
+                                           (count, host))
+        return [int(x) for x in ports]
 
     def deregister_service(self, service_name, service_guid, host):
         """
@@ -104,93 +524,321 @@ class RedisServiceRegistry(object):
         :return: None
         """
 
+        self._deregister_service(service_name, service_guid, host)
+
+    def _deregister_service(self, service_name, service_guid, host,
+                            expired_at=None):
+        """
+        :param expired_at: if set, the instance is deregistered only if its
+        lease ran out by then
+        :return: whether the instance was deregistered
+        """
+
         services_key = RedisServiceRegistryKeys.services_key()
         service_guids_key = \
             RedisServiceRegistryKeys.service_guids_key(service_name)
         service_instance_key = RedisServiceRegistryKeys.service_instance_key(
             service_name, service_guid)
+        service_leases_key = RedisServiceRegistryKeys.service_leases_key(
+            service_name)
         host_ports_key = RedisServiceRegistryKeys.host_ports_key(host)
+        node = self._service_node(service_name)
+        # local to the call, the reaper, deregister and refreshers of other
+        # threads may run at the same time
+        state = {'deregistered': False, 'last_instance': False, 'ports': []}
+
+        def _home_commands(pipe):
+            if state['last_instance']:
+                pipe.srem(services_key, service_name)
+            for port in set(int(x) for x in state['ports']):
+                pipe.zadd(host_ports_key, port, port)
+            pipe.publish(
+                RedisServiceRegistryKeys.service_events_channel(
+                    service_name),
+                self._event(self.DEREGISTER_EVENT, service_name,
+                            service_guid))
 
         def _deregister_service(pipe):
-            services_card = pipe.scard(services_key)
-            service_guids_card = pipe.scard(service_guids_key)
+            if expired_at is not None:
+                lease = pipe.zscore(service_leases_key, service_guid)
+                if lease is None or lease > expired_at:
+                    pipe.multi()
+                    return
+            state['last_instance'] = pipe.scard(service_guids_key) == 1
             service_instance = pipe.hgetall(service_instance_key)
-            try:
-                port = service_instance['port']
-            except KeyError:
-                port = None
+            # 'ports' lists further ports the instance reserved, e.g. a
+            # block from next_available_ports
+            state['ports'] = json.loads(service_instance.get('ports', '[]'))
+            if 'port' in service_instance:
+                state['ports'].append(service_instance['port'])
+            state['deregistered'] = bool(service_instance)
             pipe.multi()
             pipe.delete(service_instance_key)
             pipe.srem(service_guids_key, service_guid)
-            if service_guids_card == 1:
-                pipe.delete(service_guids_key)
-                pipe.srem(services_key, service_name)
-                if services_card == 1:
-                    pipe.delete(services_key)
-            if port is not None:
-                pipe.zadd(host_ports_key, port, port)
+            pipe.zrem(service_leases_key, service_guid)
+            if state['deregistered'] and node is self._home:
+                _home_commands(pipe)
+
+        node.primary.transaction(_deregister_service,
+                                 service_guids_key,
+                                 service_instance_key,
+                                 service_leases_key)
+        if state['deregistered'] and node is not self._home:
+            pipe = self._redis.pipeline(transaction=True)
+            _home_commands(pipe)
+            pipe.execute()
+        return state['deregistered']
+
+    def service_guids(self, service_name):
+        """
 
-        self._redis.transaction(_deregister_service,
-                                services_key,
-                                service_guids_key,
-                                service_instance_key,
-                                host_ports_key)
+        :param service_name:
+        :return: set of guids of all registered instances of a service
+        whose lease did not run out
+        """
+        if self._watcher is not None and self._watcher.watches(service_name):
+            return self._watcher.service_guids(service_name)
+        if self._snapshot_watches(service_name, fresh=True):
+            return self._snapshot.service_guids(service_name)
+
+        def _service_guids(r):
+            pipe = r.pipeline(transaction=False)
+            pipe.time()
+            pipe.smembers(
+                RedisServiceRegistryKeys.service_guids_key(service_name))
+            pipe.zrange(
+                RedisServiceRegistryKeys.service_leases_key(service_name),
+                0, -1, withscores=True)
+            return pipe.execute()
+
+        try:
+            now, guids, leases = self._service_node(service_name).read(
+                _service_guids)
+        except redis.RedisError:
+            if not self._snapshot_watches(service_name):
+                raise
+            return self._snapshot.service_guids(service_name)
+        now = self._time_to_milliseconds(now)
+        return guids - set(guid for guid, lease in leases if lease <= now)
+
+    def _snapshot_watches(self, service_name, fresh=False):
+        """
+        :param fresh: whether the snapshot must be fresh, rather than only
+        exist
+        :return: whether the snapshot can answer for the service
+        """
+        if self._snapshot is None:
+            return False
+        if fresh and not self._snapshot.fresh():
+            return False
+        return self._snapshot.watches(service_name)
+
+    @property
+    def snapshot(self):
+        """
+        :return: the RegistrySnapshot read, None without a snapshot_file
+        """
+        return self._snapshot
 
-    def discover_service(self, service_name, num=1):
+    def services(self):
+        """
 
-        services_key = RedisServiceRegistryKeys.services_key()
-        if not self._redis.sismember(services_key, service_name):
-            raise ServiceNotAvailableError("service: %s not available" %
-                                           service_name)
+        :return: set of names of all registered services
+        """
+        return self._home.read(
+            lambda r: r.smembers(RedisServiceRegistryKeys.services_key()))
 
-        self.sample_guids = []
-        self.configs = []
+    def instance_configs(self, service_name, guids=None):
+        """
 
-        service_guids_key = RedisServiceRegistryKeys.service_guids_key(
+        :param service_name:
+        :param guids: guids of the instances, all registered ones if None
+        :return: dict of guid to config of the instances, as returned by
+        discover_service. Instances deregistered meanwhile or whose lease
+        ran out are left out.
+        """
+        node = self._service_node(service_name)
+        if guids is None:
+            guids = node.read(lambda r: r.smembers(
+                RedisServiceRegistryKeys.service_guids_key(service_name)))
+        guids = list(guids)
+        service_leases_key = RedisServiceRegistryKeys.service_leases_key(
             service_name)
-        available_guids = [x for x in self._redis.smembers(service_guids_key)]
-        guid = available_guids[random.randint(0, len(available_guids) - 1)]
-        service_instance_key = RedisServiceRegistryKeys.service_instance_key(
-            service_name, guid)
 
-        def _get_random_sample(pipe):
-            available_guids = [x for x in pipe.smembers(service_guids_key)]
-            if len(available_guids) > num:
-                self.sample_guids = random.sample(available_guids, num)
-            else:
-                self.sample_guids = available_guids
-            pipe.multi()
+        def _instance_configs(r):
+            pipe = r.pipeline(transaction=False)
+            pipe.time()
+            for guid in guids:
+                pipe.hgetall(RedisServiceRegistryKeys.service_instance_key(
+                    service_name, guid))
+                pipe.zscore(service_leases_key, guid)
+            return pipe.execute()
+
+        results = node.read(_instance_configs)
+        now = self._time_to_milliseconds(results[0])
+        configs = {}
+        for guid, config, lease in zip(guids, results[1::2], results[2::2]):
+            if config and (lease is None or lease > now):
+                configs[guid] = self.parse_service_config(config)
+        return configs
+
+    def subscribe(self, service_names=None):
+        """
 
-        self._redis.transaction(_get_random_sample, service_guids_key)
+        :param service_names: names of the services to be notified of, all
+        services if None
+        :return: redis PubSub subscribed to register, deregister and update
+        events of the services
+        """
+        pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        if service_names is None:
+            pubsub.psubscribe(
+                RedisServiceRegistryKeys.service_events_pattern())
+        else:
+            pubsub.subscribe(*[
+                RedisServiceRegistryKeys.service_events_channel(x)
+                for x in service_names])
+        return pubsub
+
+    def watch(self, service_names=None, logger=None):
+        """
+        Starts a RegistryWatcher, after which discover_service and
+        service_guids of the watched services are answered from its local
+        cache without going to Redis.
 
-        watched_keys = []
-        for guid in self.sample_guids:
-            watched_keys.append(
-                RedisServiceRegistryKeys.service_instance_key(service_name,
-                                                              guid)
-            )
+        :param service_names: names of the services to watch, all services
+        if None
+        :return: the RegistryWatcher
+        """
+        if self._watcher is None:
+            watcher = RegistryWatcher(self, service_names, logger)
+            watcher.start()
+            self._watcher = watcher
+        return self._watcher
+
+    def unwatch(self):
+        if self._watcher is not None:
+            self._watcher.stop()
+            self._watcher = None
+
+    def discover_service(self, service_name, num=1, weighted=False):
+        """
+        Samples instances of a service in one round trip
 
-        def _get_configs(pipe):
-            for guid in self.sample_guids:
-                service_instance_key = \
-                    RedisServiceRegistryKeys.service_instance_key(
-                        service_name, guid)
-                self.configs.append(pipe.hgetall(service_instance_key))
-            pipe.multi()
+        :param service_name:
+        :param num: number of instances to sample
+        :param weighted: sample in proportion to the spare capacity the
+        instances publish, rather than uniformly
+        :return: list of configs of at most num distinct instances
+        """
+
+        configs = self.discover_services([service_name], num,
+                                         weighted)[service_name]
+        if not configs:
+            raise ServiceNotAvailableError("service: %s not available" %
+                                           service_name)
+        return configs
+
+    def discover_services(self, service_names, num=1, weighted=False):
+        """
+        Samples instances of many services in one round trip. Services
+        watched or in a fresh snapshot are answered locally, the snapshot
+        stands in for the nodes which can not be reached.
+
+        :param service_names: list of service names
+        :param num: number of instances to sample per service
+        :param weighted: sample in proportion to the spare capacity the
+        instances publish, rather than uniformly
+        :return: dict of service name to list of configs of at most num
+        distinct instances, empty for services not available
+        """
 
-        self._redis.transaction(_get_configs, *watched_keys)
+        result = {}
+        queried = []
+        for service_name in service_names:
+            if self._watcher is not None and \
+                    self._watcher.watches(service_name):
+                source = self._watcher
+            elif self._snapshot_watches(service_name, fresh=True):
+                source = self._snapshot
+            else:
+                queried.append(service_name)
+                continue
+            try:
+                result[service_name] = source.discover_service(
+                    service_name, num, weighted)
+            except ServiceNotAvailableError:
+                result[service_name] = []
+        if not queried:
+            return result
+
+        # one script call per node the services live on
+        by_node = {}
+        for service_name in queried:
+            by_node.setdefault(self._service_node(service_name),
+                               []).append(service_name)
+        for node, node_service_names in by_node.items():
+            keys = []
+            for service_name in node_service_names:
+                keys.append(RedisServiceRegistryKeys.service_guids_key(
+                    service_name))
+                keys.append(RedisServiceRegistryKeys.service_leases_key(
+                    service_name))
+            args = [num * self.WEIGHTED_DISCOVERY_OVERSAMPLING
+                    if weighted else num]
+            args.extend(RedisServiceRegistryKeys.service_instance_key(x, '')
+                        for x in node_service_names)
+            try:
+                services = node.read(lambda r: self._discover_script(
+                    keys=keys, args=args, client=r))
+            except redis.RedisError:
+                if not all(self._snapshot_watches(x)
+                           for x in node_service_names):
+                    raise
+                for service_name in node_service_names:
+                    try:
+                        result[service_name] = \
+                            self._snapshot.discover_service(
+                                service_name, num, weighted)
+                    except ServiceNotAvailableError:
+                        result[service_name] = []
+                continue
+            for service_name, instances in zip(node_service_names, services):
+                configs = [
+                    self.parse_service_config(dict(zip(x[::2], x[1::2])))
+                    for x in instances]
+                if weighted:
+                    configs = self.weighted_sample(configs, num)
+                result[service_name] = configs
+        return result
 
-        for config in self.configs:
-            config["socket_type"] = self.client_socket_type(config[
-                "socket_type"])
-            config["connect_method"] = "connect" \
-                if config["connect_method"] == "bind" else "bind"
-            config['functions'] = set(json.loads(config['functions']))
-            for f in ['port', 'pid', 'start_time', 'alive']:
-                if f in config:
-                    config[f] = json.loads(config[f])
+    @classmethod
+    def weighted_sample(cls, configs, num):
+        """
+        :param configs: configs of instances
+        :param num:
+        :return: at most num of the configs, sampled in proportion to the
+        spare capacity of the instances
+        """
+        return weighted_sample(
+            configs, [spare_capacity(x.get('load')) for x in configs], num)
 
-        return self.configs
+    @classmethod
+    def parse_service_config(cls, config):
+        """
+        Turns the HMAP of an instance into the config a client connects with
+
+        :param config: HMAP of an instance, as registered
+        :return: config
+        """
+        config["socket_type"] = cls.client_socket_type(config["socket_type"])
+        config["connect_method"] = "connect" \
+            if config["connect_method"] == "bind" else "bind"
+        config['functions'] = set(json.loads(config['functions']))
+        for f in cls.JSON_FIELDS:
+            if f in config:
+                config[f] = json.loads(config[f])
+        return config
 
     @classmethod
     def client_socket_type(cls, socket_type):
@@ -220,6 +868,7 @@ class RedisServiceRegistryKeys(object):
     HMAP_KEY_PREFIX = 'hm'
     SET_KEY_PREFIX = 'se'
     ZSET_KEY_PREFIX = 'zs'
+    CHANNEL_KEY_PREFIX = 'ch'
 
     @classmethod
     def services_key(cls):
@@ -251,13 +900,55 @@ class RedisServiceRegistryKeys(object):
         return "%s:s:%s:g:%s" % (cls.HMAP_KEY_PREFIX, service_name,
                                  service_guid)
 
+    @classmethod
+    def service_leases_key(cls, service_name):
+        """
+
+        :param service_name:
+        :return: key for ZSET of guids of the instances of a service scored
+        by the expiry of their lease, in milliseconds of Redis server time
+        """
+
+        return "%s:s:%s:l" % (cls.ZSET_KEY_PREFIX, service_name)
+
+    @classmethod
+    def host_next_port_key(cls, host):
+        """
+
+        :param host:
+        :return: key for STRING of the lowest port of a host that was never
+        allocated
+        """
+
+        return "%s:h:%s:p" % (cls.STRING_KEY_PREFIX, host)
+
     @classmethod
     def host_ports_key(cls, host):
         """
 
         :param host:
-        :return: key for ZSET that keeps track of available ports for a host
+        :return: key for ZSET of ports returned by services of a host,
+        which are allocated again before new ones
         """
 
         return "%s:h:%s:p" % (cls.ZSET_KEY_PREFIX, host)
 
+    @classmethod
+    def service_events_channel(cls, service_name):
+        """
+
+        :param service_name:
+        :return: pub/sub channel of register, deregister and update events
+        of a service
+        """
+
+        return "%s:s:%s" % (cls.CHANNEL_KEY_PREFIX, service_name)
+
+    @classmethod
+    def service_events_pattern(cls):
+        """
+
+        :return: pub/sub pattern matching the event channels of all services
+        """
+
+        return "%s:s:*" % cls.CHANNEL_KEY_PREFIX
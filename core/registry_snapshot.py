@@ -0,0 +1,400 @@
+"""
+Module provides a host local snapshot of the service registry: a sidecar
+daemon mirrors the registry into a file, which every client on the host
+reads discovery data from without network I/O
+
+    python -m core.registry_snapshot -c config_file
+
+The file is also last-known data when Redis is slow or unavailable, and
+lets clients start without waiting for Redis.
+"""
+
+import argparse
+import ConfigParser
+import json
+import logging
+import logging.config
+import mmap
+import os
+import random
+import tempfile
+import threading
+import time
+
+from common.utils import config_value, redis_config_from_config_file
+from error import ServiceNotAvailableError
+from load_balancer import spare_capacity, weighted_sample
+
+
+DEFAULT_SNAPSHOT_FILE = os.path.join(tempfile.gettempdir(),
+                                     'service_registry_snapshot.json')
+SNAPSHOT_VERSION = 2
+# the file is a header line of this many bytes, then the map
+SNAPSHOT_HEADER_SIZE = 256
+
+
+class RegistrySnapshotWriter(object):
+    """
+    Follows the registry with a RegistryWatcher and writes its map to the
+    snapshot file after every change, at most once per
+    'min_write_interval' milliseconds.
+
+    The file starts with a header line of SNAPSHOT_HEADER_SIZE bytes, which
+    says whether the watcher is connected and when Redis last answered it.
+    Every 'max_write_interval' milliseconds the header is refreshed in
+    place, even without changes, so readers can tell a current map from
+    the one of a dead writer, or of a writer cut off from Redis.
+
+    A changed map is written to a temporary file and renamed over the
+    snapshot, readers never see a partial one.
+    """
+
+    DEFAULT_MIN_WRITE_INTERVAL = 100  # in milliseconds
+    DEFAULT_MAX_WRITE_INTERVAL = 5 * 1000  # in milliseconds
+
+    def __init__(self, registry, path=DEFAULT_SNAPSHOT_FILE,
+                 service_names=None, logger=None,
+                 min_write_interval=DEFAULT_MIN_WRITE_INTERVAL,
+                 max_write_interval=DEFAULT_MAX_WRITE_INTERVAL):
+        """
+        :param registry: RedisServiceRegistry
+        :param service_names: names of the services to mirror, all
+        services if None
+        """
+        self.logger = logger
+        self.path = path
+        self._registry = registry
+        self._service_names = None if service_names is None \
+            else sorted(service_names)
+        self._min_write_interval = min_write_interval
+        self._max_write_interval = max_write_interval
+        self._changed = threading.Event()
+        self._stop_event = threading.Event()
+        self._watcher = None
+        self._thread = None
+        # map last written, and the inode of the file it was written to
+        self._body = None
+        self._body_id = None
+        self._inode = None
+        self.num_writes = 0
+        self.num_header_writes = 0
+
+    def log(self, level, message):
+        try:
+            if not hasattr(self, 'logger'):
+                return
+            logger = self.logger
+            if logger is None:
+                return
+            if not hasattr(logger, level):
+                return
+            logger_method = getattr(logger, level)
+            if not logger_method:
+                return
+            logger_method(message)
+        except:
+            pass
+
+    def start(self):
+        self._watcher = self._registry.watch(self._service_names,
+                                             self.logger)
+        self._watcher.add_listener(self._on_change)
+        self.write()
+        self._thread = threading.Thread(target=self._run,
+                                        name='registry-snapshot-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._changed.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._registry.unwatch()
+
+    def _on_change(self, event, service_name, guid):
+        self._changed.set()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self._changed.wait(self._max_write_interval / 1000.0)
+            if self._stop_event.is_set():
+                break
+            self._changed.clear()
+            try:
+                self.write()
+            except Exception as exception:
+                self.log('error', 'Error while writing registry snapshot: '
+                                  '%s. Error: %r' % (self.path, exception))
+            # changes made meanwhile are written together
+            self._stop_event.wait(self._min_write_interval / 1000.0)
+
+    def write(self):
+        """
+        Writes the map if it changed, otherwise refreshes the header only
+        """
+        services = {}
+        for service_name, instances in self._watcher.services().items():
+            services[service_name] = {}
+            for guid, config in instances.items():
+                config = dict(config)
+                config['functions'] = sorted(config['functions'])
+                services[service_name][guid] = config
+        body = json.dumps({
+            'service_names': self._service_names,
+            'services': services
+        }, sort_keys=True)
+        try:
+            inode = os.stat(self.path).st_ino
+        except OSError:
+            inode = None
+        if body == self._body and inode == self._inode:
+            with open(self.path, 'r+b') as f:
+                f.write(self._header())
+            self.num_header_writes += 1
+            return
+
+        self._body_id = '%d-%d-%d' % (os.getpid(), int(time.time() * 1000),
+                                      self.num_writes)
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(dir=directory,
+                                         prefix='.registry_snapshot')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(self._header())
+                f.write(body)
+                f.flush()
+                os.fsync(f.fileno())
+                inode = os.fstat(f.fileno()).st_ino
+            os.chmod(temp_path, 0644)
+            os.rename(temp_path, self.path)
+        except:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+        self._body = body
+        self._inode = inode
+        self.num_writes += 1
+
+    def _header(self):
+        header = json.dumps({
+            'version': SNAPSHOT_VERSION,
+            'time': time.time(),
+            'pid': os.getpid(),
+            'body': self._body_id,
+            'connected': self._watcher.connected(),
+            'watcher_time': self._watcher.last_contact()
+        })
+        return header.ljust(SNAPSHOT_HEADER_SIZE - 1) + '\n'
+
+
+class RegistrySnapshot(object):
+    """
+    Reader of the snapshot file. The file stays memory-mapped, and at most
+    every CHECK_INTERVAL seconds its header is read from the mapping. The
+    map is parsed again only when the header says it changed, or the
+    writer replaced the file, so reads are served from memory.
+    """
+
+    DEFAULT_MAX_AGE = 30 * 1000  # in milliseconds
+    CHECK_INTERVAL = 0.1  # in seconds
+
+    def __init__(self, path=DEFAULT_SNAPSHOT_FILE, max_age=DEFAULT_MAX_AGE):
+        """
+        :param max_age: milliseconds after which a snapshot whose writer
+        did not hear from Redis is no longer fresh, e.g. because the writer
+        died or lost its connection. It is still used as last-known data
+        when Redis can not be reached.
+        """
+        self.path = path
+        self.max_age = max_age
+        self._file = None
+        self._mapped = None
+        self._header = None
+        self._data = None
+        self._next_check = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'RegistrySnapshot(path=%s, age=%s)' % (self.path, self.age())
+
+    def _replaced(self):
+        if self._mapped is None:
+            return True
+        try:
+            # the writer renames a new file over the mapped one
+            return os.fstat(self._file.fileno()).st_nlink == 0
+        except OSError:
+            return True
+
+    def _map(self):
+        try:
+            f = open(self.path, 'rb')
+        except IOError:
+            return
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error, EnvironmentError):
+            # e.g. an empty file
+            f.close()
+            return
+        if self._mapped is not None:
+            self._mapped.close()
+            self._file.close()
+        self._file, self._mapped = f, mapped
+
+    def _load(self):
+        now = time.time()
+        if now < self._next_check:
+            return self._data
+        with self._lock:
+            if now < self._next_check:
+                return self._data
+            self._next_check = now + self.CHECK_INTERVAL
+            if self._replaced():
+                self._map()
+            if self._mapped is None:
+                return self._data
+            try:
+                header = json.loads(self._mapped[:SNAPSHOT_HEADER_SIZE])
+            except ValueError:
+                # partial header, being refreshed
+                return self._data
+            if header.get('version') != SNAPSHOT_VERSION:
+                return self._data
+            if self._header is None or \
+                    header['body'] != self._header['body']:
+                try:
+                    data = json.loads(self._mapped[SNAPSHOT_HEADER_SIZE:])
+                except ValueError:
+                    return self._data
+                # configs as the registry returns them, with str not
+                # unicode
+                services = {}
+                for service_name, instances in data['services'].items():
+                    services[str(service_name)] = dict(
+                        (str(guid), self._config(config))
+                        for guid, config in instances.items())
+                self._data = {
+                    'service_names': data['service_names'],
+                    'services': services
+                }
+            self._header = header
+            return self._data
+
+    @classmethod
+    def _config(cls, config):
+        config = dict((str(k), str(v) if isinstance(v, unicode) else v)
+                      for k, v in config.items())
+        config['functions'] = set(str(x) for x in config['functions'])
+        return config
+
+    def available(self):
+        """
+        :return: whether there is a snapshot, fresh or not
+        """
+        return self._load() is not None
+
+    def age(self):
+        """
+        :return: milliseconds since Redis last answered the writer, None if
+        there is no snapshot
+        """
+        if self._load() is None:
+            return None
+        watcher_time = self._header.get('watcher_time')
+        if watcher_time is None:
+            return None
+        return int((time.time() - watcher_time) * 1000)
+
+    def fresh(self):
+        """
+        :return: whether the writer is connected to Redis and heard from it
+        within max_age milliseconds
+        """
+        age = self.age()
+        return age is not None and age <= self.max_age and \
+            self._header.get('connected', False)
+
+    def watches(self, service_name):
+        data = self._load()
+        if data is None:
+            return False
+        return data['service_names'] is None or \
+            service_name in data['service_names']
+
+    def services(self):
+        """
+        :return: dict of service name to {guid: config}
+        """
+        data = self._load()
+        return {} if data is None else data['services']
+
+    def service_guids(self, service_name):
+        return set(self.services().get(service_name, {}).keys())
+
+    def discover_service(self, service_name, num=1, weighted=False):
+        """
+        :param weighted: sample in proportion to the spare capacity the
+        instances publish, rather than uniformly
+        :return: list of configs of at most num randomly sampled instances
+        """
+        instances = self.services().get(service_name)
+        if not instances:
+            raise ServiceNotAvailableError("service: %s not available" %
+                                           service_name)
+        configs = instances.values()
+        if weighted:
+            configs = weighted_sample(
+                configs, [spare_capacity(x.get('load')) for x in configs],
+                num)
+        elif len(configs) > num:
+            configs = random.sample(configs, num)
+        return [dict(x) for x in configs]
+
+
+def main():
+    from core.redis_service_registry import RedisServiceRegistry
+
+    parser = argparse.ArgumentParser(
+        description="Mirrors the service registry into a host local "
+                    "snapshot file")
+    parser.add_argument("-c", "--config_file", required=True,
+                        help="config file")
+    parser.add_argument("-p", "--path", default=None,
+                        help="snapshot file, [registry_snapshot] path of "
+                             "the config file by default")
+    parser.add_argument("-s", "--services", nargs='*', default=None,
+                        help="services to mirror, all by default")
+    args = parser.parse_args()
+
+    config = ConfigParser.SafeConfigParser()
+    config.read(args.config_file)
+    if config.has_section("loggers"):
+        logging.config.fileConfig(args.config_file)
+    else:
+        logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger('RegistrySnapshotWriter')
+
+    path = args.path or config_value(config, "registry_snapshot", "path",
+                                     DEFAULT_SNAPSHOT_FILE)
+    registry = RedisServiceRegistry(**redis_config_from_config_file(
+        config, "redis_service_registry",
+        RedisServiceRegistry.DEFAULT_REDIS_CONFIG))
+    writer = RegistrySnapshotWriter(registry, path, args.services, logger)
+    writer.start()
+    logger.info('writing registry snapshot to %s' % path)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        writer.stop()
+
+
+if __name__ == "__main__":
+    main()
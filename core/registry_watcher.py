@@ -0,0 +1,299 @@
+"""
+Module provides a watcher, which keeps an in-process copy of the service
+registry current by following its register, deregister and update events
+"""
+
+import json
+import random
+import threading
+import time
+
+from error import ServiceNotAvailableError
+
+
+class RegistryWatcher(object):
+    """
+    Keeps a map of service name to {guid: config} of the watched services.
+    It is loaded from the registry once, then kept current with the events
+    the registry publishes, so discovery never goes to Redis.
+
+    The subscription is made before the map is loaded, no event is lost in
+    between. Pub/sub does not queue events for a disconnected subscriber,
+    so the map is reloaded after the connection to Redis was lost, and
+    every 'resync_interval' milliseconds as a safety net.
+
+    A lease running out publishes no event, so the leases of the watched
+    services are checked every 'lease_check_interval' milliseconds, and
+    instances whose lease ran out are left out until they renew it.
+    """
+
+    DEFAULT_RESYNC_INTERVAL = 60 * 1000  # in milliseconds
+    DEFAULT_LEASE_CHECK_INTERVAL = 5 * 1000  # in milliseconds
+    POLL_TIMEOUT = 1.0  # in seconds
+    RECONNECT_INTERVAL = 1.0  # in seconds
+
+    def __init__(self, registry, service_names=None, logger=None,
+                 resync_interval=DEFAULT_RESYNC_INTERVAL,
+                 lease_check_interval=DEFAULT_LEASE_CHECK_INTERVAL):
+        """
+        :param registry: RedisServiceRegistry
+        :param service_names: names of the services to watch, all services
+        if None
+        :param resync_interval: milliseconds between reloads of the map,
+        0 disables them
+        :param lease_check_interval: milliseconds between checks of the
+        leases, 0 disables them
+        """
+        self.logger = logger
+        self._registry = registry
+        self._service_names = None if service_names is None \
+            else set(service_names)
+        self._resync_interval = resync_interval
+        self._lease_check_interval = lease_check_interval
+        # every instance, and the ones whose lease did not run out
+        self._all_services = {}
+        self._services = {}
+        # service name to set of guids whose lease ran out
+        self._expired = {}
+        self._last_lease_check = None
+        self._listeners = []
+        self._pubsub = None
+        self._last_sync = None
+        # time Redis last answered the watcher
+        self._last_contact = None
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self.stats = {
+            'num_events': 0,
+            'num_resyncs': 0,
+            'num_lease_checks': 0,
+            'num_reconnects': 0
+        }
+
+    def log(self, level, message):
+        try:
+            if not hasattr(self, 'logger'):
+                return
+            logger = self.logger
+            if logger is None:
+                return
+            if not hasattr(logger, level):
+                return
+            logger_method = getattr(logger, level)
+            if not logger_method:
+                return
+            logger_method(message)
+        except:
+            pass
+
+    def add_listener(self, listener):
+        """
+        :param listener: callable(event, service_name, guid), called from
+        the watcher thread after the map was updated. event is None after a
+        reload of the map or a change of the instances whose lease ran out.
+        """
+        self._listeners.append(listener)
+
+    def _notify(self, event, service_name, guid):
+        for listener in self._listeners:
+            try:
+                listener(event, service_name, guid)
+            except Exception as exception:
+                self.log('error', 'Error in registry listener: %r' %
+                         exception)
+
+    def start(self):
+        """
+        Subscribes to the events, loads the map and starts following the
+        events in a thread. Raises if Redis can not be reached.
+        """
+        self._pubsub = self._registry.subscribe(self._service_names)
+        self._resync()
+        self._thread = threading.Thread(target=self._run,
+                                        name='registry-watcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._pubsub is not None:
+            try:
+                self._pubsub.close()
+            except Exception:
+                pass
+            self._pubsub = None
+
+    def _resync(self):
+        service_names = self._service_names
+        if service_names is None:
+            service_names = self._registry.services()
+        services = {}
+        for service_name in service_names:
+            services[service_name] = self._registry.instance_configs(
+                service_name)
+        # instance_configs leaves out instances whose lease ran out
+        with self._lock:
+            self._expired = {}
+            self._set_services(services)
+        self._last_sync = time.time()
+        self._last_lease_check = self._last_sync
+        self._last_contact = self._last_sync
+        self.stats['num_resyncs'] += 1
+        self.log('debug', 'loaded %d instances of %d services' %
+                 (sum(len(x) for x in services.values()), len(services)))
+        self._notify(None, None, None)
+
+    def _handle_event(self, message):
+        try:
+            event = json.loads(message['data'])
+            event_type = event['event']
+            service_name = str(event['name'])
+            guid = str(event['guid'])
+        except (ValueError, KeyError, TypeError):
+            self.log('error', 'Malformed registry event: %r' % message)
+            return
+
+        self.stats['num_events'] += 1
+        self.log('debug', '%s event of instance: %s of %s service' %
+                 (event_type, guid, service_name))
+
+        if event_type == self._registry.DEREGISTER_EVENT:
+            config = None
+        else:
+            config = self._registry.instance_configs(
+                service_name, [guid]).get(guid)
+
+        with self._lock:
+            instances = dict(self._all_services.get(service_name, {}))
+            if config is None:
+                instances.pop(guid, None)
+            else:
+                instances[guid] = config
+            services = dict(self._all_services)
+            if instances:
+                services[service_name] = instances
+            elif self._service_names is None:
+                services.pop(service_name, None)
+            else:
+                services[service_name] = instances
+            if config is not None and guid in self._expired.get(service_name,
+                                                                ()):
+                # registered again, or updated after renewing its lease
+                self._expired = dict(self._expired)
+                self._expired[service_name] = \
+                    self._expired[service_name] - set([guid])
+            self._set_services(services)
+
+        self._notify(event_type, service_name, guid)
+
+    def _set_services(self, services):
+        """
+        Replaces the map, called with the lock held
+        """
+        self._all_services = services
+        live = {}
+        for service_name, instances in services.items():
+            expired = self._expired.get(service_name)
+            live[service_name] = instances if not expired else dict(
+                (guid, config) for guid, config in instances.items()
+                if guid not in expired)
+        self._services = live
+
+    def _check_leases(self):
+        expired = {}
+        for service_name in self._all_services.keys():
+            guids = set(self._registry.expired_instances(service_name))
+            if guids:
+                expired[service_name] = guids
+        self._last_lease_check = time.time()
+        self.stats['num_lease_checks'] += 1
+        with self._lock:
+            if expired == self._expired:
+                return
+            self._expired = expired
+            self._set_services(self._all_services)
+        self.log('debug', '%d instances whose lease ran out' %
+                 sum(len(x) for x in expired.values()))
+        self._notify(None, None, None)
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                if self._pubsub is None:
+                    self._pubsub = self._registry.subscribe(
+                        self._service_names)
+                    self._resync()
+                elif self._resync_interval and time.time() - \
+                        self._last_sync >= self._resync_interval / 1000.0:
+                    self._resync()
+                elif self._lease_check_interval and time.time() - \
+                        self._last_lease_check >= \
+                        self._lease_check_interval / 1000.0:
+                    self._check_leases()
+                message = self._pubsub.get_message(
+                    timeout=self.POLL_TIMEOUT)
+                self._last_contact = time.time()
+                if message is not None and \
+                        message['type'] in ('message', 'pmessage'):
+                    self._handle_event(message)
+            except Exception as exception:
+                self.log('error', 'Error while watching the registry, '
+                                  'reconnecting. Error: %r' % exception)
+                self.stats['num_reconnects'] += 1
+                if self._pubsub is not None:
+                    try:
+                        self._pubsub.close()
+                    except Exception:
+                        pass
+                    self._pubsub = None
+                self._stop_event.wait(self.RECONNECT_INTERVAL)
+
+    def connected(self):
+        """
+        :return: whether the watcher is subscribed to the events, the map
+        may be missing changes otherwise
+        """
+        return self._pubsub is not None
+
+    def last_contact(self):
+        """
+        :return: time Redis last answered the watcher, in seconds since
+        the epoch, None before the map was loaded
+        """
+        return self._last_contact
+
+    def watches(self, service_name):
+        return self._service_names is None or \
+            service_name in self._service_names
+
+    def services(self):
+        """
+        :return: dict of service name to {guid: config} of the instances
+        whose lease did not run out. It is never mutated, updates replace
+        it.
+        """
+        return self._services
+
+    def service_guids(self, service_name):
+        return set(self._services.get(service_name, {}).keys())
+
+    def discover_service(self, service_name, num=1, weighted=False):
+        """
+        :param weighted: sample in proportion to the spare capacity the
+        instances publish, rather than uniformly
+        :return: list of configs of at most num randomly sampled instances
+        """
+        instances = self._services.get(service_name)
+        if not instances:
+            raise ServiceNotAvailableError("service: %s not available" %
+                                           service_name)
+        configs = instances.values()
+        if weighted:
+            configs = self._registry.weighted_sample(configs, num)
+        elif len(configs) > num:
+            configs = random.sample(configs, num)
+        return [dict(x) for x in configs]
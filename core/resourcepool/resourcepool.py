@@ -25,6 +25,12 @@ except ImportError:
     import queue as Queue
 
 
+def _discard(resource):
+    """Discard a resource that is dropped from its pool, e.g. close it."""
+    if hasattr(resource, 'discard'):
+        resource.discard()
+
+
 class Resource(object):
     """Wrapper object around an allocated resource from ResourcePool.
 
@@ -48,7 +54,9 @@ class Resource(object):
             pass
 
     def release(self):
-        """Release the underlying resource back into the pool."""
+        """Release the underlying resource back into the pool. A resource
+        that has gone bad is dropped, and discarded if it has a discard
+        method."""
         if hasattr(self.resource, 'good_to_use'):
             if self.resource.good_to_use():
                 self._pool.release(self.resource)
@@ -57,6 +65,7 @@ class Resource(object):
                       'to pool' %\
                       (time.strftime('%Y-%m-%d %H-%M-%S', time.localtime()),
                        self.resource)
+                _discard(self.resource)
         else:
             self._pool.release(self.resource)
         self._pool = None
@@ -133,6 +142,7 @@ class ResourcePool(object):
                     time.strftime('%Y-%m-%d %H-%M-%S', time.localtime()),
                     resource
                 )
+                _discard(resource)
 
         raise Queue.Empty
 
@@ -140,6 +150,23 @@ class ResourcePool(object):
         """Add a resource to the pool."""
         self._resources.put(resource)
 
+    def drain(self):
+        """Remove and return all available resources, without checking
+        whether they are good to use."""
+        resources = []
+        while True:
+            try:
+                resources.append(self._resources.get_nowait())
+            except Queue.Empty:
+                return resources
+
+    def available(self):
+        """Number of resources available.
+
+        Note: This is a rough guide only, like empty().
+        """
+        return self._resources.qsize()
+
     def empty(self):
         """Check if any resources are available.
 
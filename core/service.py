@@ -15,21 +15,31 @@ import hashlib
 import json
 import logging
 import logging.config
+import multiprocessing
 import os
 import os.path
 import psutil
 import random
 import requests
+import signal
+import tempfile
+import threading
 
 import zmq
 from core.service_message_handler import \
     HeartbeatHandler, DescriptionHandler, StopServiceHandler, \
-    DefaultMessageHandler, HealthCheckHandler
+    DefaultMessageHandler, HealthCheckHandler, SlowLogHandler, \
+    ProfileHandler, HeapProfileHandler
 from common.utils import redis_config_from_config_file, \
-    zmq_socket_from_socket_type, set_time_zone, current_timestamp
+    zmq_socket_from_socket_type, set_time_zone, current_timestamp, \
+    config_value, split_envelope, monotonic_time
 from core.redis_service_registry import \
     RedisServiceRegistry
 from core.error import StopServiceError
+from core.function_stats import FunctionStats, PhaseTimer, SlowLog
+from core.load_balancer import spare_capacity
+from core.profiler import HeapProfiler, Profiler
+from core.transport import TransportManager
 
 
 class Service(object):
@@ -42,12 +52,18 @@ class Service(object):
     MESSAGE_HANDLERS = {}
     CONFIG_REDIS_SECTION = "config_redis"
     BASE_TCP_ADDR = 'tcp://%s:%d'
-    DEFAULT_FUNCTIONS = ["heartbeat", "healthcheck", "description", "stop"]
+    DEFAULT_FUNCTIONS = ["heartbeat", "healthcheck", "description", "stop",
+                         "slowlog", "profile", "heapprofile"]
+    # functions also served on the control socket
+    CONTROL_FUNCTIONS = DEFAULT_FUNCTIONS
     DEFAULT_FUNCTION_MESSAGE_HANDLERS = {
         "heartbeat": HeartbeatHandler,
         "healthcheck": HealthCheckHandler,
         "description": DescriptionHandler,
         "stop": StopServiceHandler,
+        "slowlog": SlowLogHandler,
+        "profile": ProfileHandler,
+        "heapprofile": HeapProfileHandler,
         "default": DefaultMessageHandler
     }
     EC2_INSTANCE_HOSTNAME_URL = \
@@ -55,6 +71,23 @@ class Service(object):
     EC2_METADATA_REQUEST_TIMEOUT = 1
     PID_DIR = "/home/ec2-user/publishing_services"
     FUNCTIONS_DECK_LENGTH = 10
+    VALID_WORKER_TYPES = {"thread", "process"}
+    VALID_IO_LOOPS = {"poller", "gevent"}
+    DEFAULT_MAX_CONCURRENCY = 100
+    DEFAULT_EXECUTOR_THREADS = 10
+    WORKER_POLL_TIMEOUT = 100  # in milliseconds
+    WORKER_DRAIN_TIMEOUT = 5 * 1000  # in milliseconds
+    WORKER_JOIN_TIMEOUT = 2  # in seconds
+    WORKER_SUPERVISE_INTERVAL = 1000  # in milliseconds
+    WORKER_READY = "ready"
+    DEFAULT_LEASE_TTL = 15 * 1000  # in milliseconds
+    LEASE_RENEWALS_PER_TTL = 3
+    DEFAULT_LOAD_REPORT_INTERVAL = 5 * 1000  # in milliseconds
+    LOAD_WINDOW_SIZE = 1000  # latest response times p50 and p99 are over
+    # a load published with an update event differs from the previous one
+    # by this much spare capacity, or this factor of p99
+    LOAD_CHANGE_SPARE_CAPACITY = 0.1
+    LOAD_CHANGE_P99_FACTOR = 1.5
 
     def __repr__(self):
         return "%s(name=%s, host=%s, guid=%s, pid=%s, description=%s, " \
@@ -106,7 +139,7 @@ class Service(object):
             ])
         ).hexdigest()
 
-    def _set_config(self, config_file=None):
+    def _set_config(self, config_file=None, workers=None):
         if not config_file:
             raise RuntimeError('A config file must be specified')
 
@@ -144,6 +177,103 @@ class Service(object):
         self.pid_dir_path = "%s/%s" % (self.pid_dir_path, self.name)
         self.pid_file = "%s/%s" % (self.pid_dir_path, self.pid)
 
+        self.num_workers = int(config_value(self.config, "global", "workers",
+                                            0))
+        self.worker_type = config_value(self.config, "global", "worker_type",
+                                        "thread").lower()
+        if workers is not None:
+            # pre-fork mode requested on the command line
+            self.num_workers = workers
+            self.worker_type = "process"
+        if self.worker_type not in self.VALID_WORKER_TYPES:
+            raise RuntimeError(
+                "Worker type %s not in set [%s] of valid worker types" %
+                (self.worker_type, ", ".join(self.VALID_WORKER_TYPES)))
+        self._workers = []
+        # routing identity of every worker, and requests sent to a ready
+        # worker and not answered yet by identity
+        self._worker_identities = []
+        self._worker_requests = {}
+        self._num_worker_starts = 0
+        self._workers_stop_event = None
+
+        self.io_loop = config_value(self.config, "global", "io_loop",
+                                    "poller").lower()
+        if self.io_loop not in self.VALID_IO_LOOPS:
+            raise RuntimeError(
+                "IO loop %s not in set [%s] of valid IO loops" %
+                (self.io_loop, ", ".join(self.VALID_IO_LOOPS)))
+        if self.io_loop == "gevent" and self.num_workers:
+            raise RuntimeError("gevent IO loop can not be used with workers")
+        self.max_concurrency = int(config_value(
+            self.config, "global", "max_concurrency",
+            self.DEFAULT_MAX_CONCURRENCY))
+        self.executor_threads = int(config_value(
+            self.config, "global", "executor_threads",
+            self.DEFAULT_EXECUTOR_THREADS))
+        # I/O threads of the context shared by the clients the service makes
+        # of other services
+        client_io_threads = int(config_value(
+            self.config, "global", "client_io_threads",
+            TransportManager.DEFAULT_IO_THREADS))
+        if not TransportManager.configure(client_io_threads):
+            raise RuntimeError("client_io_threads: %d can not be applied, "
+                               "clients were made with %d I/O threads "
+                               "already" % (client_io_threads,
+                                            TransportManager.instance()
+                                            .io_threads))
+
+        # 0 registers the instance without a lease, it then stays
+        # discoverable until it deregisters
+        self.lease_ttl = int(config_value(self.config, "global", "lease_ttl",
+                                          self.DEFAULT_LEASE_TTL))
+        self.reap_expired_instances = config_value(
+            self.config, "global", "reap_expired_instances",
+            "false").lower() in ("1", "true", "yes", "on")
+        self._lease_stop_event = threading.Event()
+        self._lease_thread = None
+        self.load_report_interval = int(config_value(
+            self.config, "global", "load_report_interval",
+            self.DEFAULT_LOAD_REPORT_INTERVAL))
+        self.in_flight = 0
+        self._recent_response_times = collections.deque(
+            maxlen=self.LOAD_WINDOW_SIZE)
+        self._worker_procs = {}
+        # per-function latency histograms, counts and sizes over the last
+        # one to two windows of stats_window milliseconds
+        self.function_stats = FunctionStats(int(config_value(
+            self.config, "global", "stats_window",
+            FunctionStats.DEFAULT_WINDOW)))
+        # slowest requests of the current window, returned by the slowlog
+        # function
+        self.slowlog = SlowLog(int(config_value(
+            self.config, "global", "slowlog_size", SlowLog.DEFAULT_SIZE)),
+            self.function_stats.window)
+        # on-demand stack sampling or cProfile of requests, started by the
+        # profile function
+        self.profiler = Profiler(self.logger)
+        # top allocation sites or object counts, and live clients, sockets
+        # and protobuf messages, returned by the heapprofile function
+        self.heap_profiler = HeapProfiler(self.logger)
+        # share of responses whose header carries the queue, handler and
+        # CPU time of the request
+        self.timing_sample_rate = float(config_value(
+            self.config, "global", "timing_sample_rate", 0))
+        self._load_stop_event = threading.Event()
+        self._load_thread = None
+        # control functions are served on a socket of their own, by their
+        # own thread, so they never wait behind data requests
+        self.control_socket_enabled = config_value(
+            self.config, "global", "control_socket",
+            "true").lower() in ("1", "true", "yes", "on")
+        self.control_port = None
+        self.control_socket = None
+        self._control_thread = None
+        self._control_stop_event = threading.Event()
+        # set to make the IO loop stop the service, e.g. by a stop request
+        # on the control socket
+        self._stop_event = threading.Event()
+
         self._registry = RedisServiceRegistry(
             **redis_config_from_config_file(
                 self.config, "redis_service_registry",
@@ -162,7 +292,7 @@ class Service(object):
         try:
             self._setup_sockets()
             self._setup_message_handlers()
-            self._registry.register_service({
+            self._service_map = {
                 'name': self.name,
                 'env': self.env,
                 'guid': self.guid,
@@ -173,8 +303,14 @@ class Service(object):
                 'connect_method': self.connect_method,
                 'functions': json.dumps(self.functions),
                 'start_time': json.dumps(self.start_time),
-                'alive': json.dumps(True)
-            })
+                'alive': json.dumps(True),
+                'workers': json.dumps(self.num_workers)
+            }
+            if self.control_port is not None:
+                self._service_map['control_port'] = self.control_port
+                self._service_map['ports'] = json.dumps([self.control_port])
+            self._registry.register_service(self._service_map,
+                                            lease_ttl=self.lease_ttl or None)
         except Exception as exception:
             import traceback
             self.log('error', 'Error while registering service: %s' %
@@ -188,9 +324,31 @@ class Service(object):
     def _setup_sockets(self):
         self._poller = zmq.Poller()
         self._ports = {}
-        self._context = zmq.Context()
+        if self.io_loop == "gevent":
+            from zmq import green
+            self._context = green.Context()
+        else:
+            self._context = zmq.Context()
         self.port, self.socket = self._get_socket_for_service()
         self._poller.register(self.socket, zmq.POLLIN)
+        if self.control_socket_enabled:
+            self.control_port, self.control_socket = \
+                self._get_control_socket()
+
+    def _get_control_socket(self):
+        """
+        The control socket is a ROUTER always bound on a port of its own,
+        made in the context of the service like the data socket. It is
+        served, and closed, by the control thread, or greenlet with the
+        gevent IO loop.
+        """
+        port = self._registry.next_available_port(self.name, self.guid,
+                                                  self.host)
+        connect_string = self.BASE_TCP_ADDR % ("*", port)
+        socket = self._context.socket(zmq.ROUTER)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.bind(connect_string)
+        return port, socket
 
     def _get_socket_for_service(self):
         port = self._registry.next_available_port(self.name, self.guid,
@@ -221,25 +379,114 @@ class Service(object):
             "*" if self.connect_method == "bind" else self.host, port
         )
 
-        socket = zmq_socket_from_socket_type(self._context, self.socket_type)
+        use_router = self.num_workers or self.io_loop == "gevent"
+        if use_router and self.socket_type != "REP":
+            raise RuntimeError(
+                "Socket type %s can not be used with workers or the gevent "
+                "IO loop, only REP is supported" % self.socket_type)
+
+        # in worker mode and with the gevent IO loop the public socket is a
+        # ROUTER, which talks to the same REQ clients as a REP socket does
+        socket = zmq_socket_from_socket_type(
+            self._context, "ROUTER" if use_router else self.socket_type)
 
         getattr(socket, self.connect_method)(connect_string)
         return port, socket
 
     def _setup_message_handlers(self):
-        for function, handler_class in self.MESSAGE_HANDLERS.items():
-            self._message_handlers[function] = handler_class(
-                self, function, self.socket, logger=self.logger
-            )
+        self._message_handlers = self._create_message_handlers(self.socket)
+        for function, handler in self._message_handlers.items():
             self.logger.debug("Registered handler: service: %s, function: %s, "
                               "handler: %s", self.name, function,
-                              handler_class.__name__)
+                              handler.__class__.__name__)
+
+    def _create_message_handlers(self, socket):
+        handlers = {}
+        for function, handler_class in self.MESSAGE_HANDLERS.items():
+            handlers[function] = handler_class(
+                self, function, socket, logger=self.logger
+            )
+        return handlers
+
+    def _record_stats(self, function, response_processing_time, success,
+                      request_size=0, response_size=0, phases=None,
+                      cpu_time=None, request_guid=None, client=None):
+        self.function_stats.record(function, response_processing_time,
+                                   success, request_size, response_size,
+                                   phases, cpu_time)
+        if function not in self.DEFAULT_FUNCTION_MESSAGE_HANDLERS:
+            self._recent_response_times.append(response_processing_time)
+            self.slowlog.record(function, response_processing_time,
+                                request_guid, client, request_size,
+                                response_size, phases, cpu_time)
+        if success:
+            self.stats['num_success'] += 1
+        else:
+            self.stats['num_error'] += 1
+        self.stats['last_response_time'] = response_processing_time
+        self.stats['max_response_time'] = max(
+            self.stats['max_response_time'],
+            response_processing_time
+        )
+        if self.stats['min_response_time'] == 0:
+            self.stats['min_response_time'] = response_processing_time
+        else:
+            self.stats['min_response_time'] = min(
+                self.stats['min_response_time'],
+                response_processing_time
+            )
+        # in worker mode num_messages also counts requests still in flight
+        num_processed = self.stats['num_success'] + self.stats['num_error']
+        self.stats['avg_response_time'] = (
+            response_processing_time +
+            ((num_processed - 1) * self.stats['avg_response_time'])
+        )/float(num_processed)
+
+    def _handle_message(self, handlers, function, request, timer=None):
+        """
+        Runs the handler of a function and returns a tuple of (response,
+        success, response processing time in microseconds)
+
+        :param timer: PhaseTimer of the request, started when it arrived.
+        The time until the handler runs is its queue phase.
+        """
+        if timer is None:
+            timer = PhaseTimer()
+        timer.mark('queue')
+        timer.sampled = self.timing_sample_rate > 0 and \
+            random.random() < self.timing_sample_rate
+        timer.start()
+        response_start_time = monotonic_time()
+        try:
+            # None unless a cprofile session runs, which leaves out the
+            # default functions
+            request_profiler = self.profiler.request_profiler
+            if request_profiler is None or \
+                    function in self.DEFAULT_FUNCTION_MESSAGE_HANDLERS:
+                response = handlers[function].handle(request)
+            else:
+                response = request_profiler.call(handlers[function].handle,
+                                                 request)
+            success = True
+        except Exception:
+            response = 'empty response'
+            success = False
+            import traceback
+            self.log('error', 'Error while processing request for '
+                              'function: %s. Traceback: %s' %
+                     (function, traceback.format_exc()))
+        finally:
+            timer.stop()
+        # handlers of protobuf messages mark their own phases
+        if timer.phases[-1][0] == 'queue':
+            timer.mark('handle')
+        return response, success, monotonic_time() - response_start_time
 
     def _run(self):
-        while True:
+        while not self._stop_event.is_set():
             try:
                 # self.logger.debug("poller: %s", self._poller)
-                socks = dict(self._poller.poll())
+                socks = dict(self._poller.poll(self.WORKER_POLL_TIMEOUT))
             except KeyboardInterrupt as e:
                 raise e
             except Exception as e:
@@ -247,54 +494,600 @@ class Service(object):
                 raise e
 
             if self.socket in socks:
+                timer = PhaseTimer()
                 function, request = self.socket.recv_multipart()
+                timer.mark('recv')
                 function = function if function in self._message_handlers \
                     else 'default'
                 self.function_deque.appendleft(function)
                 if function != 'heartbeat':
                     self.logger.debug("Received RPC for function: %s", function)
                 self.stats['num_messages'] += 1
-                response_start_time = current_timestamp()
-                try:
-                    response = self._message_handlers[function].handle(request)
-                    self.stats['num_success'] += 1
-                except Exception:
-                    response = 'empty response'
-                    self.stats['num_error'] += 1
-                    import traceback
-                    self.log('error', 'Error while processing request for '
-                                      'function: %s. Traceback: %s' %
-                             (function, traceback.format_exc()))
-                response_processing_time = current_timestamp() - \
-                    response_start_time
-                self.stats['last_response_time'] = response_processing_time
-                self.stats['max_response_time'] = max(
-                    self.stats['max_response_time'],
-                    response_processing_time
-                )
-                if self.stats['min_response_time'] == 0:
-                    self.stats['min_response_time'] = response_processing_time
-                else:
-                    self.stats['min_response_time'] = min(
-                        self.stats['min_response_time'],
-                        response_processing_time
-                    )
-                self.stats['avg_response_time'] = (
-                    response_processing_time +
-                    ((self.stats['num_messages'] - 1) * self.stats[
-                        'avg_response_time'])
-                )/float(self.stats['num_messages'])
+                self.in_flight = 1
+                response, success, response_processing_time = \
+                    self._handle_message(self._message_handlers, function,
+                                         request, timer)
 
                 self.socket.send(response)
+                timer.mark('send')
+                self.in_flight = 0
+                self._record_stats(function, response_processing_time,
+                                   success, len(request), len(response),
+                                   timer.phases, timer.cpu_time,
+                                   timer.request_guid, timer.client)
 
                 if function == 'stop':
                     raise StopServiceError()
+        raise StopServiceError()
+
+    def _start_control_loop(self):
+        if self.control_socket is None:
+            return
+        if self.io_loop == "gevent":
+            import gevent
+            self._control_thread = gevent.spawn(self._run_control)
+            return
+        self._control_thread = threading.Thread(target=self._run_control,
+                                                name='control-loop')
+        self._control_thread.daemon = True
+        self._control_thread.start()
+
+    def _run_control(self):
+        """
+        Loop of the control socket, serves the control functions only.
+        Its requests are not counted in stats, which describe data traffic.
+        """
+        handlers = self._create_message_handlers(self.control_socket)
+        while not self._control_stop_event.is_set():
+            try:
+                if not self.control_socket.poll(self.WORKER_POLL_TIMEOUT):
+                    continue
+                frames = self.control_socket.recv_multipart()
+                envelope, body = split_envelope(frames)
+                function, request = (body + ['', ''])[:2]
+                if function not in self.CONTROL_FUNCTIONS:
+                    function = 'default'
+                response, success, response_processing_time = \
+                    self._handle_message(handlers, function, request)
+                self.control_socket.send_multipart(envelope + [response])
+                if function == 'stop':
+                    self._stop_event.set()
+            except zmq.error.ContextTerminated:
+                break
+            except Exception as exception:
+                self.log('error', 'Error in control loop of %s service. '
+                                  'Error: %r' % (self.name, exception))
+        # the socket is closed by the thread using it
+        self._close_control_socket()
+
+    def _close_control_socket(self):
+        socket, self.control_socket = self.control_socket, None
+        if socket is not None:
+            socket.close()
+
+    def _stop_control_loop(self):
+        self._control_stop_event.set()
+        if self._control_thread is None:
+            # never served, no other thread uses the socket
+            self._close_control_socket()
+            return
+        self._control_thread.join(self.WORKER_JOIN_TIMEOUT)
+        if self.io_loop == "gevent":
+            alive = not self._control_thread.dead
+        else:
+            alive = self._control_thread.is_alive()
+        if alive:
+            self.log('error', 'control loop of %s service did not stop in '
+                              'time, its socket is left open' % self.name)
+        self._control_thread = None
+
+    def _start_lease_renewer(self):
+        if not self.lease_ttl:
+            return
+        self._lease_thread = threading.Thread(target=self._renew_lease,
+                                              name='lease-renewer')
+        self._lease_thread.daemon = True
+        self._lease_thread.start()
+
+    def _renew_lease(self):
+        """
+        Renews the lease of the instance LEASE_RENEWALS_PER_TTL times per
+        lease_ttl, so a few failed renewals do not let it expire. An
+        instance which was reaped, e.g. after a long stall, registers again.
+        Reaps expired instances of the service if reap_expired_instances.
+        """
+        interval = self.lease_ttl / 1000.0 / self.LEASE_RENEWALS_PER_TTL
+        while not self._lease_stop_event.wait(interval):
+            try:
+                if not self._registry.renew_lease(self.name, self.guid,
+                                                  self.lease_ttl):
+                    self.log('error', 'instance: %s of %s service was '
+                                      'deregistered, registering again' %
+                             (self.guid, self.name))
+                    self._registry.register_service(
+                        self._service_map, lease_ttl=self.lease_ttl)
+                if self.reap_expired_instances:
+                    for service_name, guid in \
+                            self._registry.reap_expired_instances(
+                                [self.name]):
+                        self.log('info', 'reaped instance: %s of %s service '
+                                         'whose lease ran out' %
+                                 (guid, service_name))
+            except Exception as exception:
+                self.log('error', 'Error while renewing lease of %s '
+                                  'service. Error: %r' %
+                         (self.name, exception))
+
+    def _stop_lease_renewer(self):
+        self._lease_stop_event.set()
+        if self._lease_thread is not None:
+            self._lease_thread.join()
+            self._lease_thread = None
+
+    def concurrency(self):
+        """
+        :return: number of requests the instance handles at once
+        """
+        if self.io_loop == "gevent":
+            return self.max_concurrency
+        return self.num_workers or 1
+
+    def _cpu_percent(self):
+        """
+        :return: CPU use of the instance and its worker processes since the
+        last call, 100 per fully used core
+        """
+        cpu = self.proc.cpu_percent(interval=None)
+        if self.worker_type != "process" or not self.num_workers:
+            return cpu
+        worker_procs = {}
+        for child in self.proc.children():
+            proc = self._worker_procs.get(child.pid, child)
+            try:
+                cpu += proc.cpu_percent(interval=None)
+            except psutil.Error:
+                continue
+            worker_procs[child.pid] = proc
+        self._worker_procs = worker_procs
+        return cpu
+
+    def load(self):
+        """
+        :return: dict of the load figures published to the registry:
+        requests in flight, requests queued for a worker, concurrency,
+        p50 and p99 of the latest response times in microseconds, and CPU
+        """
+        response_times = sorted(self._recent_response_times)
+        p50 = p99 = None
+        if response_times:
+            p50 = response_times[len(response_times) * 50 // 100]
+            p99 = response_times[min(len(response_times) - 1,
+                                     len(response_times) * 99 // 100)]
+        concurrency = self.concurrency()
+        return {
+            'in_flight': self.in_flight,
+            'queue_depth': max(0, self.in_flight - concurrency),
+            'concurrency': concurrency,
+            'p50': p50,
+            'p99': p99,
+            'cpu': round(self._cpu_percent(), 1),
+            'time': current_timestamp(seconds=True)
+        }
+
+    def _start_load_reporter(self):
+        if not self.load_report_interval:
+            return
+        self._load_thread = threading.Thread(target=self._report_load,
+                                             name='load-reporter')
+        self._load_thread.daemon = True
+        self._load_thread.start()
+
+    @classmethod
+    def _load_changed(cls, load, published):
+        """
+        :return: whether load differs materially from the load published
+        with the latest update event
+        """
+        if published is None:
+            return True
+        if abs(spare_capacity(load) - spare_capacity(published)) >= \
+                cls.LOAD_CHANGE_SPARE_CAPACITY:
+            return True
+        p99, published_p99 = load['p99'], published['p99']
+        if p99 is None or published_p99 is None:
+            return p99 != published_p99
+        return max(p99, published_p99) > \
+            cls.LOAD_CHANGE_P99_FACTOR * max(1, min(p99, published_p99))
+
+    def _report_load(self):
+        """
+        Writes the load of the instance to its registry entry every
+        load_report_interval, for load aware discovery and balancing.
+        Watchers are sent an update event only when the load changed
+        materially, an idle fleet causes no reloads.
+        """
+        self._cpu_percent()
+        published = None
+        while not self._load_stop_event.wait(
+                self.load_report_interval / 1000.0):
+            try:
+                load = self.load()
+                notify = self._load_changed(load, published)
+                if self._registry.update_service(
+                        self.name, self.guid, {'load': json.dumps(load)},
+                        notify=notify) and notify:
+                    published = load
+            except Exception as exception:
+                self.log('error', 'Error while publishing load of %s '
+                                  'service. Error: %r' %
+                         (self.name, exception))
+
+    def _stop_load_reporter(self):
+        self._load_stop_event.set()
+        if self._load_thread is not None:
+            self._load_thread.join()
+            self._load_thread = None
+
+    def _worker_endpoint(self, purpose):
+        if self.worker_type == "thread":
+            return "inproc://%s-%s-%s" % (self.name, self.guid, purpose)
+        return "ipc://%s/%s-%s-%s.ipc" % (tempfile.gettempdir(), self.name,
+                                          self.guid, purpose)
+
+    def _start_workers(self):
+        self._backend_endpoint = self._worker_endpoint("workers")
+        self._stats_endpoint = self._worker_endpoint("stats")
+        # requests are routed to a worker of the frontend's choice, so the
+        # requests a dead worker took are known
+        self._backend = self._context.socket(zmq.ROUTER)
+        self._backend.setsockopt(zmq.ROUTER_MANDATORY, 1)
+        self._backend.bind(self._backend_endpoint)
+        self._stats_socket = self._context.socket(zmq.PULL)
+        self._stats_socket.bind(self._stats_endpoint)
+
+        if self.worker_type == "thread":
+            self._workers_stop_event = threading.Event()
+        else:
+            self._workers_stop_event = multiprocessing.Event()
+
+        for worker_id in range(self.num_workers):
+            self._workers.append(None)
+            self._worker_identities.append(None)
+            self._start_worker(worker_id)
+
+    def _start_worker(self, worker_id):
+        name = '%s-worker-%d' % (self.name, worker_id)
+        # a respawned worker gets a new identity, late answers of the dead
+        # one are not counted for it
+        self._num_worker_starts += 1
+        identity = '%d-%d' % (worker_id, self._num_worker_starts)
+        if self.worker_type == "thread":
+            worker = threading.Thread(target=self._run_worker, name=name,
+                                      args=(worker_id, identity,
+                                            self._context))
+            worker.daemon = True
+        else:
+            worker = multiprocessing.Process(target=self._run_worker,
+                                             name=name,
+                                             args=(worker_id, identity))
+        worker.start()
+        self._workers[worker_id] = worker
+        self._worker_identities[worker_id] = identity
+        self.log('debug', 'started %s worker: %s' % (self.worker_type, name))
+
+    def _run_worker(self, worker_id, identity, context=None):
+        """
+        Loop of a single worker. Requests arrive over the ROUTER backend on a
+        DEALER socket, a stats record for every request is pushed back to the
+        frontend loop, which owns stats and the function deque.
+        """
+        parent_pid = None
+        if context is None:
+            # process worker, the parent's context can not be used after
+            # fork. SIGINT is left to the parent, which stops the workers.
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            parent_pid = os.getppid()
+            context = zmq.Context()
+        # a DEALER rather than a REP, it tells the frontend it is ready,
+        # which only then routes requests to it
+        socket = context.socket(zmq.DEALER)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.setsockopt(zmq.IDENTITY, identity)
+        socket.connect(self._backend_endpoint)
+        socket.send(self.WORKER_READY)
+        stats_socket = context.socket(zmq.PUSH)
+        stats_socket.setsockopt(zmq.LINGER, self.WORKER_DRAIN_TIMEOUT)
+        stats_socket.connect(self._stats_endpoint)
+        handlers = self._create_message_handlers(socket)
+        poller = zmq.Poller()
+        poller.register(socket, zmq.POLLIN)
+        try:
+            while not self._workers_stop_event.is_set():
+                if not poller.poll(self.WORKER_POLL_TIMEOUT):
+                    if parent_pid is not None and os.getppid() != parent_pid:
+                        self.log('error', 'parent of worker %d of %s service '
+                                          'is gone, stopping' %
+                                 (worker_id, self.name))
+                        break
+                    continue
+                envelope, body = split_envelope(socket.recv_multipart())
+                function, request = (body + ['', ''])[:2]
+                # the frontend appends the monotonic time the request
+                # arrived at, the clock is shared by the processes of a host
+                timer = PhaseTimer(int(body[2]) if len(body) > 2 else None)
+                function = function if function in handlers else 'default'
+                response, success, response_processing_time = \
+                    self._handle_message(handlers, function, request, timer)
+                socket.send_multipart(envelope + [response])
+                timer.mark('send')
+                stats_socket.send_multipart([
+                    function, str(response_processing_time),
+                    '1' if success else '0', str(len(request)),
+                    str(len(response)), json.dumps(timer.phases),
+                    '' if timer.cpu_time is None else str(timer.cpu_time),
+                    (timer.request_guid or u'').encode('utf-8'),
+                    (timer.client or u'').encode('utf-8')
+                ])
+        except Exception as exception:
+            self.log('error', 'worker %d of %s service crashed. Error: %r' %
+                     (worker_id, self.name, exception))
+        finally:
+            socket.close()
+            stats_socket.close()
+            if self.worker_type == "process":
+                context.term()
+
+    def _supervise_workers(self):
+        """
+        Respawns workers which have died, e.g. a process worker killed by the
+        OOM killer. Requests in flight on a dead worker are lost, and no
+        longer counted in flight.
+        """
+        for worker_id, worker in enumerate(self._workers):
+            if worker.is_alive():
+                continue
+            lost = self._worker_requests.pop(
+                self._worker_identities[worker_id], 0)
+            self.in_flight -= lost
+            self.log('error', 'worker %s of %s service died (exit code: %s) '
+                              'with %d requests in flight, respawning it' %
+                     (worker.name, self.name,
+                      getattr(worker, 'exitcode', None), lost))
+            self._start_worker(worker_id)
+
+    def _forward_to_worker(self, frames):
+        """
+        Sends a request to the ready worker with the fewest requests in
+        flight
+
+        :return: whether a worker took it
+        """
+        for identity in sorted(self._worker_requests,
+                               key=self._worker_requests.get):
+            try:
+                self._backend.send_multipart([identity] + frames,
+                                             zmq.NOBLOCK)
+            except zmq.error.ZMQError:
+                # gone, or its queue is full
+                continue
+            self._worker_requests[identity] += 1
+            self.in_flight += 1
+            return True
+        return False
+
+    def _stop_workers(self):
+        if not self._workers:
+            return
+        self._workers_stop_event.set()
+        for worker in self._workers:
+            worker.join(self.WORKER_JOIN_TIMEOUT)
+            if self.worker_type == "process" and worker.is_alive():
+                self.log('error', 'worker %s did not stop, terminating it' %
+                         worker.name)
+                worker.terminate()
+        self._workers = []
+        self._worker_identities = []
+        self._worker_requests = {}
+        self._backend.close()
+        self._stats_socket.close()
+        self.log('debug', 'stopped all workers of %s service' % self.name)
+
+    def _collect_worker_stats(self):
+        while True:
+            try:
+                function, response_processing_time, success, \
+                    request_size, response_size, phases, cpu_time, \
+                    request_guid, client = \
+                    self._stats_socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.error.Again:
+                return
+            self._record_stats(function, int(response_processing_time),
+                               success == '1', int(request_size),
+                               int(response_size), json.loads(phases),
+                               int(cpu_time) if cpu_time else None,
+                               request_guid.decode('utf-8') or None,
+                               client.decode('utf-8') or None)
+
+    def _run_with_workers(self):
+        """
+        Frontend loop of worker mode. Requests for data functions are
+        forwarded to the workers, default functions (heartbeat, healthcheck,
+        description and stop) are answered here, as this loop sees the
+        aggregated stats of all workers.
+        """
+        self._start_workers()
+        self._poller.register(self._backend, zmq.POLLIN)
+        self._poller.register(self._stats_socket, zmq.POLLIN)
+
+        self.in_flight = 0
+        # requests no worker could take yet, e.g. before a worker was
+        # ready
+        backlog = collections.deque()
+        drain_deadline = None
+        next_supervise_time = current_timestamp(milliseconds=True) + \
+            self.WORKER_SUPERVISE_INTERVAL
+        while drain_deadline is None or \
+                ((self.in_flight > 0 or backlog) and
+                 current_timestamp(milliseconds=True) < drain_deadline):
+            try:
+                socks = dict(self._poller.poll(self.WORKER_POLL_TIMEOUT))
+            except KeyboardInterrupt as e:
+                raise e
+            except Exception as e:
+                self.logger.error(e)
+                raise e
+
+            if self._stats_socket in socks:
+                self._collect_worker_stats()
+
+            if drain_deadline is None and self._stop_event.is_set():
+                self._poller.unregister(self.socket)
+                drain_deadline = current_timestamp(milliseconds=True) + \
+                    self.WORKER_DRAIN_TIMEOUT
+
+            now = current_timestamp(milliseconds=True)
+            if drain_deadline is None and now >= next_supervise_time:
+                self._supervise_workers()
+                next_supervise_time = now + self.WORKER_SUPERVISE_INTERVAL
+
+            if self._backend in socks:
+                while True:
+                    try:
+                        frames = self._backend.recv_multipart(zmq.NOBLOCK)
+                    except zmq.error.Again:
+                        break
+                    identity = frames[0]
+                    if frames[1:] == [self.WORKER_READY]:
+                        if identity in self._worker_identities:
+                            self._worker_requests.setdefault(identity, 0)
+                        continue
+                    # answers of a worker which died were counted already
+                    if identity in self._worker_requests:
+                        self._worker_requests[identity] -= 1
+                        self.in_flight -= 1
+                    self.socket.send_multipart(frames[1:])
+
+            while backlog and self._forward_to_worker(backlog[0]):
+                backlog.popleft()
+
+            if self.socket in socks and drain_deadline is None:
+                timer = PhaseTimer()
+                frames = self.socket.recv_multipart()
+                timer.mark('recv')
+                envelope, body = split_envelope(frames)
+                function, request = (body + ['', ''])[:2]
+                function = function if function in self._message_handlers \
+                    else 'default'
+                self.function_deque.appendleft(function)
+                if function != 'heartbeat':
+                    self.logger.debug("Received RPC for function: %s",
+                                      function)
+                self.stats['num_messages'] += 1
+                if function in self.DEFAULT_FUNCTION_MESSAGE_HANDLERS:
+                    self._collect_worker_stats()
+                    response, success, response_processing_time = \
+                        self._handle_message(self._message_handlers, function,
+                                             request, timer)
+                    self.socket.send_multipart(envelope + [response])
+                    timer.mark('send')
+                    self._record_stats(function, response_processing_time,
+                                       success, len(request), len(response),
+                                       timer.phases, timer.cpu_time,
+                                       timer.request_guid, timer.client)
+                    if function == 'stop':
+                        self._poller.unregister(self.socket)
+                        drain_deadline = current_timestamp(
+                            milliseconds=True) + self.WORKER_DRAIN_TIMEOUT
+                else:
+                    frames = frames + [str(timer.start_time)]
+                    if backlog or not self._forward_to_worker(frames):
+                        backlog.append(frames)
+
+        if self.in_flight > 0 or backlog:
+            self.log('error', '%d requests still in flight after draining '
+                              'workers of %s service' %
+                     (self.in_flight + len(backlog), self.name))
+        raise StopServiceError()
+
+    def _run_cooperative(self):
+        """
+        gevent based loop, every request is handled in its own greenlet, so
+        many I/O bound requests can be in flight at once. Handlers marked as
+        COOPERATIVE run on the loop itself and must only do gevent friendly
+        I/O (gevent.monkey patched stdlib, zmq.green sockets), all other
+        handlers run in gevent's thread pool.
+        """
+        try:
+            import gevent
+            import gevent.event
+            import gevent.lock
+            import gevent.pool
+        except ImportError:
+            raise RuntimeError('gevent must be installed to use the gevent '
+                               'IO loop')
+
+        gevent.get_hub().threadpool.maxsize = self.executor_threads
+        pool = gevent.pool.Pool(self.max_concurrency)
+        send_lock = gevent.lock.Semaphore()
+        stopping = gevent.event.Event()
+
+        def _handle_request(frames, timer):
+            envelope, body = split_envelope(frames)
+            function, request = (body + ['', ''])[:2]
+            function = function if function in self._message_handlers \
+                else 'default'
+            self.function_deque.appendleft(function)
+            if function != 'heartbeat':
+                self.logger.debug("Received RPC for function: %s", function)
+            self.stats['num_messages'] += 1
+            self.in_flight += 1
+            if getattr(self._message_handlers[function], 'COOPERATIVE', False):
+                response, success, response_processing_time = \
+                    self._handle_message(self._message_handlers, function,
+                                         request, timer)
+            else:
+                response, success, response_processing_time = \
+                    gevent.get_hub().threadpool.apply(
+                        self._handle_message,
+                        (self._message_handlers, function, request, timer))
+            with send_lock:
+                self.socket.send_multipart(envelope + [response])
+            timer.mark('send')
+            self.in_flight -= 1
+            self._record_stats(function, response_processing_time, success,
+                               len(request), len(response), timer.phases,
+                               timer.cpu_time, timer.request_guid,
+                               timer.client)
+            if function == 'stop':
+                stopping.set()
+
+        while not stopping.is_set() and not self._stop_event.is_set():
+            if not self.socket.poll(self.WORKER_POLL_TIMEOUT):
+                continue
+            timer = PhaseTimer()
+            frames = self.socket.recv_multipart()
+            timer.mark('recv')
+            # blocks while max_concurrency requests are in flight
+            pool.spawn(_handle_request, frames, timer)
+
+        if not pool.join(timeout=self.WORKER_DRAIN_TIMEOUT / 1000.0):
+            self.log('error', '%d requests still in flight after draining '
+                              '%s service' % (len(pool), self.name))
+        raise StopServiceError()
 
     def run(self):
         if not self.config:
             raise RuntimeError('A config file must be specified')
+        self._start_lease_renewer()
+        self._start_load_reporter()
+        self._start_control_loop()
         try:
-            self._run()
+            if self.io_loop == "gevent":
+                self._run_cooperative()
+            elif self.num_workers:
+                self._run_with_workers()
+            else:
+                self._run()
         except StopServiceError:
             self.logger.debug("Stopping :%s service in response to STOP "
                               "message.")
@@ -306,6 +1099,10 @@ class Service(object):
                               "%s", exception.__class__.__name__, ", ".join(
                               exception.args), str(exception))
         finally:
+            self._stop_control_loop()
+            self._stop_lease_renewer()
+            self._stop_load_reporter()
+            self._stop_workers()
             self._registry.deregister_service(self.name, self.guid, self.host)
             try:
                 os.remove(self.pid_file)
@@ -321,13 +1118,16 @@ class Service(object):
             description="User management service")
         argparser.add_argument("-c", "--config_file", required=True,
                                help="config file")
+        argparser.add_argument("-w", "--workers", type=int, default=None,
+                               help="number of pre-forked worker processes "
+                                    "serving the registered endpoint")
         return argparser
 
     def run_service(self):
         set_time_zone()
         parser = self.get_cmd_line_parser()
         args = parser.parse_args()
-        self._set_config(args.config_file)
+        self._set_config(args.config_file, workers=args.workers)
         if not os.path.exists(self.pid_dir_path):
             os.makedirs(self.pid_dir_path)
         f = open(self.pid_file, 'w')
@@ -338,10 +1138,12 @@ class Service(object):
             'guid': self.guid,
             'host': self.host,
             'port': self.port,
+            'control_port': self.control_port,
             'socket_type': self.socket_type,
             'connect_method': self.connect_method,
             'functions': self.functions,
             'start_time': self.start_time,
+            'workers': self.num_workers,
             'cmdline': self.proc.cmdline()
         }, indent=4))
         f.close()
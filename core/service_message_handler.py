@@ -3,6 +3,9 @@ Module provides following: -
     - holds definition of abstract base class to represent message handler
     - provides default implementation of heartbeat handler
     - provides default implementation of description handler
+    - provides default implementation of slowlog handler
+    - provides default implementation of profile handler
+    - provides default implementation of heap profile handler
 """
 
 import datetime
@@ -10,7 +13,10 @@ import json
 import psutil
 import os
 
-from common.utils import current_timestamp
+from common.utils import monotonic_time
+
+from core.function_stats import PhaseTimer
+from core.profiler import HeapProfiler, Profiler, ProfilerError
 
 from core.error import StopServiceError, \
     BadServiceRequestError, BadServiceMessageHandlerError
@@ -22,6 +28,10 @@ class ServiceMessageHandler(object):
     abstract base class to provide message handler interface
     """
 
+    # with the gevent IO loop, cooperative handlers run on the loop and
+    # must not block it, all others run in a thread pool
+    COOPERATIVE = False
+
     def __init__(self, service, socket_name, socket, logger=None,
                  is_proto=True):
         self._service = service
@@ -61,7 +71,10 @@ class ServiceMessageHandler(object):
         pass
 
     def handle(self, message):
-        request_start_time = current_timestamp()
+        request_start_time = monotonic_time()
+        # the timer of the request, taken before _handle can yield to
+        # another greenlet
+        timer = PhaseTimer.current()
         response = self.response_class()
         request_guid = None
         request_client = None
@@ -75,18 +88,30 @@ class ServiceMessageHandler(object):
             except Exception as exception:
                 raise BadServiceRequestError(exception)
             else:
+                if timer is not None:
+                    timer.mark('parse')
+                    timer.request_guid = request_guid
+                    timer.client = request_client
                 self._validate_request(request)
+                if timer is not None:
+                    timer.mark('validate')
                 self.log('info', '%s of %s service got request guid %s, '
                                  'from client: %s' %
                          (self.__class__.__name__, self._service.name,
                          request.header.request_guid,
                          request.header.client))
+                if timer is not None:
+                    timer.mark('log')
                 self._handle(request, response)
+                if timer is not None:
+                    timer.mark('handle')
                 response.header.success = True
                 self.log('debug', 'successfully processed request guid: %s, '
                                   'from client: %s' %
                          (request.header.request_guid,
                          request.header.client))
+                if timer is not None:
+                    timer.mark('log')
         except Exception as exception:
             import traceback
             self.log('error', 'Error while handling request. Type: %s, '
@@ -95,14 +120,26 @@ class ServiceMessageHandler(object):
                       traceback.format_exc()))
             self._response_from_exception(exception, response)
         finally:
-            response.header.response_time = current_timestamp() - \
+            response.header.response_time = monotonic_time() - \
                 request_start_time
+            if timer is not None and timer.sampled:
+                response.header.queue_time = timer.duration('recv', 'queue')
+                response.header.handler_time = timer.duration(
+                    'parse', 'validate', 'handle')
+                cpu_time = timer.cpu_time_so_far()
+                if cpu_time is not None:
+                    response.header.cpu_time = cpu_time
+            serialized = response.SerializeToString()
+            if timer is not None:
+                timer.mark('serialize')
             self.log('info', '%s of %s service took %s microseconds to '
                              'respond to request guid: %s, from client: %s' %
                      (self.__class__.__name__, self._service.name,
                      response.header.response_time, request_guid,
                      request_client))
-            return response.SerializeToString()
+            if timer is not None:
+                timer.mark('log')
+            return serialized
 
     def _response_from_exception(self, exception, response):
         response.header.success = False
@@ -123,6 +160,8 @@ class ServiceMessageHandler(object):
 
 class HeartbeatHandler(ServiceMessageHandler):
 
+    COOPERATIVE = True
+
     def __init__(self, service, socket_name, socket, logger=None):
         super(HeartbeatHandler, self).__init__(service, socket_name,
                                                socket, logger, is_proto=False)
@@ -133,6 +172,8 @@ class HeartbeatHandler(ServiceMessageHandler):
 
 class DescriptionHandler(ServiceMessageHandler):
 
+    COOPERATIVE = True
+
     def __init__(self, service, socket_name, socket, logger=None):
         super(DescriptionHandler, self).__init__(service, socket_name,
                                                  socket, logger, is_proto=False)
@@ -146,18 +187,141 @@ class DescriptionHandler(ServiceMessageHandler):
             'guid': self._service.guid,
             'host': self._service.host,
             'port': self._service.port,
+            'control_port': self._service.control_port,
             'socket_type': self._service.socket_type,
             'connect_method': self._service.connect_method,
             'functions': self._service.functions,
             'start_time': self._service.start_time,
             'function_deck': [x for x in self._service.function_deque],
-            'stats': self._service.stats
+            'stats': self._service.stats,
+            'function_stats': self._service.function_stats.to_dict(),
+            'workers': self._service.num_workers,
+            'worker_type': self._service.worker_type
         }
         return json.dumps(d)
 
 
+class SlowLogHandler(ServiceMessageHandler):
+    """
+    Returns the slowest requests of the current window, a 'reset' request
+    also clears them
+    """
+
+    COOPERATIVE = True
+
+    def __init__(self, service, socket_name, socket, logger=None):
+        super(SlowLogHandler, self).__init__(service, socket_name,
+                                             socket, logger, is_proto=False)
+
+    def handle(self, request):
+        return json.dumps(self._service.slowlog.to_dict(
+            reset=request.strip() == 'reset'))
+
+
+class ProfileHandler(ServiceMessageHandler):
+    """
+    Starts and stops profiling sessions of the service and returns their
+    result. Requests are json objects with an action of start, stop or
+    result, start also takes mode, duration, interval and every. A request
+    of just the action is taken as well.
+
+    With process workers, profile requests are served by the frontend
+    process, which serves no data requests, so only sample mode is taken
+    and it samples the frontend.
+    """
+
+    COOPERATIVE = True
+
+    def __init__(self, service, socket_name, socket, logger=None):
+        super(ProfileHandler, self).__init__(service, socket_name,
+                                             socket, logger, is_proto=False)
+
+    def handle(self, request):
+        try:
+            params = json.loads(request) if request.strip() else {}
+        except ValueError:
+            params = {'action': request.strip()}
+        if not isinstance(params, dict):
+            return json.dumps({'error': 'profile request is not an object'})
+        profiler = self._service.profiler
+        action = params.get('action', 'result')
+        try:
+            mode = params.get('mode', Profiler.DEFAULT_MODE)
+            if action == 'start' and mode == 'cprofile' and \
+                    self._service.num_workers and \
+                    self._service.worker_type == "process":
+                d = {'error': 'cprofile mode can not profile the requests '
+                              'of process workers'}
+            elif action == 'start':
+                d = profiler.start(
+                    mode,
+                    params.get('duration', Profiler.DEFAULT_DURATION),
+                    params.get('interval', Profiler.DEFAULT_INTERVAL),
+                    params.get('every', Profiler.DEFAULT_EVERY))
+                d['running'] = True
+            elif action == 'stop':
+                profiler.stop()
+                d = profiler.result()
+            elif action == 'result':
+                d = profiler.result()
+            else:
+                d = {'error': 'profile action %s not in set [start, stop, '
+                              'result]' % action}
+        except (ProfilerError, TypeError, ValueError) as e:
+            d = {'error': str(e)}
+        return json.dumps(d)
+
+
+class HeapProfileHandler(ServiceMessageHandler):
+    """
+    Returns a snapshot of the heap of the service, with its diff to the
+    previous one, and starts and stops tracing allocations. Requests are
+    json objects with an action of start, stop or snapshot, start also takes
+    frames and snapshot limit. A request of just the action is taken as
+    well.
+    """
+
+    COOPERATIVE = True
+
+    def __init__(self, service, socket_name, socket, logger=None):
+        super(HeapProfileHandler, self).__init__(service, socket_name,
+                                                 socket, logger,
+                                                 is_proto=False)
+
+    def handle(self, request):
+        try:
+            params = json.loads(request) if request.strip() else {}
+        except ValueError:
+            params = {'action': request.strip()}
+        if not isinstance(params, dict):
+            return json.dumps({'error': 'heapprofile request is not an '
+                                        'object'})
+        heap_profiler = self._service.heap_profiler
+        action = params.get('action', 'snapshot')
+        try:
+            if action == 'start':
+                heap_profiler.start(params.get('frames',
+                                               HeapProfiler.DEFAULT_FRAMES))
+                d = {'tracemalloc': heap_profiler.tracing()}
+            elif action == 'stop':
+                heap_profiler.stop()
+                d = {'tracemalloc': heap_profiler.tracing()}
+            elif action == 'snapshot':
+                d = heap_profiler.snapshot(params.get(
+                    'limit', HeapProfiler.DEFAULT_LIMIT))
+            else:
+                d = {'error': 'heapprofile action %s not in set [start, '
+                              'stop, snapshot]' % action}
+        except (ProfilerError, TypeError, ValueError) as e:
+            d = {'error': str(e)}
+        d['tracemalloc_available'] = heap_profiler.available()
+        return json.dumps(d)
+
+
 class StopServiceHandler(ServiceMessageHandler):
 
+    COOPERATIVE = True
+
     def __init__(self, service, socket_name, socket, logger=None):
         super(StopServiceHandler, self).__init__(service, socket_name,
                                                  socket, logger, is_proto=False)
@@ -168,6 +332,8 @@ class StopServiceHandler(ServiceMessageHandler):
 
 class HealthCheckHandler(ServiceMessageHandler):
 
+    COOPERATIVE = True
+
     def __init__(self, service, socket_name, socket, logger=None):
         super(HealthCheckHandler, self).__init__(service, socket_name,
                                                socket, logger, is_proto=False)
@@ -181,12 +347,16 @@ class HealthCheckHandler(ServiceMessageHandler):
             'guid': self._service.guid,
             'host': self._service.host,
             'port': self._service.port,
+            'control_port': self._service.control_port,
             'socket_type': self._service.socket_type,
             'connect_method': self._service.connect_method,
             'functions': self._service.functions,
             'start_time': self._service.start_time,
             'function_deck': [x for x in self._service.function_deque],
             'stats': self._service.stats,
+            'function_stats': self._service.function_stats.to_dict(),
+            'workers': self._service.num_workers,
+            'worker_type': self._service.worker_type,
             'start_datetime': datetime.datetime.fromtimestamp(
                 self._service.start_time/1000000
             ).strftime('%Y-%m-%d %H:%M:%S'),
@@ -210,6 +380,8 @@ class HealthCheckHandler(ServiceMessageHandler):
 
 class DefaultMessageHandler(ServiceMessageHandler):
 
+    COOPERATIVE = True
+
     def __init__(self, service, socket_name, socket, logger=None):
         super(DefaultMessageHandler, self).__init__(service, socket_name,
                                                     socket, logger,
@@ -3,16 +3,29 @@ Module provides utility class to call a function on a service
 """
 
 import Queue
+import random
+import threading
+import time
 import uuid
 
+from common.utils import current_timestamp
 from core.resourcepool import ResourcePool
 
-from core.client import ServiceClient, DEFAULT_TIME_OUT, \
-    DEFAULT_MAX_TRIES, DEFAULT_SLEEP_BEFORE_RETRY
+from core.budget import TokenBudget
+from core.circuit_breaker import CircuitBreaker, BREAKER_STATES
+from core.client import ServiceClient, ServiceClientError, \
+    ServiceClientTimeoutError, DEFAULT_TIME_OUT, DEFAULT_MAX_TRIES, \
+    DEFAULT_SLEEP_BEFORE_RETRY
+from core.hedging import Hedger, DEFAULT_HEDGE_BUDGET_RATIO
+from core.load_balancer import InstanceStats, balancing_policy_from_name, \
+    RoundRobinPolicy, LoadAwarePolicy
 from core.redis_service_registry import RedisServiceRegistry
 
 
 RESOURCE_ACQUIRING_TIMEOUT = 2
+DEFAULT_MAX_SLEEP_BEFORE_RETRY = 2 * 1000  # in milliseconds
+DEFAULT_RETRY_BUDGET_RATIO = 0.1
+MIN_RETRIES_PER_SECOND = 10
 
 
 class UnknownServiceError(RuntimeError):
@@ -23,10 +36,15 @@ class ClientResourceNotAvailableError(RuntimeError):
     pass
 
 
+class CircuitOpenError(ClientResourceNotAvailableError):
+    pass
+
+
 class ServiceClientResource(object):
 
     def __init__(self, service_name, service_config, logger=None):
         self.service = service_name
+        self.retired = False
         self.client = ServiceClient(service_name,
                                     service_config=service_config,
                                     logger=logger,
@@ -38,7 +56,179 @@ class ServiceClientResource(object):
             self.service, self.client, self.good_to_use())
 
     def good_to_use(self):
-        return self.client.alive
+        return self.client.alive and not self.retired
+
+    def discard(self):
+        """
+        Closes the client, called when the pool drops it, e.g. on release
+        after it was retired while in use
+        """
+        self.client.close()
+
+
+class ServiceInstancePool(object):
+    """
+    Pool of clients of one instance (guid) of a service
+    """
+
+    def __init__(self, service_name, service_config, num_clients,
+                 logger=None):
+        self.service = service_name
+        self.config = service_config
+        self.guid = service_config['guid']
+        self.stats = InstanceStats(self.guid)
+        self.stats.load = service_config.get('load')
+        self.breaker = CircuitBreaker(service_name, self.guid, logger=logger)
+        self.num_clients = num_clients
+        self.logger = logger
+        self._resources = []
+        for i in range(num_clients):
+            self._resources.append(ServiceClientResource(
+                service_name, service_config, logger))
+        self.pool = ResourcePool(self._resources)
+
+    def __repr__(self):
+        return "ServiceInstancePool(service=%s, guid=%s, available=%d)" % (
+            self.service, self.guid, self.available())
+
+    def available(self):
+        return self.pool.available()
+
+    def top_up(self):
+        """
+        Replaces clients which have gone bad, the pool drops them on release
+
+        :return: number of clients added
+        """
+        self._resources = [x for x in self._resources if x.good_to_use()]
+        num_added = 0
+        while len(self._resources) < self.num_clients:
+            resource = ServiceClientResource(self.service, self.config,
+                                             self.logger)
+            self._resources.append(resource)
+            self.pool.release(resource)
+            num_added += 1
+        return num_added
+
+    def retire(self):
+        """
+        Closes the idle clients, clients in use are closed on release
+        """
+        for resource in self._resources:
+            resource.retired = True
+        for resource in self.pool.drain():
+            resource.client.close()
+
+
+class ServicePool(object):
+    """
+    Pools of clients of all discovered instances of a service. A load
+    balancing policy picks the instance every request goes to, among the
+    instances whose circuit breaker lets requests through.
+    """
+
+    OUTLIER_DETECTION_INTERVAL = 1000  # in milliseconds
+    OUTLIER_LATENCY_FACTOR = 5
+    OUTLIER_MIN_REQUESTS = 20
+    OUTLIER_MIN_INSTANCES = 3
+    MAX_EJECTION_PERCENT = 50
+
+    def __init__(self, service_name, instances, policy):
+        self.service = service_name
+        self.policy = policy
+        self.instances = dict((x.guid, x) for x in instances)
+        self._next_outlier_detection = 0
+        self._lock = threading.Lock()
+
+    def add_instance(self, instance):
+        # copy on write, acquire() reads instances without locking
+        with self._lock:
+            instances = dict(self.instances)
+            instances[instance.guid] = instance
+            self.instances = instances
+
+    def remove_instance(self, guid):
+        with self._lock:
+            instances = dict(self.instances)
+            instance = instances.pop(guid, None)
+            self.instances = instances
+        return instance
+
+    def __repr__(self):
+        return "ServicePool(service=%s, policy=%s, instances=%r)" % (
+            self.service, self.policy.NAME, self.instances.values())
+
+    def available(self):
+        return sum(x.available() for x in self.instances.values())
+
+    def acquire(self, timeout=None, exclude=()):
+        """
+        :param exclude: guids of instances not to choose
+        :return: tuple of (ServiceInstancePool, Resource, probe) of the
+        chosen instance, probe as returned by the acquire of its breaker
+        :raises Empty: No instance has a client available before timeout
+        :raises CircuitOpenError: The breaker of every instance refuses
+        requests
+        """
+        instances = [x for x in self.instances.values()
+                     if x.guid not in exclude]
+        if not instances:
+            raise Queue.Empty
+        instances = [x for x in instances if x.breaker.available()]
+        # instances with idle clients first, acquiring from a drained pool
+        # fails right away
+        candidates = [x for x in instances if x.available() > 0] or instances
+        while candidates:
+            by_guid = dict((x.guid, x) for x in candidates)
+            instance = by_guid[self.policy.select(
+                [x.stats for x in candidates]).guid]
+            admitted, probe = instance.breaker.acquire()
+            if admitted:
+                break
+            # half_open with every probe slot taken meanwhile
+            candidates.remove(instance)
+        else:
+            raise CircuitOpenError('breakers of all instances of %s service '
+                                   'are open' % self.service)
+        try:
+            lease = instance.pool.acquire(timeout=timeout)
+        except Queue.Empty:
+            instance.breaker.release(probe)
+            raise
+        return instance, lease, probe
+
+    def detect_outliers(self):
+        """
+        Ejects instances whose latency is a multiple of the median latency
+        of the service, at most MAX_EJECTION_PERCENT of them at a time
+        """
+        now = current_timestamp(milliseconds=True)
+        if now < self._next_outlier_detection:
+            return
+        self._next_outlier_detection = now + self.OUTLIER_DETECTION_INTERVAL
+
+        instances = self.instances.values()
+        measured = [x for x in instances
+                    if x.stats.num_requests >= self.OUTLIER_MIN_REQUESTS and
+                    x.stats.ewma_latency is not None]
+        if len(measured) < self.OUTLIER_MIN_INSTANCES:
+            return
+        latencies = sorted(x.stats.ewma_latency for x in measured)
+        median = latencies[len(latencies) // 2]
+        num_ejected = len([x for x in instances
+                           if x.breaker.state != BREAKER_STATES.CLOSED])
+        max_ejected = len(instances) * self.MAX_EJECTION_PERCENT // 100
+        for instance in measured:
+            if num_ejected >= max_ejected:
+                return
+            if instance.breaker.state != BREAKER_STATES.CLOSED:
+                continue
+            if instance.stats.ewma_latency > \
+                    self.OUTLIER_LATENCY_FACTOR * median:
+                instance.breaker.eject(
+                    'latency outlier: %d microseconds, median: %d '
+                    'microseconds' % (instance.stats.ewma_latency, median))
+                num_ejected += 1
 
 
 class ServiceMethodCaller(object):
@@ -49,53 +239,242 @@ class ServiceMethodCaller(object):
 
     DEFAULT_POOL_SIZE = 5
     CLIENTS_PER_SERVICE_CONFIG = 5
+    DEFAULT_BALANCING_POLICY = RoundRobinPolicy.NAME
+    DEFAULT_REFRESH_INTERVAL = 30 * 1000  # in milliseconds
     MOCK = False  # this is for tests
 
     def __init__(self, service_registry_redis_config, services,
-                 logger=None):
+                 logger=None, balancing_policy=DEFAULT_BALANCING_POLICY,
+                 hedged_functions=None,
+                 hedge_budget_ratio=DEFAULT_HEDGE_BUDGET_RATIO,
+                 failover=False,
+                 retry_budget_ratio=DEFAULT_RETRY_BUDGET_RATIO,
+                 max_sleep_before_retry=DEFAULT_MAX_SLEEP_BEFORE_RETRY,
+                 refresh_interval=DEFAULT_REFRESH_INTERVAL,
+                 watch_registry=False):
+        """
+        :param service_registry_redis_config: kwargs of the
+        RedisServiceRegistry, a snapshot_file among them makes discovery
+        read the host local registry snapshot
+        :param services: list of service names, or of tuples of (service
+        name, pool size, balancing policy)
+        :param balancing_policy: policy of services which do not set one,
+        one of round_robin, least_outstanding, p2c and load_aware
+        :param hedged_functions: dict of service name to read-only functions
+        whose calls are hedged by default
+        :param hedge_budget_ratio: hedges allowed per request
+        :param failover: retry a request that timed out or failed on a
+        different instance right away, instead of sleeping and retrying on
+        the same one
+        :param retry_budget_ratio: failover retries allowed per request
+        :param max_sleep_before_retry: cap of the backoff, in milliseconds,
+        once every instance failed
+        :param refresh_interval: milliseconds between rediscoveries of the
+        services in the background, which replace bad clients and follow
+        instances that come and go. 0 disables it.
+        :param watch_registry: follow the registry events of the services,
+        discovery is then answered from a local cache and pools are
+        refreshed as soon as instances come and go
+        """
 
         self._registry_redis_config = service_registry_redis_config
         self._registry = RedisServiceRegistry(**(self._registry_redis_config
                                                  or {}))
         self.logger = logger
+        self._hedged_functions = dict(
+            (k, set(v)) for k, v in (hedged_functions or {}).items())
+        self._hedger = Hedger(budget_ratio=hedge_budget_ratio)
+        self._failover = failover
+        self._retry_budget = TokenBudget(
+            retry_budget_ratio, tokens_per_second=MIN_RETRIES_PER_SECOND)
+        self._max_sleep_before_retry = max_sleep_before_retry
+        self.retry_stats = {
+            'num_retries': 0,
+            'num_backoffs': 0,
+            'num_retries_over_budget': 0
+        }
+        # callers of map and hedges count retries from many threads
+        self._retry_stats_lock = threading.Lock()
 
         if self.MOCK:
             return
 
         self._managed_services = {}
         for service in services:
+            policy = balancing_policy
             if isinstance(service, tuple) or isinstance(service, list):
                 service_name = service[0]
                 try:
                     pool_size = int(service[1])
                 except IndexError:
                     pool_size = self.DEFAULT_POOL_SIZE
+                if len(service) > 2:
+                    policy = service[2]
             else:
                 service_name = service
                 pool_size = self.DEFAULT_POOL_SIZE
-            self._managed_services[service_name] = [pool_size]
+            self._managed_services[service_name] = [pool_size, policy]
+
+        self._refresh_interval = refresh_interval
+        self._refresh_event = threading.Event()
+        self._refresh_stop_event = threading.Event()
+        self._refresh_thread = None
+        self._watcher = None
+        if watch_registry:
+            self._watcher = self._registry.watch(
+                self._managed_services.keys(), self.logger)
+            self._watcher.add_listener(self._on_registry_event)
 
         for service_name, value in self._managed_services.items():
-            self._managed_services[service_name].append(
-                self._create_service_pool(service_name, value[0])
-            )
+            self._managed_services[service_name][1] = \
+                self._create_service_pool(service_name, value[0], value[1])
+
+        if refresh_interval or watch_registry:
+            self._refresh_thread = threading.Thread(
+                target=self._run_refresher, name='service-pool-refresher')
+            self._refresh_thread.daemon = True
+            self._refresh_thread.start()
 
         self.log('debug', 'created service method caller')
 
-    def _create_service_pool(self, service_name, pool_size):
-        resources = []
-        service_configs = self._registry.discover_service(service_name,
-                                                          num=pool_size)
+    def _on_registry_event(self, event, service_name, guid):
+        if event != RedisServiceRegistry.UPDATE_EVENT:
+            self._refresh_event.set()
+            return
+        try:
+            pool = self._managed_services[service_name][1]
+            instance = pool.instances[guid]
+            config = self._watcher.services()[service_name][guid]
+        except (KeyError, TypeError):
+            return
+        instance.stats.load = config.get('load')
+
+    def _run_refresher(self):
+        interval = self._refresh_interval / 1000.0 \
+            if self._refresh_interval else None
+        while True:
+            self._refresh_event.wait(interval)
+            self._refresh_event.clear()
+            if self._refresh_stop_event.is_set():
+                break
+            self.refresh_pools()
+
+    def refresh_pools(self):
+        for service_name in self._managed_services.keys():
+            try:
+                self._refresh_service_pool(service_name)
+            except Exception as exception:
+                self.log('error', 'Error while refreshing pool of service: '
+                                  '%s. Error: %r' % (service_name, exception))
+
+    def _refresh_service_pool(self, service_name):
+        """
+        Retires the instances which are no longer registered, adds newly
+        registered ones up to the pool size, and tops up the clients of
+        every instance. Clients are created before they are added, callers
+        are never blocked.
+        """
+        pool_size, pool = self._managed_services[service_name]
+        load_aware = isinstance(pool.policy, LoadAwarePolicy)
+        registered_guids = self._registry.service_guids(service_name)
+
+        for guid in set(pool.instances.keys()) - registered_guids:
+            instance = pool.remove_instance(guid)
+            if instance is not None:
+                self.log('info', 'retiring instance: %s of %s service' %
+                         (guid, service_name))
+                instance.retire()
+
+        if len(pool.instances) < pool_size and \
+                len(registered_guids) > len(pool.instances):
+            service_configs = self._registry.discover_service(
+                service_name, num=pool_size + len(pool.instances),
+                weighted=load_aware)
+            for config in service_configs:
+                if len(pool.instances) >= pool_size:
+                    break
+                if config['guid'] in pool.instances:
+                    continue
+                self.log('info', 'adding instance: %s of %s service' %
+                         (config['guid'], service_name))
+                pool.add_instance(ServiceInstancePool(
+                    service_name, config, self.CLIENTS_PER_SERVICE_CONFIG,
+                    self.logger))
+
+        if load_aware and self._watcher is None:
+            # with a watcher, loads are updated as they are published
+            service_configs = self._registry.instance_configs(
+                service_name, pool.instances.keys())
+            for guid, config in service_configs.items():
+                instance = pool.instances.get(guid)
+                if instance is not None:
+                    instance.stats.load = config.get('load')
+
+        for instance in pool.instances.values():
+            num_added = instance.top_up()
+            if num_added:
+                self.log('info', 'added %d clients for instance: %s of %s '
+                                 'service' % (num_added, instance.guid,
+                                              service_name))
+
+    def shutdown(self):
+        """
+        stops the background refresher and closes the idle clients
+        """
+        if self.MOCK:
+            return
+        self._refresh_stop_event.set()
+        self._refresh_event.set()
+        if self._refresh_thread is not None:
+            self._refresh_thread.join()
+        self._registry.unwatch()
+        for pool_size, pool in self._managed_services.values():
+            for instance in pool.instances.values():
+                instance.retire()
+
+    def _create_service_pool(self, service_name, pool_size, policy):
+        instances = []
+        service_configs = self._registry.discover_service(
+            service_name, num=pool_size,
+            weighted=policy == LoadAwarePolicy.NAME)
         for config in service_configs:
-            for i in range(self.CLIENTS_PER_SERVICE_CONFIG):
-                self.log('debug', 'creating %d client resource for service '
-                                  'config: %s' % (i + 1, config))
-                resource = ServiceClientResource(service_name, config,
-                                                 self.logger)
-                resources.append(resource)
-
-        self.log('debug', 'created a pool of clients: %r' % resources)
-        return ResourcePool(resources)
+            self.log('debug', 'creating %d client resources for service '
+                              'config: %s' %
+                     (self.CLIENTS_PER_SERVICE_CONFIG, config))
+            instances.append(ServiceInstancePool(
+                service_name, config, self.CLIENTS_PER_SERVICE_CONFIG,
+                self.logger))
+
+        pool = ServicePool(service_name, instances,
+                           balancing_policy_from_name(policy))
+        self.log('debug', 'created a pool of clients: %r' % pool)
+        return pool
+
+    def instance_stats(self, service):
+        """
+        :return: dict of guid to request counters and latency of every
+        instance of service
+        """
+        if service not in self._managed_services:
+            raise UnknownServiceError('service: %s unknown' % service)
+        ret = {}
+        for guid, instance in \
+                self._managed_services[service][1].instances.items():
+            ret[guid] = instance.stats.to_dict()
+            ret[guid]['available'] = instance.available()
+            ret[guid]['breaker'] = instance.breaker.to_dict()
+        return ret
+
+    def breaker_states(self, service):
+        """
+        :return: dict of guid to circuit breaker state of every instance of
+        service
+        """
+        if service not in self._managed_services:
+            raise UnknownServiceError('service: %s unknown' % service)
+        return dict(
+            (guid, instance.breaker.to_dict()) for guid, instance in
+            self._managed_services[service][1].instances.items())
 
     def log(self, level, message):
         try:
@@ -115,7 +494,8 @@ class ServiceMethodCaller(object):
 
     def __call__(self, method, service, request, response_class=None,
                  timeout=DEFAULT_TIME_OUT, max_tries=DEFAULT_MAX_TRIES,
-                 sleep_before_retry=DEFAULT_SLEEP_BEFORE_RETRY):
+                 sleep_before_retry=DEFAULT_SLEEP_BEFORE_RETRY,
+                 hedge=None, hedge_delay=None, failover=None):
         """
         calls function 'method' on service 'service'
 
@@ -123,6 +503,14 @@ class ServiceMethodCaller(object):
         :param service:
         :param request:
         :param response_class:
+        :param hedge: if the request is slow, send a duplicate to another
+        instance, only safe for read-only functions. Defaults to whether
+        method is one of the hedged functions of service.
+        :param hedge_delay: microseconds to wait before hedging, defaults to
+        the observed p95 latency of method
+        :param failover: retry on a different instance right away, defaults
+        to the failover setting of the caller. A hedged call fails over
+        from the instance of the request and of the hedge alike.
         :return:
         """
 
@@ -132,35 +520,58 @@ class ServiceMethodCaller(object):
         if service not in self._managed_services:
             raise UnknownServiceError('service: %s unknown' % service)
 
+        if hedge is None:
+            hedge = method in self._hedged_functions.get(service, ())
+        if failover is None:
+            failover = self._failover
+
         try:
+            if hasattr(request, 'SerializeToString'):
+                request.header.request_guid = str(uuid.uuid4())
+                self.log('info', 'calling %s method on %s service '
+                                 'with request guid: %s' %
+                         (method, service,
+                          request.header.request_guid))
+                request_message = request.SerializeToString()
+            else:
+                request_message = str(request)
+
             pool = self._managed_services[service][1]
-            with pool.acquire(timeout=RESOURCE_ACQUIRING_TIMEOUT) as resource:
-                client = resource.client
-                self.log('debug', 'using client: %r' % client)
-                if hasattr(request, 'SerializeToString'):
-                    request.header.request_guid = str(uuid.uuid4())
-                    self.log('info', 'calling %s method on %s service '
-                                     'with request guid: %s' %
-                             (method, service,
-                              request.header.request_guid))
-                    request_message = request.SerializeToString()
-                else:
-                    request_message = str(request)
-                response = client.request(method, request_message,
-                                          response_class=response_class,
-                                          timeout=timeout, max_tries=max_tries,
-                                          sleep_before_retry=sleep_before_retry)
-                if hasattr(request, 'SerializeToString'):
-                    response_type = 'good' if response.header.success else 'bad'
-                    self.log('info', 'received %s response for %s method from %s '
-                                     'service for request guid: %s in %s '
-                                     'microseconds' %
-                             (response_type, method, service,
-                              response.header.request_guid,
-                              response.header.response_time))
-                else:
-                    self.log('info', 'received response: %s' % response)
-                return response
+            instance, lease, probe = pool.acquire(
+                timeout=RESOURCE_ACQUIRING_TIMEOUT)
+
+            def _send(instance, lease, probe, deposit=True):
+                if failover:
+                    return self._request_with_failover(
+                        pool, instance, lease, probe, method, service,
+                        request_message, response_class, timeout,
+                        max_tries, sleep_before_retry, deposit)
+                return self._request(instance, lease, probe, method, service,
+                                     request_message, response_class,
+                                     timeout, max_tries, sleep_before_retry)
+
+            if not hedge:
+                return _send(instance, lease, probe)
+
+            def _primary():
+                return _send(instance, lease, probe)
+
+            def _hedge():
+                try:
+                    hedge_instance, hedge_lease, hedge_probe = pool.acquire(
+                        timeout=RESOURCE_ACQUIRING_TIMEOUT,
+                        exclude=(instance.guid, ))
+                except Queue.Empty:
+                    raise ClientResourceNotAvailableError()
+                self.log('debug', 'hedging %s method on %s service to '
+                                  'instance: %s' %
+                         (method, service, hedge_instance.guid))
+                # the call was counted for the retry budget already
+                return _send(hedge_instance, hedge_lease, hedge_probe,
+                             deposit=False)
+
+            return self._hedger((service, method), _primary, _hedge,
+                                delay=hedge_delay)
         except Queue.Empty:
             self.log('error', 'no client to call method: %s on service: %s '
                      % (method, service))
@@ -172,3 +583,211 @@ class ServiceMethodCaller(object):
                      (method, service, traceback.format_exc()))
             raise exception
 
+    def _request(self, instance, lease, probe, method, service,
+                 request_message, response_class, timeout, max_tries,
+                 sleep_before_retry):
+        """
+        :param probe: probe of the breaker of instance, given back however
+        the request ends
+        """
+        with lease as resource:
+            client = resource.client
+            self.log('debug', 'using client: %r' % client)
+            instance.stats.start()
+            request_start_time = current_timestamp()
+            success = False
+            server_latency = None
+            settled = False
+            try:
+                response = client.request(
+                    method, request_message,
+                    response_class=response_class, timeout=timeout,
+                    max_tries=max_tries,
+                    sleep_before_retry=sleep_before_retry)
+                if hasattr(response, 'header'):
+                    success = response.header.success
+                    server_latency = response.header.response_time
+                else:
+                    success = True
+            except ServiceClientTimeoutError:
+                settled = True
+                instance.breaker.record_failure(timeout=True, probe=probe)
+                raise
+            except ServiceClientError:
+                settled = True
+                instance.breaker.record_failure(probe=probe)
+                raise
+            else:
+                # a response, even an unsuccessful one, means the instance
+                # is up
+                settled = True
+                instance.breaker.record_success(probe=probe)
+            finally:
+                if not settled:
+                    # e.g. a DecodeError or a raw ZMQError, which says
+                    # nothing of the instance
+                    instance.breaker.release(probe)
+                latency = current_timestamp() - request_start_time
+                instance.stats.finish(latency, success, server_latency)
+                self._managed_services[service][1].detect_outliers()
+            self._hedger.record_latency((service, method), latency)
+            if hasattr(response, 'header'):
+                response_type = 'good' if response.header.success else 'bad'
+                self.log('info', 'received %s response for %s method from %s '
+                                 'service for request guid: %s in %s '
+                                 'microseconds' %
+                         (response_type, method, service,
+                          response.header.request_guid,
+                          response.header.response_time))
+            else:
+                self.log('info', 'received response: %s' % response)
+            return response
+
+    def _request_with_failover(self, pool, instance, lease, probe, method,
+                               service, request_message, response_class,
+                               timeout, max_tries, sleep_before_retry,
+                               deposit=True):
+        """
+        Tries the request once per instance. A timeout or ZMQ error moves on
+        to a different instance right away, only once every instance failed
+        there is a jittered backoff, capped at max_sleep_before_retry, before
+        the next round. Rounds are bounded by max_tries, retries by the
+        retry budget.
+
+        :param deposit: whether the call adds to the retry budget
+        """
+        if deposit:
+            self._retry_budget.deposit()
+        failed_guids = set()
+        round_num = 0
+        while True:
+            try:
+                return self._request(instance, lease, probe, method, service,
+                                     request_message, response_class,
+                                     timeout, 1, sleep_before_retry)
+            except ServiceClientError as exception:
+                failed_guids.add(instance.guid)
+                self.log('error', 'instance: %s of %s service failed %s '
+                                  'method. Error: %r' %
+                         (instance.guid, service, method, exception))
+                error = exception
+
+            if not self._retry_budget.withdraw():
+                self._count_retry('num_retries_over_budget')
+                self.log('error', 'retry budget of %s service exhausted' %
+                         service)
+                raise error
+
+            if not set(pool.instances.keys()) - failed_guids:
+                # every instance failed in this round
+                round_num += 1
+                if round_num >= max_tries:
+                    raise error
+                sleep_duration = min(self._max_sleep_before_retry,
+                                     pow(2, round_num - 1) *
+                                     sleep_before_retry)
+                sleep_duration *= random.uniform(0.5, 1)
+                self._count_retry('num_backoffs')
+                self.log('debug', 'every instance of %s service failed, will '
+                                  'try again in %d milliseconds' %
+                         (service, sleep_duration))
+                time.sleep(sleep_duration / 1000.0)
+                failed_guids = set()
+            try:
+                instance, lease, probe = pool.acquire(
+                    timeout=RESOURCE_ACQUIRING_TIMEOUT, exclude=failed_guids)
+            except (Queue.Empty, ClientResourceNotAvailableError):
+                # the instances left are busy, or their breakers are open
+                self.log('error', 'no instance of %s service to fail over '
+                                  'to' % service)
+                raise error
+            self._count_retry('num_retries')
+
+    def _count_retry(self, name):
+        with self._retry_stats_lock:
+            self.retry_stats[name] += 1
+
+    def hedge_stats(self):
+        """
+        :return: counters of requests that could be hedged, hedges fired,
+        hedges won and hedges not fired for lack of budget
+        """
+        return dict(self._hedger.stats)
+
+    def map(self, method, service, requests, response_class=None,
+            concurrency=None, timeout=DEFAULT_TIME_OUT,
+            max_tries=DEFAULT_MAX_TRIES,
+            sleep_before_retry=DEFAULT_SLEEP_BEFORE_RETRY):
+        """
+        calls function 'method' on service 'service' once for every request,
+        spreading the calls over the pooled clients in parallel
+
+        :param concurrency: number of calls in flight at once, defaults to
+        the number of pooled clients of the service
+        :return: list of responses in the order of requests. The response of
+        a failed call is the exception it raised.
+        """
+        responses = [None] * len(requests)
+        for i, response in self.imap(method, service, requests,
+                                     response_class=response_class,
+                                     concurrency=concurrency,
+                                     timeout=timeout, max_tries=max_tries,
+                                     sleep_before_retry=sleep_before_retry):
+            responses[i] = response
+        return responses
+
+    def imap(self, method, service, requests, response_class=None,
+             concurrency=None, timeout=DEFAULT_TIME_OUT,
+             max_tries=DEFAULT_MAX_TRIES,
+             sleep_before_retry=DEFAULT_SLEEP_BEFORE_RETRY):
+        """
+        unordered version of map, yields a tuple of (index of request,
+        response or exception) as soon as each call finishes
+        """
+
+        if service not in self._managed_services:
+            raise UnknownServiceError('service: %s unknown' % service)
+
+        requests = list(requests)
+        if not requests:
+            return
+
+        # more callers than pooled clients would fail to acquire a client
+        available = self._managed_services[service][1].available()
+        if concurrency is None or concurrency > available:
+            concurrency = available
+        concurrency = max(1, min(concurrency, len(requests)))
+
+        pending = Queue.Queue()
+        for item in enumerate(requests):
+            pending.put(item)
+        results = Queue.Queue()
+        stop_event = threading.Event()
+
+        def _call():
+            while not stop_event.is_set():
+                try:
+                    i, request = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    response = self(method, service, request,
+                                    response_class=response_class,
+                                    timeout=timeout, max_tries=max_tries,
+                                    sleep_before_retry=sleep_before_retry)
+                except Exception as exception:
+                    response = exception
+                results.put((i, response))
+
+        for _ in range(concurrency):
+            caller = threading.Thread(target=_call,
+                                      name='%s-%s-map' % (service, method))
+            caller.daemon = True
+            caller.start()
+
+        try:
+            for _ in range(len(requests)):
+                yield results.get()
+        finally:
+            # the consumer may stop early, no new calls are made after that
+            stop_event.set()
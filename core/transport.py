@@ -0,0 +1,167 @@
+"""
+Module provides the transport manager, which owns the zmq context all
+clients of a process share
+"""
+
+import atexit
+import logging
+import os
+import threading
+import weakref
+import zmq
+
+from common.utils import zmq_socket_from_socket_type
+
+
+class TransportManager(object):
+    """
+    One zmq context per process, with 'io_threads' I/O threads, instead of
+    a context, and an I/O thread, per client. Sockets are handed out by the
+    manager, which keeps track of the open ones per endpoint and terminates
+    the context when the process exits.
+
+    A forked child gets a manager of its own the first time it asks for
+    one, the context of the parent can not be used after a fork.
+    """
+
+    DEFAULT_IO_THREADS = 1
+    # time the threads owning sockets get to close them on shutdown
+    SHUTDOWN_GRACE_PERIOD = 0.05  # in seconds
+    SHUTDOWN_TIMEOUT = 1.0  # in seconds
+
+    _instance = None
+    _instance_lock = threading.Lock()
+    io_threads = DEFAULT_IO_THREADS
+
+    def __init__(self, io_threads=DEFAULT_IO_THREADS, logger=None):
+        self.logger = logger
+        self.io_threads = io_threads
+        self.pid = os.getpid()
+        self.context = zmq.Context(io_threads=io_threads)
+        self._sockets = {}
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def __repr__(self):
+        return 'TransportManager(pid=%d, io_threads=%d, sockets=%d)' % (
+            self.pid, self.io_threads, sum(self.open_sockets().values()))
+
+    def log(self, level, message):
+        try:
+            if not hasattr(self, 'logger'):
+                return
+            logger = self.logger
+            if logger is None:
+                return
+            if not hasattr(logger, level):
+                return
+            logger_method = getattr(logger, level)
+            if not logger_method:
+                return
+            logger_method(message)
+        except:
+            pass
+
+    @classmethod
+    def configure(cls, io_threads=DEFAULT_IO_THREADS):
+        """
+        Sets the number of I/O threads of the context, which must be done
+        before the first client of the process is made
+
+        :return: whether it was applied
+        """
+        with cls._instance_lock:
+            cls.io_threads = io_threads
+            instance = cls._instance
+            return instance is None or instance.pid != os.getpid() or \
+                instance.io_threads == io_threads
+
+    @classmethod
+    def instance(cls):
+        """
+        :return: the TransportManager of the current process
+        """
+        instance = cls._instance
+        if instance is not None and instance.pid == os.getpid():
+            return instance
+        with cls._instance_lock:
+            instance = cls._instance
+            if instance is None or instance.pid != os.getpid():
+                instance = cls(cls.io_threads,
+                               logging.getLogger(cls.__name__))
+                cls._instance = instance
+            return instance
+
+    def socket(self, socket_type, endpoint=None, context=None):
+        """
+        :param socket_type: zmq socket type, or its name
+        :param endpoint: endpoint the socket is tracked under
+        :param context: context to make the socket in, e.g. a
+        zmq.green.Context, the shared one if None
+        :return: zmq socket
+        """
+        context = context or self.context
+        if isinstance(socket_type, basestring):
+            socket = zmq_socket_from_socket_type(context, socket_type)
+        else:
+            socket = context.socket(socket_type)
+        with self._lock:
+            self._sockets.setdefault(endpoint, weakref.WeakSet()).add(socket)
+        return socket
+
+    def open_sockets(self):
+        """
+        :return: dict of endpoint to number of open sockets
+        """
+        with self._lock:
+            result = {}
+            for endpoint, sockets in self._sockets.items():
+                num = len([x for x in sockets if not x.closed])
+                if num:
+                    result[endpoint] = num
+            return result
+
+    def shutdown(self):
+        """
+        Terminates the context, which makes blocking calls of the threads
+        owning sockets fail with ETERM, upon which each of them closes its
+        own sockets. zmq sockets are not thread safe, so the sockets still
+        open after SHUTDOWN_GRACE_PERIOD are only closed then, e.g. those of
+        pooled clients no thread uses.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        if os.getpid() != self.pid:
+            return
+        terminator = threading.Thread(target=self.context.term,
+                                      name='transport-manager-shutdown')
+        terminator.daemon = True
+        terminator.start()
+        terminator.join(self.SHUTDOWN_GRACE_PERIOD)
+        if not terminator.is_alive():
+            return
+        with self._lock:
+            sockets = [x for y in self._sockets.values() for x in y
+                       if not x.closed]
+        self.log('debug', '%r closing %d sockets left open: %r' %
+                 (self, len(sockets), self.open_sockets()))
+        for socket in sockets:
+            try:
+                socket.close(linger=0)
+            except Exception:
+                pass
+        terminator.join(self.SHUTDOWN_TIMEOUT)
+        if terminator.is_alive():
+            self.log('error', '%r sockets not closed in time: %r' %
+                     (self, self.open_sockets()))
+
+
+def _shutdown_at_exit():
+    instance = TransportManager._instance
+    if instance is not None and instance.pid == os.getpid():
+        instance.shutdown()
+
+
+atexit.register(_shutdown_at_exit)
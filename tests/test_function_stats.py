@@ -0,0 +1,168 @@
+"""
+Tests of the latency histogram, the per function stats and the slow log
+
+    python -m unittest discover -s tests -t .
+"""
+
+import random
+import unittest
+
+from core.function_stats import FunctionStats, LatencyHistogram, SlowLog
+
+
+class LatencyHistogramTest(unittest.TestCase):
+
+    def test_index_value_round_trip(self):
+        for index in range(LatencyHistogram._index(
+                LatencyHistogram.MAX_VALUE) + 1):
+            self.assertEqual(LatencyHistogram._index(
+                LatencyHistogram._value(index)), index)
+
+    def test_value_within_bucket_precision(self):
+        rng = random.Random(7)
+        values = range(1000) + [
+            rng.randint(1000, LatencyHistogram.MAX_VALUE)
+            for _ in range(10000)] + [LatencyHistogram.MAX_VALUE]
+        for value in values:
+            bucket_value = LatencyHistogram._value(
+                LatencyHistogram._index(value))
+            self.assertLessEqual(abs(bucket_value - value),
+                                 value / float(LatencyHistogram.SUB_BUCKETS))
+
+    def test_small_values_are_exact(self):
+        for value in range(2 * LatencyHistogram.SUB_BUCKETS):
+            self.assertEqual(LatencyHistogram._value(
+                LatencyHistogram._index(value)), value)
+
+    def test_percentiles(self):
+        histogram = LatencyHistogram()
+        values = range(1, 100001)
+        random.Random(7).shuffle(values)
+        for value in values:
+            histogram.record(value)
+        for percentile in (50, 90, 99, 99.9):
+            expected = percentile * 1000
+            self.assertLessEqual(
+                abs(histogram.percentile(percentile) - expected),
+                expected / float(LatencyHistogram.SUB_BUCKETS))
+        self.assertEqual(histogram.percentile(0), 1)
+        self.assertEqual(histogram.percentile(100), 100000)
+        self.assertEqual(histogram.count, 100000)
+        self.assertEqual(histogram.min, 1)
+        self.assertEqual(histogram.max, 100000)
+
+    def test_percentile_of_empty_histogram(self):
+        histogram = LatencyHistogram()
+        self.assertIsNone(histogram.percentile(50))
+        self.assertIsNone(histogram.to_dict()['mean'])
+
+    def test_out_of_range_values_are_clamped(self):
+        histogram = LatencyHistogram()
+        histogram.record(-5)
+        histogram.record(LatencyHistogram.MAX_VALUE * 2)
+        self.assertEqual(histogram.min, 0)
+        self.assertEqual(histogram.max, LatencyHistogram.MAX_VALUE)
+
+    def test_merge(self):
+        first, second, both = LatencyHistogram(), LatencyHistogram(), \
+            LatencyHistogram()
+        for value in range(0, 5000, 7):
+            first.record(value)
+            both.record(value)
+        for value in range(3, 90000, 11):
+            second.record(value)
+            both.record(value)
+        first.merge(second)
+        self.assertEqual(first.to_dict(), both.to_dict())
+
+
+class FunctionStatsTest(unittest.TestCase):
+
+    def test_record(self):
+        stats = FunctionStats()
+        stats.record('greet', 100, True, 10, 20, [('handle', 60),
+                                                   ('log', 5), ('log', 5)],
+                     40)
+        stats.record('greet', 300, False, 30, 40, [('handle', 80)])
+        d = stats.to_dict()['greet']
+        self.assertEqual(d['num_requests'], 2)
+        self.assertEqual(d['num_errors'], 1)
+        self.assertEqual(d['avg_request_bytes'], 20)
+        self.assertEqual(d['avg_response_bytes'], 30)
+        self.assertEqual(d['avg_phases'], {'handle': 70, 'log': 5})
+        self.assertEqual(d['avg_cpu_time'], 40)
+        self.assertEqual(d['latency']['min'], 100)
+        self.assertEqual(d['latency']['max'], 300)
+
+    def test_previous_window_is_kept(self):
+        stats = FunctionStats(window=1000)
+        stats.record('greet', 100, True)
+        stats._window_start -= 1000
+        stats.record('greet', 200, True)
+        d = stats.to_dict()['greet']
+        self.assertEqual(d['num_requests'], 2)
+        self.assertEqual(d['since'], stats._window_start - 1000)
+
+    def test_windows_rotate_out(self):
+        stats = FunctionStats(window=1000)
+        stats.record('greet', 100, True)
+        stats._window_start -= 1000
+        stats.record('hello', 200, True)
+        stats._window_start -= 1000
+        d = stats.to_dict()
+        self.assertNotIn('greet', d)
+        self.assertEqual(d['hello']['num_requests'], 1)
+
+    def test_idle_window_drops_everything(self):
+        stats = FunctionStats(window=1000)
+        stats.record('greet', 100, True)
+        stats._window_start -= 2000
+        self.assertEqual(stats.to_dict(), {})
+
+    def test_reset(self):
+        stats = FunctionStats()
+        stats.record('greet', 100, True)
+        stats.reset()
+        self.assertEqual(stats.to_dict(), {})
+
+
+class SlowLogTest(unittest.TestCase):
+
+    def test_keeps_slowest_first(self):
+        slow_log = SlowLog(size=3)
+        for response_time in (5, 1, 9, 7, 3, 8):
+            slow_log.record('greet', response_time)
+        self.assertEqual([x['response_time'] for x in slow_log.entries()],
+                         [9, 8, 7])
+
+    def test_entry(self):
+        slow_log = SlowLog()
+        slow_log.record('greet', 100, 'guid', 'client', 10, 20,
+                        [('handle', 60), ('log', 3), ('log', 4)], 50)
+        entry = slow_log.entries()[0]
+        self.assertEqual(entry['function'], 'greet')
+        self.assertEqual(entry['request_guid'], 'guid')
+        self.assertEqual(entry['client'], 'client')
+        self.assertEqual(entry['request_bytes'], 10)
+        self.assertEqual(entry['response_bytes'], 20)
+        self.assertEqual(entry['phases'], {'handle': 60, 'log': 7})
+        self.assertEqual(entry['cpu_time'], 50)
+
+    def test_window_rotates_out(self):
+        slow_log = SlowLog(size=2, window=1000)
+        slow_log.record('greet', 100)
+        slow_log.record('greet', 200)
+        slow_log._window_start -= 1000
+        slow_log.record('greet', 1)
+        self.assertEqual([x['response_time'] for x in slow_log.entries()],
+                         [1])
+
+    def test_reset(self):
+        slow_log = SlowLog()
+        slow_log.record('greet', 100)
+        self.assertEqual(len(slow_log.reset()), 1)
+        self.assertEqual(slow_log.entries(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()